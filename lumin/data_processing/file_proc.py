@@ -1,17 +1,19 @@
 import h5py
 import numpy as np
 import pandas as pd
-from typing import List, Union, Optional, Any, Tuple, Dict
+from typing import List, Union, Optional, Any, Tuple, Dict, Iterable
 import os
 from pathlib import Path
 import json
 
 from sklearn.model_selection import StratifiedKFold, KFold
 
-__all__ = ['save_to_grp', 'fold2foldfile', 'df2foldfile', 'add_meta_data']
+from .pre_proc import CatEncoder
 
+__all__ = ['save_to_grp', 'fold2foldfile', 'df2foldfile', 'chunks2foldfile', 'add_meta_data']
 
-def save_to_grp(arr:np.ndarray, grp:h5py.Group, name:str, compression:Optional[str]=None) -> None:
+
+def save_to_grp(arr:np.ndarray, grp:h5py.Group, name:str, compression:Optional[str]=None, chunks:Optional[Union[bool,Tuple[int,...]]]=None) -> None:
     r'''
     Save Numpy array as a dataset in an h5py Group
     
@@ -20,12 +22,121 @@ def save_to_grp(arr:np.ndarray, grp:h5py.Group, name:str, compression:Optional[s
         grp: group in which to save arr
         name: name of dataset to create
         compression: optional compression argument for h5py, e.g. 'lzf'
+        chunks: optional chunking argument for h5py, e.g. `True` for automatic chunk shape
     '''
 
     # TODO Option for string length
 
     ds = grp.create_dataset(name, shape=arr.shape, dtype=arr.dtype.name if arr.dtype.name not in ['object', 'str864'] else 'S64',
-                            data=arr if arr.dtype.name not in ['object', 'str864'] else arr.astype('S64'), compression=compression)
+                            data=arr if arr.dtype.name not in ['object', 'str864'] else arr.astype('S64'), compression=compression,
+                            chunks=chunks if len(arr) > 0 else None)
+
+
+def _append_to_grp(arr:np.ndarray, grp:h5py.Group, name:str, compression:Optional[str]=None) -> None:
+    r'''
+    Append Numpy array to a resizable, chunked dataset in an h5py Group along the first axis, creating the dataset if it does not yet exist
+    '''
+
+    if arr.dtype.name in ['object', 'str864']: arr = arr.astype('S64')
+    if name not in grp:
+        grp.create_dataset(name, data=arr, maxshape=(None,*arr.shape[1:]), chunks=True, compression=compression)
+    else:
+        ds = grp[name]
+        n = len(ds)
+        ds.resize(n+len(arr), axis=0)
+        ds[n:] = arr
+
+
+def _to_float32(arr:np.ndarray, sanitise:bool=False) -> np.ndarray:
+    r'''
+    Returns a float32 copy of the array, optionally with NaNs and infs replaced in place via `np.nan_to_num`
+    '''
+
+    arr = arr.astype('float32')
+    return np.nan_to_num(arr, copy=False) if sanitise else arr
+
+
+def _check_storage_dtypes(storage_dtypes:Optional[Dict[str,str]], columnar:bool=False) -> Dict[str,str]:
+    r'''
+    Checks requested storage types, and returns the storage type of each of 'inputs', 'cat_feats', and 'matrix_inputs'
+    '''
+
+    dtypes = {'inputs': 'float32', 'matrix_inputs': 'float32', **({} if storage_dtypes is None else storage_dtypes)}
+    unknown = [k for k in dtypes if k not in ['inputs', 'cat_feats', 'matrix_inputs']]
+    if len(unknown) > 0: raise ValueError(f"Storage types can only be set for inputs, cat_feats, and matrix_inputs, but {unknown} were passed")
+    for k in ['inputs', 'matrix_inputs']:
+        if dtypes[k] not in ['float32', 'float16', 'bfloat16']: raise ValueError(f"{k} must be stored as float32, float16, or bfloat16, not {dtypes[k]}")
+    if not columnar and dtypes.get('cat_feats', dtypes['inputs']) != dtypes['inputs']:
+        raise ValueError("Categorical features can only be stored separately from continuous features if columnar=True")
+    dtypes['cat_feats'] = dtypes.get('cat_feats', dtypes['inputs'])
+    if columnar and 'bfloat16' in [dtypes['inputs'], dtypes['cat_feats']]:
+        raise ValueError("Columnar inputs cannot be stored as bfloat16, since the virtual dataset of inputs could not decode them. Please use float16")
+    return dtypes
+
+
+def _to_storage(arr:np.ndarray, dtype:str='float32') -> np.ndarray:
+    r'''
+    Converts float32 data to the requested storage type. Since HDF5 has no bfloat16 type, bfloat16 data are stored in uint16 arrays as the upper 16 bits of
+    the float32 data, rounded to nearest even. Conversions which would overflow float16, or lose information when converting to integer types, raise errors.
+    '''
+
+    if dtype == 'float32': return arr
+    if dtype == 'bfloat16':
+        arr = np.ascontiguousarray(arr, dtype=np.float32)
+        bits = arr.view(np.uint32)
+        out = ((bits+np.uint32(0x7FFF)+((bits >> 16) & 1)) >> 16).astype(np.uint16)
+        out[np.isnan(arr)] = 0x7FC0
+        return out
+    with np.errstate(over='ignore', invalid='ignore'): out = arr.astype(dtype)
+    if np.dtype(dtype).kind == 'f':
+        if np.any(np.isinf(out) & np.isfinite(arr)): raise ValueError(f"Data exceed the range of {dtype}, please standardise them or use a wider type")
+    elif not np.array_equal(out, arr):
+        raise ValueError(f"Data cannot be stored as {dtype} without loss; only finite integer codes within the range of the type can be stored")
+    return out
+
+
+def _save_as(arr:np.ndarray, grp:h5py.Group, name:str, dtype:str='float32', compression:Optional[str]=None,
+             chunks:Optional[Union[bool,Tuple[int,...]]]=None, append:bool=False) -> None:
+    r'''
+    Saves, or appends, float32 data as a dataset in the requested storage type. Data stored as bfloat16 are marked via the 'dtype' attribute of the dataset
+    '''
+
+    arr = _to_storage(arr, dtype)
+    if append: _append_to_grp(arr, grp, name, compression=compression)
+    else:      save_to_grp(arr, grp, name, compression=compression, chunks=chunks)
+    if dtype == 'bfloat16': grp[name].attrs['dtype'] = 'bfloat16'
+
+
+def _get_inputs(df:pd.DataFrame, cont_feats:List[str], cat_feats:List[str], sanitise:bool=False) -> np.ndarray:
+    inputs = np.hstack((df[cont_feats].values.astype('float32'), df[cat_feats].values.astype('float32')))
+    return np.nan_to_num(inputs, copy=False) if sanitise else inputs
+
+
+def _add_columnar_view(grp:h5py.Group, feats:List[str]) -> None:
+    r'''
+    Create a virtual dataset 'inputs' which presents the per-feature datasets in sub-group 'input_columns' as the usual horizontally stacked matrix of inputs
+    '''
+
+    col_grp = grp['input_columns']
+    n = len(col_grp['0'])
+    layout = h5py.VirtualLayout(shape=(n,len(feats)), dtype='float32')
+    for i, f in enumerate(feats):
+        col_grp[str(i)].attrs['feat'] = f
+        layout[:,i] = h5py.VirtualSource('.', col_grp[str(i)].name, shape=(n,))  # '.' refers to the same file, even if renamed
+    grp.create_virtual_dataset('inputs', layout, fillvalue=np.nan)
+
+
+def _save_columnar_inputs(df:pd.DataFrame, feats:List[str], grp:h5py.Group, compression:Optional[str]=None, sanitise:bool=False,
+                          dtypes:Optional[List[str]]=None) -> None:
+    r'''
+    Save each input feature as its own chunked dataset in a sub-group 'input_columns', named by column index, and create a virtual dataset 'inputs' which
+    presents them as the usual horizontally stacked matrix of inputs. Features are stored in the types listed in `dtypes`, by default float32.
+    '''
+
+    col_grp = grp.create_group('input_columns')
+    if dtypes is None: dtypes = ['float32']*len(feats)
+    for i, f in enumerate(feats): _save_as(_to_float32(df[f].values, sanitise), col_grp, str(i), dtypes[i], compression=compression, chunks=True)
+    _add_columnar_view(grp, feats)
 
 
 def _build_matrix_lookups(feats:List[str], vecs:List[str], feats_per_vec:List[str], row_wise:bool) -> Tuple[List[str],np.ndarray,Tuple[int,int]]:
@@ -52,11 +163,53 @@ def _build_matrix_lookups(feats:List[str], vecs:List[str], feats_per_vec:List[st
     return list(lookup.flatten()),missing.flatten(),shape
 
 
+def _get_matrix(df:pd.DataFrame, matrix_lookup:List[str], matrix_missing:np.ndarray, matrix_shape:Tuple[int,int], sanitise:bool=False) -> np.ndarray:
+    mat = df[matrix_lookup].values.astype('float32')
+    mat[:,matrix_missing] = np.NaN
+    if sanitise: np.nan_to_num(mat, copy=False)
+    return mat.reshape((len(df),*matrix_shape))
+
+
+def _save_ragged_matrix(mat:np.ndarray, grp:h5py.Group, row_wise:bool, compression:Optional[str]=None, sanitise:bool=False,
+                        dtype:str='float32') -> None:
+    r'''
+    Saves (or appends) matrix data in ragged format: a sub-group 'matrix_inputs' containing the features of only the objects present in each row ('values'),
+    the index of each object within the padded matrix ('objects'), and the index in 'values' of the first object of each row, followed by the total number
+    of objects ('offsets'). Objects are missing if all of their features are NaN.
+
+    Arguments:
+        mat: padded matrix data, with NaN for missing objects and features
+        grp: group of the fold in which to save data
+        row_wise: whether objects are rows of the matrices, otherwise columns
+        compression: optional compression argument for h5py, e.g. 'lzf'
+        sanitise: whether to replace NaNs and infs in the features of present objects via `np.nan_to_num`
+        dtype: storage type of the features
+    '''
+
+    objs = mat if row_wise else mat.transpose(0,2,1)
+    present = ~np.isnan(objs).all(axis=2)
+    values = objs[present]
+    if sanitise: np.nan_to_num(values, copy=False)
+    counts = present.sum(axis=1)
+    offsets = np.cumsum(counts, dtype=np.int64)
+    if 'matrix_inputs' not in grp:
+        mat_grp = grp.create_group('matrix_inputs')
+        mat_grp.attrs['shape'],mat_grp.attrs['row_wise'] = mat.shape[1:],row_wise
+        offsets = np.concatenate([np.zeros(1, dtype=np.int64), offsets])
+    else:
+        mat_grp = grp['matrix_inputs']
+        offsets += mat_grp['offsets'][-1]
+    _save_as(values.astype('float32'), mat_grp, 'values', dtype, compression=compression, append=True)
+    _append_to_grp(np.nonzero(present)[1].astype(np.uint16), mat_grp, 'objects', compression=compression)
+    _append_to_grp(offsets, mat_grp, 'offsets', compression=compression)
+
+
 def fold2foldfile(df:pd.DataFrame, out_file:h5py.File, fold_idx:int,
                   cont_feats:List[str], cat_feats:List[str], targ_feats:Union[str,List[str]], targ_type:Any,
                   misc_feats:Optional[List[str]]=None, wgt_feat:Optional[str]=None,
                   matrix_lookup:Optional[List[str]]=None, matrix_missing:Optional[np.ndarray]=None, matrix_shape:Optional[Tuple[int,int]]=None,
-                  tensor_data:Optional[np.ndarray]=None, compression:Optional[str]=None) -> None:
+                  tensor_data:Optional[np.ndarray]=None, compression:Optional[str]=None, columnar:bool=False, sanitise:bool=False,
+                  ragged:bool=False, matrix_row_wise:Optional[bool]=None, storage_dtypes:Optional[Dict[str,str]]=None) -> None:
     r'''
     Save fold of data into an h5py Group
 
@@ -79,13 +232,25 @@ def fold2foldfile(df:pd.DataFrame, out_file:h5py.File, fold_idx:int,
             The array will be saved under matrix data, and this is incompatible with also setting `matrix_lookup`, `matrix_missing`, and `matrix_shape`.
             The first dimension of the array must be compatible with the length of the data frame.
         compression: optional compression argument for h5py, e.g. 'lzf'
+        columnar: whether to save each input feature as a separate, chunked dataset, allowing subsets of features to be read efficiently.
+            A virtual dataset combining the features is also created, such that the inputs may still be read as a single matrix.
+        sanitise: whether to replace NaNs and infs in the inputs and matrix inputs via `np.nan_to_num` before saving
+        ragged: whether to save matrix data in ragged format, i.e. only the features of the objects present in each row, rather than as padded matrices.
+            Tensor data must then be of shape (rows, objects, features)
+        storage_dtypes: optional dictionary of types in which to store 'inputs' and 'matrix_inputs' (float32, float16, or bfloat16), and, if `columnar`,
+            'cat_feats', e.g. 'uint8' for categorical codes. By default data are stored as float32. Data are upcast to float32 when read.
     '''
 
     # TODO infer target type automatically
 
+    dtypes = _check_storage_dtypes(storage_dtypes, columnar)
     grp = out_file.create_group(f'fold_{fold_idx}')
     
-    save_to_grp(np.hstack((df[cont_feats].values.astype('float32'), df[cat_feats].values.astype('float32'))), grp, 'inputs', compression=compression)
+    if columnar:
+        _save_columnar_inputs(df, cont_feats+cat_feats, grp, compression=compression, sanitise=sanitise,
+                              dtypes=[dtypes['inputs']]*len(cont_feats)+[dtypes['cat_feats']]*len(cat_feats))
+    else:
+        _save_as(_get_inputs(df, cont_feats, cat_feats, sanitise), grp, 'inputs', dtypes['inputs'], compression=compression)
     save_to_grp(df[targ_feats].values.astype(targ_type), grp, 'targets', compression=compression)
     if wgt_feat is not None: 
         if wgt_feat in df.columns: save_to_grp(df[wgt_feat].values.astype('float32'), grp, 'weights', compression=compression)
@@ -98,20 +263,28 @@ def fold2foldfile(df:pd.DataFrame, out_file:h5py.File, fold_idx:int,
     if matrix_lookup is not None:
         if tensor_data is not None:
             raise ValueError("The saving of both matrix and tensor data is requested. This is ambiguous. Please only set one of the other.")
-        mat = df[matrix_lookup].values.astype('float32')
-        mat[:,matrix_missing] = np.NaN
-        mat = mat.reshape((len(df),*matrix_shape))
-        save_to_grp(mat, grp, 'matrix_inputs', compression=compression)
+        if ragged:
+            _save_ragged_matrix(_get_matrix(df, matrix_lookup, matrix_missing, matrix_shape), grp, matrix_row_wise, compression=compression, sanitise=sanitise,
+                                dtype=dtypes['matrix_inputs'])
+        else:
+            _save_as(_get_matrix(df, matrix_lookup, matrix_missing, matrix_shape, sanitise), grp, 'matrix_inputs', dtypes['matrix_inputs'],
+                     compression=compression)
 
     elif tensor_data is not None:
-        save_to_grp(tensor_data.astype('float32'), grp, 'matrix_inputs', compression=compression)
+        if ragged:
+            if tensor_data.ndim != 3: raise ValueError("Ragged tensor data must have shape (rows, objects, features)")
+            _save_ragged_matrix(tensor_data.astype('float32'), grp, True, compression=compression, sanitise=sanitise, dtype=dtypes['matrix_inputs'])
+        else:
+            _save_as(_to_float32(tensor_data, sanitise), grp, 'matrix_inputs', dtypes['matrix_inputs'], compression=compression)
 
 
 def df2foldfile(df:pd.DataFrame, n_folds:int, cont_feats:List[str], cat_feats:List[str],
                 targ_feats:Union[str,List[str]], savename:Union[Path,str], targ_type:str,
                 strat_key:Optional[str]=None, misc_feats:Optional[List[str]]=None, wgt_feat:Optional[str]=None, cat_maps:Optional[Dict[str,Dict[int,Any]]]=None,
                 matrix_vecs:Optional[List[str]]=None, matrix_feats_per_vec:Optional[List[str]]=None, matrix_row_wise:Optional[bool]=None,
-                tensor_data:Optional[np.ndarray]=None, tensor_name:Optional[str]=None, compression:Optional[str]=None) -> None:
+                tensor_data:Optional[np.ndarray]=None, tensor_name:Optional[str]=None, compression:Optional[str]=None, columnar:bool=False,
+                swmr:bool=False, sanitise:bool=False, ragged:bool=False, storage_dtypes:Optional[Dict[str,str]]=None,
+                cat_encoder:Optional[CatEncoder]=None) -> None:
     r'''
     Convert dataframe into h5py file by splitting data into sub-folds to be accessed by a :class:`~lumin.nn.data.fold_yielder.FoldYielder`
     
@@ -137,12 +310,37 @@ def df2foldfile(df:pd.DataFrame, n_folds:int, cont_feats:List[str], cat_feats:Li
             The first dimension of the array must be compatible with the length of the data frame.
         tensor_name: if `tensor_data` is set, then this is the name that will to the foldfile's metadata.
         compression: optional compression argument for h5py, e.g. 'lzf'
+        columnar: whether to save each input feature as a separate, chunked dataset, allowing subsets of features to be read efficiently.
+            A virtual dataset combining the features is also created, such that the inputs may still be read as a single matrix.
+        swmr: whether to create the file using the latest HDF5 format, which is required to later open it for single-writer-multiple-reader access
+        sanitise: whether to replace NaNs and infs in the inputs and matrix inputs via `np.nan_to_num` before saving. The foldfile is then marked as
+            sanitised in its meta data, and :class:`~lumin.nn.data.fold_yielder.FoldYielder` will not need to clean the data each time it is read
+        ragged: whether to save matrix data in ragged format, i.e. only the features of the objects present in each row, rather than as padded matrices.
+            Objects are missing if all of their features are NaN. This can greatly reduce the size of the foldfile for data with variable numbers of objects.
+            :class:`~lumin.nn.data.fold_yielder.FoldYielder` pads the data when read. Tensor data must be of shape (rows, objects, features)
+        storage_dtypes: optional dictionary of types in which to store 'inputs' and 'matrix_inputs' (float32, float16, or bfloat16), and, if `columnar`,
+            'cat_feats', e.g. 'uint8' for categorical codes. By default data are stored as float32. Reduced-precision storage reduces the amount of data to
+            read, and is normally lossless in practice for standardised features. The storage types are recorded in the meta data, and
+            :class:`~lumin.nn.data.fold_yielder.FoldYielder` upcasts data to float32 when read.
+        cat_encoder: optional, fitted :class:`~lumin.data_processing.pre_proc.CatEncoder`, used to encode the categorical features before saving,
+            without modifying `df`. If `cat_maps` is not set, the category mapping of the encoder is saved in the meta data.
+            The cardinalities of the encoder, including any reserved code for unseen categories, are also saved, and used to size embeddings
+
+    Examples::
+        >>> df2foldfile(df, n_folds=10, cont_feats=cont_feats, cat_feats=cat_feats, targ_feats='gen_target', targ_type='int', savename='train',
+        ...             storage_dtypes={'inputs': 'float16', 'matrix_inputs': 'bfloat16'})
     '''
 
+    storage_dtypes = _check_storage_dtypes(storage_dtypes, columnar)
     savename = str(savename)
     os.system(f'rm {savename}.hdf5')
     os.makedirs(savename[:savename.rfind('/')], exist_ok=True)
-    out_file = h5py.File(f'{savename}.hdf5', "w")
+    out_file = h5py.File(f'{savename}.hdf5', "w", libver='latest' if swmr else None)
+    cat_szs = None
+    if cat_encoder is not None:
+        df = cat_encoder.transform(df, inplace=False)
+        if cat_maps is None: cat_maps = cat_encoder.get_cat_maps()
+        cat_szs = cat_encoder.get_cat_szs()
     lookup,missing,shape = None,None,None
     if matrix_vecs is not None:
         if tensor_data is not None:
@@ -168,16 +366,158 @@ def df2foldfile(df:pd.DataFrame, n_folds:int, cont_feats:List[str], cat_feats:Li
         fold2foldfile(df.iloc[fold].copy(), out_file, fold_idx, cont_feats=cont_feats, cat_feats=cat_feats, targ_feats=targ_feats,
                       targ_type=targ_type, misc_feats=misc_feats, wgt_feat=wgt_feat,
                       matrix_lookup=lookup, matrix_missing=missing, matrix_shape=shape, tensor_data=tensor_data[fold] if tensor_data is not None else None,
-                      compression=compression)
+                      compression=compression, columnar=columnar, sanitise=sanitise, ragged=ragged, matrix_row_wise=matrix_row_wise,
+                      storage_dtypes=storage_dtypes)
     add_meta_data(out_file=out_file, feats=df.columns, cont_feats=cont_feats, cat_feats=cat_feats, cat_maps=cat_maps, targ_feats=targ_feats, wgt_feat=wgt_feat,
                   matrix_vecs=matrix_vecs, matrix_feats_per_vec=matrix_feats_per_vec, matrix_row_wise=matrix_row_wise,
-                  tensor_name=tensor_name, tensor_shp=tensor_data[0].shape if tensor_data is not None else None)
+                  tensor_name=tensor_name, tensor_shp=tensor_data[0].shape if tensor_data is not None else None, sanitised=sanitise,
+                  storage_dtypes=storage_dtypes, cat_szs=cat_szs)
+
+
+def _assign_folds(n:int, n_folds:int, offset:int) -> np.ndarray:
+    r'''
+    Deal `n` rows to `n_folds` folds in turn, continuing from `offset`, and shuffle the assignments, such that fold sizes never differ by more than one
+    '''
+
+    folds = (offset+np.arange(n)) % n_folds
+    np.random.shuffle(folds)
+    return folds
+
+
+def chunks2foldfile(chunks:Iterable[pd.DataFrame], n_folds:int, cont_feats:List[str], cat_feats:List[str],
+                    targ_feats:Union[str,List[str]], savename:Union[Path,str], targ_type:str,
+                    strat_key:Optional[str]=None, misc_feats:Optional[List[str]]=None, wgt_feat:Optional[str]=None,
+                    cat_maps:Optional[Dict[str,Dict[int,Any]]]=None,
+                    matrix_vecs:Optional[List[str]]=None, matrix_feats_per_vec:Optional[List[str]]=None, matrix_row_wise:Optional[bool]=None,
+                    compression:Optional[str]=None, columnar:bool=False, swmr:bool=False, sanitise:bool=False, ragged:bool=False,
+                    storage_dtypes:Optional[Dict[str,str]]=None, cat_encoder:Optional[CatEncoder]=None) -> None:
+    r'''
+    Streaming version of :meth:`~lumin.data_processing.file_proc.df2foldfile`, which converts an iterable of DataFrame chunks into an h5py file split into
+    sub-folds to be accessed by a :class:`~lumin.nn.data.fold_yielder.FoldYielder`.
+    Only one chunk is held in memory at a time: rows are assigned to folds as they arrive and appended to resizable, chunked datasets in the foldfile.
+    Folds are filled in turn, such that their sizes (per class of `strat_key`, if set) never differ by more than one.
+    Within each fold, rows retain the order in which they were streamed.
+
+    Arguments:
+        chunks: iterable of DataFrames, all with the same columns, e.g. `pd.read_csv(..., chunksize=100000)` or a generator
+        n_folds: number of folds to split data into
+        cont_feats: list of columns to save as continuous variables
+        cat_feats: list of columns to save as discreet variables
+        targ_feats: (list of) column(s) to save as target feature(s)
+        savename: name of h5py file to create (.h5py extension not required)
+        targ_type: type of target feature, e.g. int,'float32'
+        strat_key: column to use for stratified splitting, by keeping running counts of each class
+        misc_feats: any extra columns to save
+        wgt_feat: column to save as data weights
+        cat_maps: Dictionary mapping categorical features to dictionary mapping codes to categories
+        matrix_vecs: list of objects for matrix encoding, i.e. feature prefixes
+        matrix_feats_per_vec: list of features per vector for matrix encoding, i.e. feature suffixes.
+            Features listed but not present in the data will be replaced with NaN.
+        matrix_row_wise: whether objects encoded as a matrix should be encoded row-wise (i.e. all the features associated with an object are in their own row),
+            or column-wise (i.e. all the features associated with an object are in their own column)
+        compression: optional compression argument for h5py, e.g. 'lzf'
+        columnar: whether to save each input feature as a separate, chunked dataset, allowing subsets of features to be read efficiently.
+            A virtual dataset combining the features is also created, such that the inputs may still be read as a single matrix.
+        swmr: whether to create the file using the latest HDF5 format, which is required to later open it for single-writer-multiple-reader access
+        sanitise: whether to replace NaNs and infs in the inputs and matrix inputs via `np.nan_to_num` before saving. The foldfile is then marked as
+            sanitised in its meta data, and :class:`~lumin.nn.data.fold_yielder.FoldYielder` will not need to clean the data each time it is read
+        ragged: whether to save matrix data in ragged format, i.e. only the features of the objects present in each row, rather than as padded matrices.
+            Objects are missing if all of their features are NaN. :class:`~lumin.nn.data.fold_yielder.FoldYielder` pads the data when read
+        storage_dtypes: optional dictionary of types in which to store 'inputs' and 'matrix_inputs' (float32, float16, or bfloat16), and, if `columnar`,
+            'cat_feats', e.g. 'uint8' for categorical codes. By default data are stored as float32.
+            :class:`~lumin.nn.data.fold_yielder.FoldYielder` upcasts data to float32 when read
+        cat_encoder: optional, fitted :class:`~lumin.data_processing.pre_proc.CatEncoder`, used to encode the categorical features of each chunk as it
+            arrives. If `cat_maps` is not set, the category mapping of the encoder is saved in the meta data.
+            The cardinalities of the encoder, including any reserved code for unseen categories, are also saved, and used to size embeddings
+
+    Examples::
+        >>> chunks2foldfile(pd.read_csv('train.csv', chunksize=1000000), n_folds=10,
+        ...                 cont_feats=cont_feats, cat_feats=cat_feats, targ_feats='gen_target',
+        ...                 savename='train', targ_type='int', strat_key='gen_target', wgt_feat='gen_weight')
+    '''
+
+    savename = str(savename)
+    storage_dtypes = _check_storage_dtypes(storage_dtypes, columnar)
+    os.system(f'rm {savename}.hdf5')
+    os.makedirs(savename[:savename.rfind('/')], exist_ok=True)
+    out_file = h5py.File(f'{savename}.hdf5', "w", libver='latest' if swmr else None)
+    grps = [out_file.create_group(f'fold_{i}') for i in range(n_folds)]
+    if cat_maps is None and cat_encoder is not None: cat_maps = cat_encoder.get_cat_maps()
+    cat_szs = None if cat_encoder is None else cat_encoder.get_cat_szs()
+    lookup,missing,shape,feats = None,None,None,None
+    offsets = {}  # Running count per stratification class of rows already assigned
+    for chunk in chunks:
+        if cat_encoder is not None: chunk = cat_encoder.transform(chunk, inplace=False)
+        if feats is None:  # Set up using first chunk
+            feats = chunk.columns
+            if matrix_vecs is not None:
+                lookup,missing,shape = _build_matrix_lookups(feats, matrix_vecs, matrix_feats_per_vec, matrix_row_wise)
+                mat_feats = list(np.array(lookup)[np.logical_not(missing)])  # Only features present in data
+                dup = [f for f in cont_feats if f in mat_feats]
+                if len(dup) > 1:
+                    print(f'{dup} present in both matrix features and continuous features; removing from continuous features')
+                    cont_feats = [f for f in cont_feats if f not in dup]
+            if strat_key is not None and strat_key not in feats:
+                print(f'{strat_key} not found in DataFrame')
+                strat_key = None
+            if wgt_feat is not None and wgt_feat not in feats:
+                print(f'{wgt_feat} not found in file')
+                wgt_feat = None
+            if misc_feats is not None:
+                for f in misc_feats:
+                    if f not in feats: print(f'{f} not found in file')
+                misc_feats = [f for f in misc_feats if f in feats]
+
+        fold_ids = np.empty(len(chunk), dtype=int)
+        if strat_key is None:
+            fold_ids[:] = _assign_folds(len(chunk), n_folds, offsets.get(None, 0))
+            offsets[None] = offsets.get(None, 0)+len(chunk)
+        else:
+            classes = chunk[strat_key].values
+            for c in np.unique(classes):
+                cut = classes == c
+                fold_ids[cut] = _assign_folds(cut.sum(), n_folds, offsets.get(c, 0))
+                offsets[c] = offsets.get(c, 0)+cut.sum()
+
+        order = np.argsort(fold_ids, kind='stable')  # Group rows by fold, retaining their order
+        bounds = np.searchsorted(fold_ids[order], np.arange(n_folds+1))
+        for fold_idx, grp in enumerate(grps):
+            df = chunk.iloc[order[bounds[fold_idx]:bounds[fold_idx+1]]]
+            if len(df) == 0: continue
+            if columnar:
+                for i, f in enumerate(cont_feats+cat_feats):
+                    _save_as(_to_float32(df[f].values, sanitise), grp.require_group('input_columns'), str(i),
+                             storage_dtypes['inputs' if i < len(cont_feats) else 'cat_feats'], compression=compression, append=True)
+            else:
+                _save_as(_get_inputs(df, cont_feats, cat_feats, sanitise), grp, 'inputs', storage_dtypes['inputs'], compression=compression, append=True)
+            _append_to_grp(df[targ_feats].values.astype(targ_type), grp, 'targets', compression=compression)
+            if wgt_feat is not None: _append_to_grp(df[wgt_feat].values.astype('float32'), grp, 'weights', compression=compression)
+            if misc_feats is not None:
+                for f in misc_feats: _append_to_grp(df[f].values, grp, f, compression=compression)
+            if lookup is not None:
+                if ragged:
+                    _save_ragged_matrix(_get_matrix(df, lookup, missing, shape), grp, matrix_row_wise, compression=compression, sanitise=sanitise,
+                                        dtype=storage_dtypes['matrix_inputs'])
+                else:
+                    _save_as(_get_matrix(df, lookup, missing, shape, sanitise), grp, 'matrix_inputs', storage_dtypes['matrix_inputs'],
+                             compression=compression, append=True)
+
+    if feats is None: raise ValueError("No data chunks were provided")
+    for fold_idx, grp in enumerate(grps):
+        if 'targets' not in grp: raise ValueError(f"Insufficient data to fill fold {fold_idx}")
+        print(f"Saved fold {fold_idx} with {len(grp['targets'])} events")
+        if columnar: _add_columnar_view(grp, cont_feats+cat_feats)
+    add_meta_data(out_file=out_file, feats=feats, cont_feats=cont_feats, cat_feats=cat_feats, cat_maps=cat_maps, targ_feats=targ_feats, wgt_feat=wgt_feat,
+                  matrix_vecs=matrix_vecs, matrix_feats_per_vec=matrix_feats_per_vec, matrix_row_wise=matrix_row_wise, sanitised=sanitise,
+                  storage_dtypes=storage_dtypes, cat_szs=cat_szs)
+    out_file.close()
 
 
 def add_meta_data(out_file:h5py.File, feats:List[str], cont_feats:List[str], cat_feats:List[str], cat_maps:Optional[Dict[str,Dict[int,Any]]],
                   targ_feats:Union[str,List[str]], wgt_feat:Optional[str]=None,
                   matrix_vecs:Optional[List[str]]=None, matrix_feats_per_vec:Optional[List[str]]=None, matrix_row_wise:Optional[bool]=None,
-                  tensor_name:Optional[str]=None, tensor_shp:Optional[Tuple[int]]=None) -> None:
+                  tensor_name:Optional[str]=None, tensor_shp:Optional[Tuple[int]]=None, sanitised:bool=False,
+                  storage_dtypes:Optional[Dict[str,str]]=None, cat_szs:Optional[Dict[str,int]]=None) -> None:
     r'''
     Adds meta data to foldfile containing information about the data: feature names, matrix information, etc.
     :class:`~lumin.nn.data.fold_yielder.FoldYielder` objects will access this and automatically extract it to save the user from having to manually pass lists
@@ -196,6 +536,13 @@ def add_meta_data(out_file:h5py.File, feats:List[str], cont_feats:List[str], cat
             Features listed but not present in df will be replaced with NaN.
         matrix_row_wise: whether objects encoded as a matrix should be encoded row-wise (i.e. all the features associated with an object are in their own row),
             or column-wise (i.e. all the features associated with an object are in their own column)
+        tensor_name: name of tensor data, if saved
+        tensor_shp: shape of a single data point of tensor data, if saved
+        sanitised: whether NaNs and infs in the inputs and matrix inputs were replaced before saving
+        storage_dtypes: optional dictionary of the types in which the inputs, categorical features, and matrix inputs were stored
+        cat_szs: optional dictionary mapping categorical features to their cardinalities, e.g. from
+            :meth:`~lumin.data_processing.pre_proc.CatEncoder.get_cat_szs`. If set, used by :meth:`~lumin.nn.models.helpers.CatEmbedder.from_fy`
+            in place of the maximum code present in the data
     '''
 
     grp = out_file.create_group('meta_data')
@@ -204,6 +551,9 @@ def add_meta_data(out_file:h5py.File, feats:List[str], cont_feats:List[str], cat
     grp.create_dataset('targ_feats',   data=json.dumps(targ_feats))
     if wgt_feat is not None: grp.create_dataset('wgt_feat', data=json.dumps(wgt_feat))
     if cat_maps is not None: grp.create_dataset('cat_maps', data=json.dumps(cat_maps))
+    if cat_szs is not None: grp.create_dataset('cat_szs', data=json.dumps(cat_szs))
+    grp.create_dataset('sanitised', data=json.dumps(sanitised))
+    if storage_dtypes is not None: grp.create_dataset('storage_dtypes', data=json.dumps(storage_dtypes))
     if matrix_vecs is not None:
         lookup,missing,shape = _build_matrix_lookups(feats, matrix_vecs, matrix_feats_per_vec, matrix_row_wise)
         use = list(np.array(lookup)[np.logical_not(missing)])  # Only features present in data
@@ -0,0 +1,495 @@
+import numpy as np
+import pandas as pd
+from typing import List, Dict, Union, Optional, Iterable, Iterator, Tuple
+from itertools import combinations
+
+__all__ = ['pt', 'eta', 'phi', 'abs_mom', 'mass', 'from_pt_eta_phi', 'boost', 'boost_to_cm', 'cos_delta', 'FourVectors', 'CombinatorialFeatures']
+
+'''
+Vectorised kernels operating on arrays of 4-momenta, whose last axis holds the Cartesian components (px, py, pz, E).
+Any leading shape is supported, e.g. (N,4) for one vector per event, or (N,n_obj,4) for several objects per event.
+'''
+
+
+def pt(p:np.ndarray) -> np.ndarray:
+    r'''
+    Transverse momenta of an array of momenta
+
+    Arguments:
+        p: (..., 3|4) array of Cartesian momenta
+
+    Returns:
+        (...) array of transverse momenta
+    '''
+
+    return np.sqrt(np.square(p[...,0])+np.square(p[...,1]))
+
+
+def eta(p:np.ndarray) -> np.ndarray:
+    r'''
+    Pseudorapidities of an array of momenta
+
+    Arguments:
+        p: (..., 3|4) array of Cartesian momenta
+
+    Returns:
+        (...) array of pseudorapidities
+    '''
+
+    with np.errstate(divide='ignore', invalid='ignore'): return np.arcsinh(p[...,2]/pt(p))
+
+
+def phi(p:np.ndarray) -> np.ndarray:
+    r'''
+    Azimuthal angles of an array of momenta, in range [-pi,pi]
+
+    Arguments:
+        p: (..., 3|4) array of Cartesian momenta
+
+    Returns:
+        (...) array of azimuthal angles
+    '''
+
+    return np.arctan2(p[...,1], p[...,0])
+
+
+def abs_mom(p:np.ndarray) -> np.ndarray:
+    r'''
+    Magnitudes of the 3-momenta of an array of momenta
+
+    Arguments:
+        p: (..., 3|4) array of Cartesian momenta
+
+    Returns:
+        (...) array of 3-momenta magnitudes
+    '''
+
+    return np.sqrt(np.einsum('...i,...i->...', p[...,:3], p[...,:3]))
+
+
+def mass(p:np.ndarray) -> np.ndarray:
+    r'''
+    Invariant masses of an array of 4-momenta. Negative squared masses result in NaNs.
+
+    Arguments:
+        p: (..., 4) array of Cartesian 4-momenta
+
+    Returns:
+        (...) array of invariant masses
+    '''
+
+    with np.errstate(invalid='ignore'): return np.sqrt(np.square(p[...,3])-np.einsum('...i,...i->...', p[...,:3], p[...,:3]))
+
+
+def from_pt_eta_phi(pt:np.ndarray, eta:Optional[np.ndarray], phi:np.ndarray, mass:Union[float,np.ndarray]=0, energy:Optional[np.ndarray]=None,
+                    out:Optional[np.ndarray]=None) -> np.ndarray:
+    r'''
+    Converts arrays of pT, eta, phi coordinates to Cartesian 4-momenta
+
+    Arguments:
+        pt: array of transverse momenta
+        eta: array of pseudorapidities, or None for 2D momenta, which are given a pz of zero
+        phi: array of azimuthal angles
+        mass: (array of) masses used to compute the energies, if `energy` is not set
+        energy: optional array of energies
+        out: optional (..., 4) array in which to write the momenta
+
+    Returns:
+        (..., 4) array of Cartesian 4-momenta
+    '''
+
+    pt = np.asarray(pt)
+    if out is None: out = np.empty(pt.shape+(4,), dtype=np.promote_types(pt.dtype, np.float32))
+    out[...,0] = pt*np.cos(phi)
+    out[...,1] = pt*np.sin(phi)
+    out[...,2] = 0 if eta is None else pt*np.sinh(eta)
+    if energy is not None: out[...,3] = energy
+    else:                  out[...,3] = np.sqrt(np.square(mass)+np.square(pt)+np.square(out[...,2]))
+    return out
+
+
+def boost(p:np.ndarray, b:np.ndarray) -> np.ndarray:
+    r'''
+    Boosts 4-momenta by velocity vectors.
+    N.B. Implementation adapted from ROOT (https://root.cern/)
+
+    Arguments:
+        p: (..., 4) array of Cartesian 4-momenta
+        b: (..., 3) array of boost velocities, in units of c, broadcastable to the shape of the 3-momenta of `p`
+
+    Returns:
+        (..., 4) array of boosted 4-momenta
+    '''
+
+    b2 = np.einsum('...i,...i->...', b, b)
+    if b2.max() > 1: raise ValueError('Boosting vector implies speed greater than c')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        g = 1.0/np.sqrt(1-b2)
+        g2 = np.where(b2 > 0, (g-1)/b2, 0)
+    bp = np.einsum('...i,...i->...', p[...,:3], b)
+    p3 = p[...,:3]+(g2*bp+g*p[...,3])[...,None]*b
+    return np.concatenate((p3, (g*(p[...,3]+bp))[...,None]), axis=-1)
+
+
+def boost_to_cm(p:np.ndarray) -> np.ndarray:
+    r'''
+    Velocity vectors required to boost 4-momenta to their centre-of-mass frames
+
+    Arguments:
+        p: (..., 4) array of Cartesian 4-momenta
+
+    Returns:
+        (..., 3) array of boost velocities
+    '''
+
+    return -p[...,:3]/p[...,3:4]
+
+
+def cos_delta(p0:np.ndarray, p1:np.ndarray) -> np.ndarray:
+    r'''
+    Cosines of the angular separations of two arrays of momenta
+
+    Arguments:
+        p0: (..., 3|4) array of Cartesian momenta
+        p1: (..., 3|4) array of Cartesian momenta
+
+    Returns:
+        (...) array of cosines of the angles between the momenta
+    '''
+
+    return np.einsum('...i,...i->...', p0[...,:3], p1[...,:3])/(abs_mom(p0)*abs_mom(p1))
+
+
+def _delta_phi(phi_0:np.ndarray, phi_1:np.ndarray) -> np.ndarray: return np.remainder(phi_1-phi_0+np.pi, 2*np.pi)-np.pi
+
+
+class FourVectors:
+    r'''
+    Structure-of-arrays container for the 4-momenta of named objects, e.g. the leptons and jets in each event, held as a single (N,n_obj,4) array of
+    Cartesian components (px, py, pz, E). Kinematic quantities are computed by vectorised kernels over all events and objects at once, rather than via
+    DataFrame columns and intermediate Series.
+
+    Arguments:
+        data: (N,n_obj,4) array of Cartesian 4-momenta
+        objs: names of the objects, in order of the second axis of `data`
+
+    Examples::
+        >>> fv = FourVectors.from_df(df, ['muon', 'tau', 'b_0', 'b_1'], masses={'muon': 0.105})
+        >>> df['m_bb'] = mass(fv['b_0']+fv['b_1'])
+        >>> df['dR_muon_tau'] = fv.delta_r('muon', 'tau')
+        >>> fv.boost_to(fv.get_sum(['b_0', 'b_1'])).to_df(df, suffix='_bbframe')
+    '''
+
+    def __init__(self, data:np.ndarray, objs:List[str]):
+        if data.ndim != 3 or data.shape[1:] != (len(objs), 4): raise ValueError(f"Data must have shape (N,{len(objs)},4), but has shape {data.shape}")
+        self.data,self.objs = data,list(objs)
+        self._idxs = {o: i for i, o in enumerate(self.objs)}
+
+    def __repr__(self) -> str: return f'FourVectors of {self.objs} for {len(self)} events'
+
+    def __len__(self) -> int: return len(self.data)
+
+    def __getitem__(self, obj:Union[str,List[str]]) -> Union[np.ndarray,'FourVectors']:
+        r'''
+        Returns the (N,4) array of 4-momenta of an object, or FourVectors of a list of objects
+        '''
+
+        if isinstance(obj, str): return self.data[:,self._idxs[obj]]
+        return FourVectors(self.data[:,[self._idxs[o] for o in obj]], obj)
+
+    @classmethod
+    def from_df(cls, df:pd.DataFrame, objs:List[str], masses:Optional[Union[float,Dict[str,float]]]=None, dtype:str='float64') -> 'FourVectors':
+        r'''
+        Extracts the 4-momenta of objects from DataFrame columns. Each object can be defined in either Cartesian coordinates (columns [obj]_px, [obj]_py,
+        and optionally [obj]_pz) or pT, eta, phi coordinates (columns [obj]_pT or [obj]_pt, [obj]_phi, and optionally [obj]_eta).
+        Energies are taken from column [obj]_E, if present, or otherwise computed from the masses in column [obj]_mass, or `masses`, or else assuming zero mass.
+
+        Arguments:
+            df: DataFrame with data
+            objs: column prefixes of the objects
+            masses: optional mass, or dictionary mapping objects to masses, used for objects without [obj]_E or [obj]_mass columns
+            dtype: type of the array of 4-momenta
+
+        Returns:
+            FourVectors of the objects
+        '''
+
+        data = np.empty((len(df), len(objs), 4), dtype=dtype)
+        cols = set(df.columns)
+        for i, o in enumerate(objs):
+            out = data[:,i]
+            m = masses.get(o, 0) if isinstance(masses, dict) else (0 if masses is None else masses)
+            if f'{o}_mass' in cols: m = df[f'{o}_mass'].values
+            e = df[f'{o}_E'].values if f'{o}_E' in cols else None
+            if f'{o}_px' in cols and f'{o}_py' in cols:
+                out[:,0],out[:,1] = df[f'{o}_px'].values,df[f'{o}_py'].values
+                out[:,2] = df[f'{o}_pz'].values if f'{o}_pz' in cols else 0
+                if e is None: out[:,3] = np.sqrt(np.square(m)+np.einsum('ij,ij->i', out[:,:3], out[:,:3]))
+                else:         out[:,3] = e
+            else:
+                pt_name = f'{o}_pT' if f'{o}_pT' in cols else f'{o}_pt'
+                from_pt_eta_phi(df[pt_name].values, df[f'{o}_eta'].values if f'{o}_eta' in cols else None, df[f'{o}_phi'].values, mass=m, energy=e,
+                                out=out)
+        return cls(data, objs)
+
+    def _get(self, obj:Optional[str]) -> np.ndarray: return self.data if obj is None else self[obj]
+
+    def pt(self, obj:Optional[str]=None) -> np.ndarray:
+        r'''
+        Returns the (N,) array of transverse momenta of an object, or the (N,n_obj) array of all objects
+        '''
+
+        return pt(self._get(obj))
+
+    def eta(self, obj:Optional[str]=None) -> np.ndarray:
+        r'''
+        Returns the (N,) array of pseudorapidities of an object, or the (N,n_obj) array of all objects
+        '''
+
+        return eta(self._get(obj))
+
+    def phi(self, obj:Optional[str]=None) -> np.ndarray:
+        r'''
+        Returns the (N,) array of azimuthal angles of an object, or the (N,n_obj) array of all objects
+        '''
+
+        return phi(self._get(obj))
+
+    def abs_mom(self, obj:Optional[str]=None) -> np.ndarray:
+        r'''
+        Returns the (N,) array of 3-momenta magnitudes of an object, or the (N,n_obj) array of all objects
+        '''
+
+        return abs_mom(self._get(obj))
+
+    def mass(self, obj:Optional[str]=None) -> np.ndarray:
+        r'''
+        Returns the (N,) array of invariant masses of an object, or the (N,n_obj) array of all objects
+        '''
+
+        return mass(self._get(obj))
+
+    def get_sum(self, objs:Optional[List[str]]=None) -> np.ndarray:
+        r'''
+        Returns the (N,4) array of the summed 4-momenta of the listed objects, by default all objects, e.g. the 4-momenta of their parent particle
+        '''
+
+        return self.data.sum(axis=1) if objs is None else self.data[:,[self._idxs[o] for o in objs]].sum(axis=1)
+
+    def delta_phi(self, obj_0:str, obj_1:str) -> np.ndarray:
+        r'''
+        Returns the (N,) array of azimuthal separations of `obj_1` from `obj_0`, in range [-pi,pi]
+        '''
+
+        return _delta_phi(self.phi(obj_0), self.phi(obj_1))
+
+    def delta_r(self, obj_0:str, obj_1:str) -> np.ndarray:
+        r'''
+        Returns the (N,) array of delta R separations of two objects, using pseudorapidity
+        '''
+
+        return np.hypot(self.delta_phi(obj_0, obj_1), self.eta(obj_0)-self.eta(obj_1))
+
+    def cos_delta(self, obj_0:str, obj_1:str) -> np.ndarray:
+        r'''
+        Returns the (N,) array of cosines of the angular separations of two objects
+        '''
+
+        return cos_delta(self[obj_0], self[obj_1])
+
+    def boost(self, b:np.ndarray) -> 'FourVectors':
+        r'''
+        Boosts all objects by velocity vectors
+
+        Arguments:
+            b: (N,3) array of boost velocities, in units of c, applied to all objects in each event, or (N,n_obj,3) array of velocities per object
+
+        Returns:
+            FourVectors of the boosted objects
+        '''
+
+        return FourVectors(boost(self.data, b[:,None] if b.ndim == 2 else b), self.objs)
+
+    def boost_to(self, ref:Union[str,np.ndarray]) -> 'FourVectors':
+        r'''
+        Boosts all objects into the rest frame of a reference vector
+
+        Arguments:
+            ref: name of object, or (N,4) array of 4-momenta, in whose rest frame to express the objects
+
+        Returns:
+            FourVectors of the boosted objects
+        '''
+
+        return self.boost(boost_to_cm(self[ref] if isinstance(ref, str) else ref))
+
+    def to_df(self, df:Optional[pd.DataFrame]=None, objs:Optional[List[str]]=None, cartesian:bool=True, inc_energy:bool=True, inc_mass:bool=False,
+              suffix:str='') -> pd.DataFrame:
+        r'''
+        Writes the 4-momenta of objects to DataFrame columns
+
+        Arguments:
+            df: DataFrame to which to add columns. If None, a new DataFrame is created
+            objs: objects to write, by default all objects
+            cartesian: whether to write columns [obj]_px, [obj]_py, [obj]_pz, or else [obj]_pT, [obj]_eta, [obj]_phi
+            inc_energy: whether to write column [obj]_E
+            inc_mass: whether to write column [obj]_mass
+            suffix: optional string appended to object names to create column prefixes, e.g. to distinguish boosted objects
+
+        Returns:
+            DataFrame with columns added
+        '''
+
+        if df is None: df = pd.DataFrame()
+        for o in (self.objs if objs is None else objs):
+            p,n = self[o],f'{o}{suffix}'
+            if cartesian:
+                for j, c in enumerate(['px', 'py', 'pz']): df[f'{n}_{c}'] = p[:,j]
+            else:
+                df[f'{n}_pT'],df[f'{n}_eta'],df[f'{n}_phi'] = pt(p),eta(p),phi(p)
+            if inc_energy: df[f'{n}_E'] = p[:,3]
+            if inc_mass: df[f'{n}_mass'] = mass(p)
+        return df
+
+
+class CombinatorialFeatures:
+    r'''
+    Computes observables for every pair, and optionally every triplet, of a list of objects, e.g. the invariant masses and delta R separations of all pairs
+    of jets and leptons. Each observable is computed for all combinations at once, via vectorised operations over the (N,n_obj,4) array of
+    :class:`~lumin.data_processing.four_vector.FourVectors`, rather than one combination at a time.
+
+    Combinations are named by joining the names of their objects with underscores, in the order in which the objects are listed, and features are named
+    [combination]_[observable], e.g. 'muon_jet_0_mass'. Features are ordered by combination, pairs then triplets, and then by observable, such that the pair
+    features can also be saved as matrix inputs, via :meth:`~lumin.data_processing.four_vector.CombinatorialFeatures.get_matrix_args`.
+    Separations are those of the second object from the first.
+
+    Pair observables: 'mass' and 'pT' of the summed momenta, 'dR', 'dphi', 'deta', and 'cosdelta'. Triplet observables: 'mass' and 'pT' of the summed
+    momenta.
+
+    Arguments:
+        objs: column prefixes of the objects
+        pair_feats: observables to compute for every pair of objects
+        triplet_feats: observables to compute for every triplet of objects
+        masses: optional mass, or dictionary mapping objects to masses, used when extracting objects from DataFrames,
+            see :meth:`~lumin.data_processing.four_vector.FourVectors.from_df`
+        dtype: type of the computed features
+
+    Examples::
+        >>> comb = CombinatorialFeatures(['muon', 'tau', 'jet_0', 'jet_1'], pair_feats=['mass', 'dR'], triplet_feats=['mass'])
+        >>> df = comb.to_df(df)
+        >>>
+        >>> matrix_vecs,matrix_feats_per_vec = comb.get_matrix_args()
+        >>> chunks2foldfile(comb.stream(pd.read_csv('train.csv', chunksize=1000000)), n_folds=10,
+        ...                 cont_feats=cont_feats, cat_feats=cat_feats, targ_feats='gen_target', savename='train', targ_type='int',
+        ...                 matrix_vecs=matrix_vecs, matrix_feats_per_vec=matrix_feats_per_vec, matrix_row_wise=True)
+    '''
+
+    pair_obs = ['mass', 'pT', 'dR', 'dphi', 'deta', 'cosdelta']
+    triplet_obs = ['mass', 'pT']
+
+    def __init__(self, objs:List[str], pair_feats:List[str]=['mass', 'dR'], triplet_feats:Optional[List[str]]=None,
+                 masses:Optional[Union[float,Dict[str,float]]]=None, dtype:str='float32'):
+        triplet_feats = [] if triplet_feats is None else triplet_feats
+        for feats, obs, c in [(pair_feats, self.pair_obs, 'pair'), (triplet_feats, self.triplet_obs, 'triplet')]:
+            unknown = [f for f in feats if f not in obs]
+            if len(unknown) > 0: raise ValueError(f"{unknown} are not recognised {c} observables, please choose from {obs}")
+        self.objs,self.pair_feats,self.triplet_feats,self.masses,self.dtype = list(objs),list(pair_feats),list(triplet_feats),masses,dtype
+        self.pairs = np.array(list(combinations(range(len(objs)), 2)), dtype=int).reshape(-1, 2)
+        self.triplets = np.array(list(combinations(range(len(objs)), 3)) if len(triplet_feats) > 0 else [], dtype=int).reshape(-1, 3)
+        self.pair_names    = ['_'.join(self.objs[i] for i in c) for c in self.pairs] if len(pair_feats) > 0 else []
+        self.triplet_names = ['_'.join(self.objs[i] for i in c) for c in self.triplets]
+
+    def __repr__(self) -> str:
+        return f'CombinatorialFeatures computing {len(self.get_feats())} features for {len(self.pair_names)} pairs and {len(self.triplet_names)} triplets'
+
+    def get_feats(self) -> List[str]:
+        r'''
+        Returns:
+            list of the names of the computed features, in the order in which they are computed
+        '''
+
+        return [f'{c}_{f}' for c in self.pair_names for f in self.pair_feats]+[f'{c}_{f}' for c in self.triplet_names for f in self.triplet_feats]
+
+    def get_matrix_args(self) -> Tuple[List[str],List[str]]:
+        r'''
+        Returns the arguments with which to save the pair features as row-wise matrix inputs
+
+        Returns:
+            list of pair names, to pass as `matrix_vecs`
+            list of pair observables, to pass as `matrix_feats_per_vec`
+        '''
+
+        return self.pair_names, self.pair_feats
+
+    def compute(self, data:Union[FourVectors,pd.DataFrame], out:Optional[np.ndarray]=None) -> np.ndarray:
+        r'''
+        Computes the features
+
+        Arguments:
+            data: :class:`~lumin.data_processing.four_vector.FourVectors` containing the objects, or DataFrame from which to extract them
+            out: optional (N,n_features) array into which to write the features, e.g. a slice of a larger buffer
+
+        Returns:
+            (N,n_features) array of features, in the order of :meth:`~lumin.data_processing.four_vector.CombinatorialFeatures.get_feats`
+        '''
+
+        if isinstance(data, pd.DataFrame): data = FourVectors.from_df(data, self.objs, masses=self.masses)
+        p = data.data if data.objs == self.objs else data[self.objs].data
+        q = np.ascontiguousarray(p.transpose(2, 1, 0))  # (4,n_obj,N), such that gathering combinations copies contiguous rows
+        n_pf,n_p = len(self.pair_feats),len(self.pair_names)
+        res = np.empty((len(self.get_feats()), len(p)), dtype=self.dtype) if out is None else out.T  # Features as rows
+
+        def _v(x:np.ndarray) -> np.ndarray: return np.moveaxis(x, 0, -1)  # View with components last, as expected by the kernels
+
+        if n_p > 0:
+            i,j = self.pairs[:,0],self.pairs[:,1]
+            s  = q[:,i]+q[:,j]   if 'mass' in self.pair_feats or 'pT' in self.pair_feats else None
+            dp = phi(_v(q))      if 'dphi' in self.pair_feats or 'dR' in self.pair_feats else None
+            de = eta(_v(q))      if 'deta' in self.pair_feats or 'dR' in self.pair_feats else None
+            if dp is not None: dp = _delta_phi(dp[i], dp[j])
+            if de is not None: de = de[j]-de[i]
+            for k, f in enumerate(self.pair_feats):
+                if   f == 'mass': x = mass(_v(s))
+                elif f == 'pT':   x = pt(_v(s))
+                elif f == 'dphi': x = dp
+                elif f == 'deta': x = de
+                elif f == 'dR':   x = np.sqrt(np.square(dp)+np.square(de))
+                else:
+                    with np.errstate(divide='ignore', invalid='ignore'): x = cos_delta(_v(q[:,i]), _v(q[:,j]))
+                res[k:n_pf*n_p:n_pf] = x
+        if len(self.triplet_names) > 0:
+            s = q[:,self.triplets[:,0]]+q[:,self.triplets[:,1]]+q[:,self.triplets[:,2]]
+            n_tf,start = len(self.triplet_feats),n_pf*n_p
+            for k, f in enumerate(self.triplet_feats): res[start+k::n_tf] = mass(_v(s)) if f == 'mass' else pt(_v(s))
+        return res.T
+
+    def to_df(self, data:Union[FourVectors,pd.DataFrame], df:Optional[pd.DataFrame]=None) -> pd.DataFrame:
+        r'''
+        Computes the features and returns them as the columns of a DataFrame.
+        Features are joined to existing DataFrames in a single operation, returning a new DataFrame, rather than being inserted column by column.
+
+        Arguments:
+            data: :class:`~lumin.data_processing.four_vector.FourVectors` containing the objects, or DataFrame from which to extract them
+            df: DataFrame to which to join the features. If None, and `data` is a DataFrame, the features are joined to `data`,
+                otherwise only the features are returned
+
+        Returns:
+            DataFrame with the features
+        '''
+
+        if df is None and isinstance(data, pd.DataFrame): df = data
+        feats = pd.DataFrame(self.compute(data), columns=self.get_feats(), index=None if df is None else df.index)
+        return feats if df is None else pd.concat((df, feats), axis=1)
+
+    def stream(self, chunks:Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        r'''
+        Adds the features to each of a stream of DataFrame chunks, e.g. to pass to :meth:`~lumin.data_processing.file_proc.chunks2foldfile`
+
+        Arguments:
+            chunks: iterable of DataFrames
+
+        Returns:
+            Generator yielding the chunks, with the features added as new columns
+        '''
+
+        for c in chunks: yield self.to_df(c)
@@ -1,10 +1,20 @@
 import numpy as np
 import pandas as pd
-from typing import List, Dict, Tuple, Union, Optional, Set
+from typing import List, Dict, Tuple, Union, Optional, Set, Callable, Any, Iterable, Iterator
 import warnings
+import os
+import multiprocessing as mp
+from collections import deque
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+from . import four_vector as fv
 
 __all__ = ['to_cartesian', 'to_pt_eta_phi', 'delta_phi', 'twist', 'add_abs_mom', 'add_mass', 'add_energy', 'add_mt', 'get_vecs', 'fix_event_phi', 'fix_event_z',
-           'fix_event_y', 'event_to_cartesian', 'proc_event', 'calc_pair_mass', 'boost', 'boost2cm', 'get_momentum', 'cos_delta', 'delta_r', 'delta_r_boosted']
+           'fix_event_y', 'event_to_cartesian', 'proc_event', 'calc_pair_mass', 'boost', 'boost2cm', 'get_momentum', 'cos_delta', 'delta_r', 'delta_r_boosted',
+           'parallel_proc']
 
 '''
 Todo:
@@ -23,18 +33,11 @@ def to_cartesian(df:pd.DataFrame, vec:str, drop:bool=False) -> None:
     '''
 
     z = f'{vec}_eta' in df.columns
-    try:
-        pt = df[f'{vec}_pT']
-        pt_name = f'{vec}_pT'
-    except KeyError:
-        pt = df[f'{vec}_pt']
-        pt_name = f'{vec}_pt'
-
-    if z: eta = df[f'{vec}_eta']  
-    phi = df[f'{vec}_phi']
+    pt_name = f'{vec}_pT' if f'{vec}_pT' in df.columns else f'{vec}_pt'
+    pt,phi = df[pt_name].values,df[f'{vec}_phi'].values
     df[f'{vec}_px'] = pt*np.cos(phi)
     df[f'{vec}_py'] = pt*np.sin(phi)
-    if z: df[f'{vec}_pz'] = pt*np.sinh(eta)
+    if z: df[f'{vec}_pz'] = pt*np.sinh(df[f'{vec}_eta'].values)
     if drop:
         df.drop(columns=[pt_name, f"{vec}_phi"], inplace=True)
         if z: df.drop(columns=[f"{vec}_eta"], inplace=True)
@@ -51,17 +54,12 @@ def to_pt_eta_phi(df:pd.DataFrame, vec:str, drop:bool=False) -> None:
     '''
 
     eta = f'{vec}_pz' in df.columns
-    px = df[f"{vec}_px"]
-    py = df[f"{vec}_py"]
-    if eta: pz = df[f"{vec}_pz"]  
-    df[f'{vec}_pT'] = np.sqrt(np.square(px) + np.square(py))
-    if eta: df[f'{vec}_eta'] = np.arcsinh(pz/df[f'{vec}_pT'])
-
-    df[f'{vec}_phi'] = np.arcsin(py/df[f'{vec}_pT'])
-    df.loc[(df[f"{vec}_px"] < 0) & (df[f"{vec}_py"] > 0), f'{vec}_phi'] =   np.pi-df.loc[(df[f"{vec}_px"] < 0) & (df[f"{vec}_py"] > 0), f'{vec}_phi']
-    df.loc[(df[f"{vec}_px"] < 0) & (df[f"{vec}_py"] < 0), f'{vec}_phi'] = -(np.pi+df.loc[(df[f"{vec}_px"] < 0) & (df[f"{vec}_py"] < 0), f'{vec}_phi'])         
-    df.loc[(df[f"{vec}_px"] < 0) & (df[f"{vec}_py"] == 0), f'{vec}_phi'] = \
-        np.random.choice((-np.pi, np.pi), df[(df[f"{vec}_px"] < 0) & (df[f"{vec}_py"] == 0)].shape[0])
+    px,py = df[f"{vec}_px"].values,df[f"{vec}_py"].values
+    pt = np.hypot(px, py)
+    df[f'{vec}_pT'] = pt
+    if eta:
+        with np.errstate(divide='ignore', invalid='ignore'): df[f'{vec}_eta'] = np.arcsinh(df[f"{vec}_pz"].values/pt)
+    df[f'{vec}_phi'] = np.arctan2(py, px)
 
     if drop:
         df.drop(columns=[f"{vec}_px", f"{vec}_py"], inplace=True)
@@ -80,11 +78,7 @@ def delta_phi(arr_a:Union[float,np.ndarray], arr_b:Union[float,np.ndarray]) -> U
         angular separation as float or np.array
     '''
 
-    df = pd.DataFrame()  # Better way to do this without df?
-    df['dphi'] = arr_b-arr_a
-    while len(df[df.dphi > np.pi]) > 0:  df.loc[df.dphi > np.pi, 'dphi']  -= 2*np.pi
-    while len(df[df.dphi < -np.pi]) > 0: df.loc[df.dphi < -np.pi, 'dphi'] += 2*np.pi
-    return df.dphi.values
+    return fv._delta_phi(np.asarray(arr_a), np.asarray(arr_b))
 
 
 def delta_r(dphi:Union[float,np.ndarray], deta:Union[float,np.ndarray]) -> Union[float, np.ndarray]:
@@ -129,8 +123,10 @@ def add_abs_mom(df:pd.DataFrame, vec:str, z:bool=True) -> None:
 
     # TODO extend to work on pT, eta, phi vectors
 
-    if z and f'{vec}_pz' in df.columns: df[f'{vec}_absp'] = np.sqrt(np.square(df[f'{vec}_px'])+np.square(df[f'{vec}_py'])+np.square(df[f'{vec}_pz']))
-    else:                               df[f'{vec}_absp'] = np.sqrt(np.square(df[f'{vec}_px'])+np.square(df[f'{vec}_py']))
+    if z and f'{vec}_pz' in df.columns:
+        df[f'{vec}_absp'] = np.sqrt(np.square(df[f'{vec}_px'].values)+np.square(df[f'{vec}_py'].values)+np.square(df[f'{vec}_pz'].values))
+    else:
+        df[f'{vec}_absp'] = np.hypot(df[f'{vec}_px'].values, df[f'{vec}_py'].values)
 
 
 def add_mass(df:pd.DataFrame, vec:str) -> None:
@@ -143,7 +139,7 @@ def add_mass(df:pd.DataFrame, vec:str) -> None:
     '''
 
     if f'{vec}_absp' not in df.columns: add_abs_mom(df, vec)
-    df[f'{vec}_mass'] = np.sqrt(np.square(df[f'{vec}_E'])-np.square(df[f'{vec}_absp']))
+    with np.errstate(invalid='ignore'): df[f'{vec}_mass'] = np.sqrt(np.square(df[f'{vec}_E'].values)-np.square(df[f'{vec}_absp'].values))
 
 
 def add_energy(df:pd.DataFrame, vec:str) -> None:
@@ -156,7 +152,7 @@ def add_energy(df:pd.DataFrame, vec:str) -> None:
     '''
 
     if f'{vec}_absp' not in df.columns: add_abs_mom(df, vec)
-    df[f'{vec}_E'] = np.sqrt(np.square(df[f'{vec}_mass'] if f'{vec}_mass' in df.columns else 0)+np.square(df[f'{vec}_absp']))
+    df[f'{vec}_E'] = np.sqrt(np.square(df[f'{vec}_mass'].values if f'{vec}_mass' in df.columns else 0)+np.square(df[f'{vec}_absp'].values))
 
 
 def add_mt(df:pd.DataFrame, vec:str, mpt_name:str='mpt'):
@@ -209,7 +205,7 @@ def fix_event_phi(df:pd.DataFrame, ref_vec:str) -> None:
 
     # TODO: extend to work on Cartesian coordinates
 
-    for v in get_vecs(df.columns):
+    for v in sorted(get_vecs(df.columns)):
         if v != ref_vec: df[f'{v}_phi'] = delta_phi(df[f'{ref_vec}_phi'], df[f'{v}_phi'])
     df[f'{ref_vec}_phi'] = 0
 
@@ -225,12 +221,12 @@ def fix_event_z(df:pd.DataFrame, ref_vec:str) -> None:
 
     if f'{ref_vec}_eta' in df.columns:
         cut = (df[f'{ref_vec}_eta'] < 0)
-        for v in get_vecs(df.columns):
+        for v in sorted(get_vecs(df.columns)):
             try: df.loc[cut, f'{v}_eta'] = -df.loc[cut, f'{v}_eta'] 
             except KeyError: print(f'eta component of {v} not found')
     else:
         cut = cut = (df[f'{ref_vec}_pz'] < 0)
-        for v in get_vecs(df.columns):
+        for v in sorted(get_vecs(df.columns)):
             try: df.loc[cut, f'{v}_pz'] = -df.loc[cut, f'{v}_pz']
             except KeyError: print(f'pz component of {v} not found')
 
@@ -247,11 +243,11 @@ def fix_event_y(df:pd.DataFrame, ref_vec_0:str, ref_vec_1:str) -> None:
     
     if f'{ref_vec_1}_phi' in df.columns:
         cut = (df[f'{ref_vec_1}_phi'] < 0)
-        for v in get_vecs(df.columns):
+        for v in sorted(get_vecs(df.columns)):
             if v != ref_vec_0: df.loc[cut, f'{v}_phi'] = -df.loc[cut, f'{v}_phi'] 
     else:
         cut = (df[f'{ref_vec_1}_py'] < 0)
-        for v in get_vecs(df.columns):
+        for v in sorted(get_vecs(df.columns)):
             if v != ref_vec_0: df.loc[cut, f'{v}_py'] = -df.loc[cut, f'{v}_py']
 
 
@@ -265,7 +261,7 @@ def event_to_cartesian(df:pd.DataFrame, drop:bool=False, ignore:Optional[List[st
         ignore: vectors to ignore when converting
     '''
     
-    for v in get_vecs(df.columns):
+    for v in sorted(get_vecs(df.columns)):
         if ignore is None or v not in ignore: to_cartesian(df, v, drop=drop)
 
 
@@ -327,20 +323,14 @@ def calc_pair_mass(df:pd.DataFrame, masses:Union[Tuple[float,float],Tuple[np.nda
         np.array of invarient masses
     '''
 
-    # TODO: rewrite to not use a DataFrame for holding parent vector
     # TODO: add inplace option
     # TODO: extend to work on pT, eta, phi coordinates
 
-    tmp = pd.DataFrame()
-    tmp['0_E'] = np.sqrt((masses[0]**2)+np.square(df.loc[:, feat_map['0_px']])+np.square(df.loc[:, feat_map['0_py']])+np.square(df.loc[:, feat_map['0_pz']]))
-    tmp['1_E'] = np.sqrt((masses[1]**2)+np.square(df.loc[:, feat_map['1_px']])+np.square(df.loc[:, feat_map['1_py']])+np.square(df.loc[:, feat_map['1_pz']]))
-    tmp['p_px'] = df.loc[:, feat_map['0_px']]+df.loc[:, feat_map['1_px']]
-    tmp['p_py'] = df.loc[:, feat_map['0_py']]+df.loc[:, feat_map['1_py']]
-    tmp['p_pz'] = df.loc[:, feat_map['0_pz']]+df.loc[:, feat_map['1_pz']]
-    tmp['p_E'] = tmp.loc[:, '0_E']+tmp.loc[:, '1_E']
-    tmp['p_p2'] = np.square(tmp.loc[:, 'p_px'])+np.square(tmp.loc[:, 'p_py'])+np.square(tmp.loc[:, 'p_pz'])
-    tmp['p_mass'] = np.sqrt(np.square(tmp.loc[:, 'p_E'])-tmp.loc[:, 'p_p2'])
-    return tmp.p_mass.values
+    p = [[df[feat_map[f'{i}_{c}']].values for c in ['px', 'py', 'pz']] for i in range(2)]
+    e = np.sqrt(np.square(masses[0])+np.square(p[0][0])+np.square(p[0][1])+np.square(p[0][2]))
+    e += np.sqrt(np.square(masses[1])+np.square(p[1][0])+np.square(p[1][1])+np.square(p[1][2]))
+    with np.errstate(invalid='ignore'):
+        return np.sqrt(np.square(e)-np.square(p[0][0]+p[1][0])-np.square(p[0][1]+p[1][1])-np.square(p[0][2]+p[1][2]))
 
 
 def boost(ref_vec:Union[np.ndarray,str], boost_vec:Union[np.ndarray,str], df:Optional[pd.DataFrame]=None, rescale_boost:bool=False) -> np.ndarray:
@@ -364,19 +354,7 @@ def boost(ref_vec:Union[np.ndarray,str], boost_vec:Union[np.ndarray,str], df:Opt
     b = get_momentum(df, boost_vec, include_E=rescale_boost, as_cart=True) if isinstance(boost_vec, str) else boost_vec
     
     if rescale_boost: b = (b/b[:,3:4])[:,:3]
-    
-    b2 = np.square(np.linalg.norm(b, axis=1))
-    if b2.max() > 1: raise ValueError('Boosting vector implies speed greater than c')
-    
-    g = (1.0/np.sqrt(1-b2))
-    bp = np.sum(v[:,:3]*b, axis=1)
-    g2 = (g-1)/b2
-    g2[b2 <= 0] = 0
-    bv = v.copy()
-    bv[:,:3] += (g2[:,None]*bp[:,None]*b) + (g[:,None]*b*v[:,3][:,None])
-    bv[:,3] += bp
-    bv[:,3] *= g
-    return bv
+    return fv.boost(v, b)
 
 
 def boost2cm(vec:Union[np.array,str], df:Optional[pd.DataFrame]=None) -> np.array:
@@ -393,7 +371,7 @@ def boost2cm(vec:Union[np.array,str], df:Optional[pd.DataFrame]=None) -> np.arra
     '''
     
     v = get_momentum(df, vec, include_E=True, as_cart=True) if isinstance(vec, str) else vec
-    return -(v/v[:,3:4])[:,:3] 
+    return fv.boost_to_cm(v)
 
 
 def get_momentum(df:pd.DataFrame, vec:str, include_E:bool=False, as_cart:bool=False) -> np.array:
@@ -414,10 +392,9 @@ def get_momentum(df:pd.DataFrame, vec:str, include_E:bool=False, as_cart:bool=Fa
         v = np.hstack((v, df[f'{vec}_pz'].values[:,None])) if f'{vec}_pz' in df.columns else np.hstack((v, np.zeros_like(df.index.values[:,None])))
     else:
         pt = 'pT' if f'{vec}_pT' in df.columns else 'pt'
-        v = df[[f'{vec}_{pt}', f'{vec}_phi']].values
-        v = np.hstack((v[:,0], df[f'{vec}_eta'].values[:,None]), v[:,1]) if f'{vec}_eta' in df.columns \
-            else np.hstack((v[:,0], np.zeros_like(df.index.values[:,None]), v[:,1]))
-        if as_cart: v = to_cartesian(pd.DataFrame(v, columns=['vec_pT', 'vec_phi', 'vec_eta']), vec='vec', drop=True).values
+        eta = df[f'{vec}_eta'].values if f'{vec}_eta' in df.columns else np.zeros(len(df))
+        if as_cart: v = fv.from_pt_eta_phi(df[f'{vec}_{pt}'].values, eta, df[f'{vec}_phi'].values)[:,:3]
+        else:       v = np.stack((df[f'{vec}_{pt}'].values, df[f'{vec}_phi'].values, eta), axis=1)
     if include_E:
         if f'{vec}_E' not in df.columns: add_energy(df, vec)
         v = np.hstack((v, df[f'{vec}_E'].values[:,None]))
@@ -447,11 +424,9 @@ def cos_delta(vec_0:Union[np.array,str], vec_1:Union[np.array,str], df:Optional[
     v0 = get_momentum(df, vec_0) if isinstance(vec_0, str) else vec_0
     v1 = get_momentum(df, vec_1) if isinstance(vec_1, str) else vec_1
     if name is None: name = f'cosdelta_{vec_0}_{vec_1}' if isinstance(vec_0, str) and isinstance(vec_1, str) else 'cosdelta'
-        
-    d = np.sum(v0*v1, axis=1)
-    mag = np.linalg.norm(v0, axis=1)*np.linalg.norm(v1, axis=1)
-    if inplace: df[name] = d/mag
-    else:       return d/mag
+    cd = fv.cos_delta(v0, v1)
+    if inplace: df[name] = cd
+    else:       return cd
 
 
 def delta_r_boosted(vec_0:Union[np.array,str], vec_1:Union[np.array,str], ref_vec:Union[np.array,str], df:Optional[pd.DataFrame]=None, name:Optional[str]=None,
@@ -477,16 +452,144 @@ def delta_r_boosted(vec_0:Union[np.array,str], vec_1:Union[np.array,str], ref_ve
     '''
     
     br = boost2cm(ref_vec, df)[:,:3]
-    b0 = boost(vec_0, br, df)[:,:3]
-    b1 = boost(vec_1, br, df)[:,:3]
+    b0 = boost(vec_0, br, df)
+    b1 = boost(vec_1, br, df)
     if name is None:
         name = f'dR_{vec_0}_{vec_1}_boosted_{ref_vec}' if isinstance(vec_0, str) and isinstance(vec_1, str) and isinstance(ref_vec, str) else 'dR_boosted'
-    
-    tmp_df = pd.DataFrame(np.hstack((b0,b1)), columns=['0_px', '0_py', '0_pz', '1_px', '1_py', '1_pz'])
-    for v in range(2): to_pt_eta_phi(tmp_df, str(v), drop=True)
-    dphi = delta_phi(tmp_df['0_phi'], tmp_df['1_phi'])
-    deta = tmp_df['0_eta']-tmp_df['1_eta']
-    dr = delta_r(dphi, deta)
+    dr = delta_r(delta_phi(fv.phi(b0), fv.phi(b1)), fv.eta(b0)-fv.eta(b1))
     
     if inplace: df[name] = dr
     else:       return dr
+
+
+def _to_shm(df:pd.DataFrame) -> Tuple['shared_memory.SharedMemory',Dict[str,Any]]:
+    r'''
+    Copies the numerical columns of a DataFrame into a new shared-memory segment. Returns the segment, and the meta data required to rebuild the DataFrame,
+    which also holds any non-numerical columns
+    '''
+
+    num = [c for c in df.columns if isinstance(df[c].dtype, np.dtype) and df[c].dtype.kind in 'biuf']
+    offsets = np.cumsum([0]+[df[c].values.nbytes for c in num])
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(offsets[-1])))
+    for c, o in zip(num, offsets):
+        np.ndarray(len(df), dtype=df[c].dtype, buffer=shm.buf, offset=o)[:] = df[c].values
+    meta = {'name': shm.name, 'n': len(df), 'index': df.index, 'columns': list(df.columns),
+            'num': [(c, df[c].dtype.str, int(o)) for c, o in zip(num, offsets)], 'other': {c: df[c].values for c in df.columns if c not in num}}
+    return shm, meta
+
+
+def _from_shm(meta:Dict[str,Any], shm:Optional['shared_memory.SharedMemory']=None) -> pd.DataFrame:
+    r'''
+    Rebuilds a DataFrame from a shared-memory segment, copying the data such that the segment can be freed
+    '''
+
+    if shm is None: shm = shared_memory.SharedMemory(name=meta['name'])
+    data = {c: np.ndarray(meta['n'], dtype=d, buffer=shm.buf, offset=o).copy() for c, d, o in meta['num']}
+    shm.close()
+    data.update(meta['other'])
+    return pd.DataFrame(data, index=meta['index'], columns=meta['columns'])
+
+
+def _apply_steps(df:pd.DataFrame, steps:List[Union[Callable,Tuple[Callable,Dict[str,Any]]]]) -> pd.DataFrame:
+    for step in steps:
+        f,kwargs = step if isinstance(step, tuple) else (step, {})
+        out = f(df=df, **kwargs)
+        if isinstance(out, pd.DataFrame): df = out
+    return df
+
+
+def _proc_chunk(chunk:Union[pd.DataFrame,Dict[str,Any]], steps:List[Union[Callable,Tuple[Callable,Dict[str,Any]]]]) -> Union[pd.DataFrame,Dict[str,Any]]:
+    r'''
+    Worker function: processes a chunk, passed either directly or as shared-memory meta data, and returns the result in the same way
+    '''
+
+    if isinstance(chunk, pd.DataFrame): return _apply_steps(chunk, steps)
+    shm,meta = _to_shm(_apply_steps(_from_shm(chunk), steps))
+    shm.close()  # Segment persists until freed by the main process
+    return meta
+
+
+def parallel_proc(data:Union[pd.DataFrame,Iterable[pd.DataFrame]], steps:List[Union[Callable,Tuple[Callable,Dict[str,Any]]]], n_workers:Optional[int]=None,
+                  chunk_size:int=100000, use_shm:bool=True) -> Union[pd.DataFrame,Iterator[pd.DataFrame]]:
+    r'''
+    Applies a sequence of processing steps, e.g. :meth:`~lumin.data_processing.hep_proc.proc_event` and other functions of this module, to chunks of data in
+    parallel, using a pool of processes. Chunks are returned in their original order, and every chunk must result in the same columns, in the same order.
+    Only a bounded number of chunks are processed at a time, such that streams of data need not fit in memory.
+    Numerical columns are passed to and from the workers via shared memory, rather than being pickled. Other columns, e.g. strings, are pickled.
+
+    Each step is either a function, or a tuple of a function and a dictionary of keyword arguments, and is called as `func(df=chunk, **kwargs)`.
+    Steps may either modify the chunk in place, as do the functions of this module, or return a new DataFrame, which replaces the chunk for later steps.
+    Steps and their arguments must be picklable, e.g. functions defined at the top level of a module, or `functools.partial` of such functions.
+
+    Arguments:
+        data: either a DataFrame, which is split into chunks of `chunk_size` rows, or an iterable of DataFrames, e.g. `pd.read_csv(..., chunksize=...)`
+        steps: list of steps to apply, in order, to each chunk
+        n_workers: number of processes to use, by default the number of CPUs. If 1, chunks are processed in the current process.
+        chunk_size: number of rows per chunk, if `data` is a DataFrame
+        use_shm: whether to pass data via shared memory. Requires Python 3.8 or later, and a POSIX system, otherwise data are pickled.
+
+    Returns:
+        If `data` is a DataFrame, a new DataFrame with the processed data, leaving `data` unchanged, otherwise a generator yielding the processed chunks
+
+    Examples::
+        >>> steps = [(proc_event, {'fix_phi': True, 'fix_y': True, 'fix_z': True, 'use_cartesian': True, 'ref_vec_0': 'l', 'ref_vec_1': 't'}),
+        ...          (add_mass, {'vec': 'h_tt'})]
+        >>> df = parallel_proc(df, steps, n_workers=8)
+        >>>
+        >>> chunks2foldfile(parallel_proc(pd.read_csv('train.csv', chunksize=100000), steps), n_folds=10, ...)
+    '''
+
+    if isinstance(data, pd.DataFrame):
+        if len(data) == 0: return _apply_steps(data.copy(), steps)  # No chunks to concatenate, but columns must still be added
+        return pd.concat(list(parallel_proc((data.iloc[i:i+chunk_size] for i in range(0, len(data), chunk_size)), steps, n_workers=n_workers,
+                                            use_shm=use_shm)))
+    return _parallel_proc(data, steps, n_workers=n_workers, use_shm=use_shm)
+
+
+def _parallel_proc(chunks:Iterable[pd.DataFrame], steps:List[Union[Callable,Tuple[Callable,Dict[str,Any]]]], n_workers:Optional[int]=None,
+                   use_shm:bool=True) -> Iterator[pd.DataFrame]:
+    columns = None
+
+    def _check(df:pd.DataFrame) -> pd.DataFrame:
+        nonlocal columns
+        if columns is None: columns = list(df.columns)
+        elif list(df.columns) != columns: raise ValueError(f"Processing of chunks resulted in different columns: {list(df.columns)} and {columns}")
+        return df
+
+    if n_workers is None: n_workers = mp.cpu_count()
+    if n_workers == 1:
+        for c in chunks: yield _check(_apply_steps(c.copy(), steps))
+        return
+    use_shm = use_shm and shared_memory is not None and os.name == 'posix'
+    if use_shm:  # Workers must share the resource tracker of the main process, which then frees segments once they are unlinked by either process
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+    pending = deque()  # Pairs of input segments and results, in order of submission
+
+    def _collect(shm:Optional['shared_memory.SharedMemory'], res:'mp.pool.AsyncResult') -> pd.DataFrame:
+        try:
+            out = res.get()
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        if not use_shm: return out
+        out_shm = shared_memory.SharedMemory(name=out['name'])
+        try:
+            return _from_shm(out, out_shm)
+        finally:
+            out_shm.unlink()
+
+    with mp.Pool(n_workers) as pool:
+        try:
+            for c in chunks:
+                shm,c = _to_shm(c) if use_shm else (None,c)
+                pending.append((shm, pool.apply_async(_proc_chunk, (c, steps))))
+                if len(pending) >= 2*n_workers: yield _check(_collect(*pending.popleft()))
+            while len(pending) > 0: yield _check(_collect(*pending.popleft()))
+        finally:  # Free the segments of any chunks still being processed, e.g. after an error
+            while len(pending) > 0:
+                try:
+                    _collect(*pending.popleft())
+                except Exception:
+                    pass
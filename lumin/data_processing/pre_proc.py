@@ -1,17 +1,22 @@
+import numpy as np
 import pandas as pd
-from typing import List, Optional, Tuple, Union
+from typing import List, Optional, Tuple, Union, Iterable, Iterator, TYPE_CHECKING
 import pickle
 from collections import OrderedDict
 
-from sklearn.preprocessing import StandardScaler
+from sklearn.preprocessing import StandardScaler, RobustScaler
 from sklearn.pipeline import Pipeline
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 
-__all__ = ['get_pre_proc_pipes', 'fit_input_pipe', 'fit_output_pipe', 'proc_cats']
+if TYPE_CHECKING: from ..nn.data.fold_yielder import FoldYielder  # Avoid importing torch when only processing data
+
+__all__ = ['get_pre_proc_pipes', 'fit_input_pipe', 'fit_output_pipe', 'QuantileSketch', 'fit_input_pipe_streaming', 'fit_output_pipe_streaming',
+           'CatEncoder', 'proc_cats']
 
 
 def get_pre_proc_pipes(norm_in:bool=True, norm_out:bool=False, pca:bool=False, whiten:bool=False,
-                       with_mean:bool=True, with_std:bool=True, n_components:Optional[int]=None) -> Tuple[Pipeline,Pipeline]:
+                       with_mean:bool=True, with_std:bool=True, n_components:Optional[int]=None,
+                       robust:bool=False, quantile_range:Tuple[float,float]=(25.,75.)) -> Tuple[Pipeline,Pipeline]:
     r'''
     Configure SKLearn Pipelines for processing inputs and targets with the requested transformations.
 
@@ -23,22 +28,29 @@ def get_pre_proc_pipes(norm_in:bool=True, norm_out:bool=False, pca:bool=False, w
         with_mean: whether StandardScalers should shift means to 0
         with_std: whether StandardScalers should scale standard deviations to 1
         n_components: if set, causes PCA to reduce the dimensionality of the input data
+        robust: whether to use RobustScalers in place of StandardScalers, shifting medians to 0 and scaling interquantile ranges to 1.
+            `with_mean` and `with_std` then control the centring and scaling
+        quantile_range: percentiles defining the interquantile range used by RobustScalers
 
     Returns:
         Pipeline for input data
         Pipeline for target data
     '''
 
+    def _scaler() -> Union[StandardScaler,RobustScaler]:
+        if robust: return RobustScaler(with_centering=with_mean, with_scaling=with_std, quantile_range=quantile_range)
+        return StandardScaler(with_mean=with_mean, with_std=with_std)
+
     steps_in = []
     if not norm_in and not pca:
         steps_in.append(('ident', StandardScaler(with_mean=False, with_std=False)))  # For compatability
     else:
         if pca: steps_in.append(('pca', PCA(n_components=n_components, whiten=whiten)))
-        if norm_in: steps_in.append(('norm_in', StandardScaler(with_mean=with_mean, with_std=with_std)))
+        if norm_in: steps_in.append(('norm_in', _scaler()))
     input_pipe = Pipeline(steps=steps_in)
 
     steps_out = []
-    if norm_out: steps_out.append(('norm_out', StandardScaler(with_mean=with_mean, with_std=with_std)))
+    if norm_out: steps_out.append(('norm_out', _scaler()))
     else:        steps_out.append(('ident', StandardScaler(with_mean=False, with_std=False)))  # For compatability
     output_pipe = Pipeline(steps=steps_out)
     return input_pipe, output_pipe
@@ -98,42 +110,407 @@ def fit_output_pipe(df:pd.DataFrame, targ_feats:Union[str,List[str]], savename:O
     return output_pipe
 
 
+class QuantileSketch:
+    r'''
+    Mergeable, approximate quantile sketch for streaming data, computing quantiles of every column of the data independently.
+    Data are kept in a hierarchy of compactors, in which rows at level h carry a weight of 2^h: once a level holds `2*k` values, its columns are sorted and
+    every other value, starting from a random offset, is promoted to the next level. Memory therefore grows only logarithmically with the number of rows,
+    and the error on the rank of returned quantiles is of order 1/k. Until `2*k` rows have been seen, quantiles are exact. NaNs are ignored.
+
+    Arguments:
+        k: compactor size, trading memory for precision
+        seed: optional seed for the sketch's own random number generator, used to draw compaction offsets. The global Numpy random state is not used
+
+    Examples::
+        >>> sketch = QuantileSketch()
+        >>> for chunk in chunks: sketch.update(chunk[feats].values)
+        >>> median = sketch.quantile(0.5)
+    '''
+
+    def __init__(self, k:int=2048, seed:Optional[int]=None):
+        self.k,self.n,self.levels = k,0,[]
+        self.rng = np.random.RandomState(seed)
+
+    def __repr__(self) -> str: return f'QuantileSketch of {self.n} rows, with {len(self.levels)} levels of size {self.k}'
+
+    def _compress(self) -> None:
+        h = 0
+        while h < len(self.levels):  # Compacting a level can fill the next one, including newly added levels
+            if len(self.levels[h]) >= 2*self.k:
+                lvl = np.sort(self.levels[h], axis=0)  # NaNs are sorted to the end, and so keep their fraction of the weight
+                m = len(lvl) - len(lvl) % 2
+                promote = lvl[self.rng.randint(2):m:2]
+                self.levels[h] = lvl[m:]
+                if h+1 == len(self.levels): self.levels.append(promote)
+                else:                       self.levels[h+1] = np.concatenate((self.levels[h+1], promote))
+            h += 1
+
+    def update(self, x:np.ndarray) -> None:
+        r'''
+        Adds data to the sketch
+
+        Arguments:
+            x: array of data with rows as entries and columns as features
+        '''
+
+        x = np.asarray(x, dtype=np.float64)
+        if x.ndim == 1: x = x[:,None]
+        if len(self.levels) > 0 and x.shape[1] != self.levels[0].shape[1]:
+            raise ValueError(f"Sketch is of {self.levels[0].shape[1]} columns, but data has {x.shape[1]} columns")
+        self.n += len(x)
+        self.levels = [x] if len(self.levels) == 0 else [np.concatenate((self.levels[0], x))]+self.levels[1:]
+        self._compress()
+
+    def merge(self, other:'QuantileSketch') -> None:
+        r'''
+        Merges another sketch into this one, e.g. a sketch computed on a different subset of the data
+
+        Arguments:
+            other: sketch to merge into this one
+        '''
+
+        if len(other.levels) == 0: return
+        if len(self.levels) > 0 and other.levels[0].shape[1] != self.levels[0].shape[1]:
+            raise ValueError(f"Sketch is of {self.levels[0].shape[1]} columns, but other sketch is of {other.levels[0].shape[1]} columns")
+        self.n += other.n
+        for h, lvl in enumerate(other.levels):
+            if h < len(self.levels): self.levels[h] = np.concatenate((self.levels[h], lvl))
+            else:                    self.levels.append(lvl)
+        self._compress()
+
+    def quantile(self, q:Union[float,List[float],np.ndarray]) -> np.ndarray:
+        r'''
+        Computes approximate quantiles of each column, interpolating linearly between values
+
+        Arguments:
+            q: (list of) quantile(s) in [0,1]
+
+        Returns:
+            Array of quantiles with shape (n_quantiles, n_columns), or (n_columns,) if `q` is a float
+        '''
+
+        if len(self.levels) == 0: raise ValueError("Sketch contains no data")
+        qs = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        vals = np.concatenate(self.levels)
+        wgts = np.concatenate([np.full(len(l), 2.**h) for h, l in enumerate(self.levels)])
+        out = np.full((len(qs), vals.shape[1]), np.nan)
+        for i in range(vals.shape[1]):
+            m = ~np.isnan(vals[:,i])
+            if not m.any(): continue
+            order = np.argsort(vals[m,i])
+            v,w = vals[m,i][order],wgts[m][order]
+            cdf = np.cumsum(w)-w  # Weight below each value, reducing to Numpy's linear interpolation for unit weights
+            out[:,i] = np.interp(qs, cdf/cdf[-1], v) if cdf[-1] > 0 else v[0]
+        return out[0] if np.ndim(q) == 0 else out
+
+
+def _is_fy(data:Union['FoldYielder',Iterable[Union[pd.DataFrame,np.ndarray]]]) -> bool: return hasattr(data, 'get_column')
+
+
+def _rechunk(chunks:Iterable[np.ndarray], chunk_size:int) -> Iterator[np.ndarray]:
+    r'''
+    Concatenates arrays into chunks of at least `chunk_size` rows, merging any remainder into the final chunk
+    '''
+
+    buf,n,pending = [],0,None
+    for c in chunks:
+        if len(c) == 0: continue
+        buf.append(c)
+        n += len(c)
+        if n >= chunk_size:
+            if pending is not None: yield pending
+            pending,buf,n = np.concatenate(buf),[],0
+    if len(buf) > 0: pending = np.concatenate(buf if pending is None else [pending]+buf)
+    if pending is not None: yield pending
+
+
+def _iter_chunks(data:Union['FoldYielder',Iterable[Union[pd.DataFrame,np.ndarray]]], feats:Optional[Union[str,List[str]]], column:str,
+                 chunk_size:int, fold_idxs:Optional[List[int]]) -> Iterator[np.ndarray]:
+    r'''
+    Yields chunks of data from either a :class:`~lumin.nn.data.fold_yielder.FoldYielder` or an iterable of DataFrames or arrays
+    '''
+
+    if isinstance(feats, str): feats = [feats]
+    if _is_fy(data):
+        all_feats = data.input_feats if column == 'inputs' else data.targ_feats
+        if feats is None and column == 'inputs': feats = data.cont_feats
+        cols = None if feats is None or feats == all_feats else [all_feats.index(f) for f in feats]
+        for i in (range(len(data)) if fold_idxs is None else fold_idxs):
+            for start in range(0, data.n_rows(i), chunk_size):
+                yield data.get_column(column, fold_idx=i, add_newaxis=True, rows=slice(start, start+chunk_size), cols=cols).astype('float32')
+    else:
+        for chunk in data:
+            if isinstance(chunk, pd.DataFrame):
+                if feats is None: raise ValueError("Features must be specified when fitting to DataFrames")
+                chunk = chunk[feats].values
+            chunk = np.asarray(chunk, dtype='float32')
+            yield chunk[:,None] if chunk.ndim == 1 else chunk
+
+
+def _fit_robust_scaler(scaler:RobustScaler, chunks:Iterable[np.ndarray], sketch_size:int, seed:Optional[int]) -> None:
+    r'''
+    Fits a RobustScaler from approximate quantiles of the data
+    '''
+
+    sketch = QuantileSketch(sketch_size, seed=seed)
+    for c in chunks: sketch.update(c)
+    lo,med,hi = sketch.quantile([scaler.quantile_range[0]/100, 0.5, scaler.quantile_range[1]/100])
+    scaler.center_ = med if scaler.with_centering else None
+    if scaler.with_scaling:
+        scale = hi-lo
+        scale[scale == 0] = 1
+        if getattr(scaler, 'unit_variance', False):
+            from scipy.stats import norm
+            scale = scale/(norm.ppf(scaler.quantile_range[1]/100)-norm.ppf(scaler.quantile_range[0]/100))
+        scaler.scale_ = scale
+    else:
+        scaler.scale_ = None
+    scaler.n_features_in_ = len(med)
+
+
+def _fit_pipe_streaming(pipe:Pipeline, data:Union['FoldYielder',Iterable[Union[pd.DataFrame,np.ndarray]]], feats:Optional[Union[str,List[str]]],
+                        column:str, chunk_size:int, sketch_size:int, fold_idxs:Optional[List[int]], seed:Optional[int]) -> Pipeline:
+    r'''
+    Fits the steps of a Pipeline in turn, each with one pass over the data, passing the data through the previously fitted steps
+    '''
+
+    for i, (name, step) in enumerate(pipe.steps):  # PCA requires all the data at once, but IncrementalPCA computes the same transformation
+        if type(step) is PCA: pipe.steps[i] = (name, IncrementalPCA(n_components=step.n_components, whiten=step.whiten))
+    steps = [s for _, s in pipe.steps if s is not None and s != 'passthrough']
+    for s in steps:
+        if not isinstance(s, RobustScaler) and not hasattr(s, 'partial_fit'):
+            raise ValueError(f"{type(s).__name__} cannot be fitted incrementally, only steps with a partial_fit method, or RobustScalers, are supported")
+    if len(steps) > 1 and not _is_fy(data) and iter(data) is data:
+        raise ValueError(f"Pipeline requires {len(steps)} passes over the data, but data is a single-pass iterator. Please pass a reusable iterable.")
+
+    for i, step in enumerate(steps):
+        chunks = _rechunk(_iter_chunks(data, feats, column, chunk_size, fold_idxs), chunk_size)
+        if i > 0: chunks = (Pipeline([(str(j), s) for j, s in enumerate(steps[:i])]).transform(c) for c in chunks)
+        if isinstance(step, RobustScaler):
+            _fit_robust_scaler(step, chunks, sketch_size, seed=seed)
+        else:
+            for c in chunks: step.partial_fit(c)
+    return pipe
+
+
+def fit_input_pipe_streaming(data:Union['FoldYielder',Iterable[Union[pd.DataFrame,np.ndarray]]], cont_feats:Optional[Union[str,List[str]]]=None,
+                             savename:Optional[str]=None, input_pipe:Optional[Pipeline]=None,
+                             norm_in:bool=True, pca:bool=False, whiten:bool=False, with_mean:bool=True, with_std:bool=True,
+                             n_components:Optional[int]=None, robust:bool=False, quantile_range:Tuple[float,float]=(25.,75.),
+                             chunk_size:int=100000, sketch_size:int=2048, fold_idxs:Optional[List[int]]=None,
+                             seed:Optional[int]=0) -> Pipeline:
+    r'''
+    Fit input pipeline to continuous features, reading the data in chunks, and optionally save. Allows pipelines to be fitted to data too large to fit in
+    memory, e.g. the data of a :class:`~lumin.nn.data.fold_yielder.FoldYielder` or chunks of DataFrames read from disc.
+    Steps are fitted one after the other, each with one pass over the data: StandardScalers are fitted by merging running moments, PCA is replaced by
+    IncrementalPCA, and RobustScalers are fitted to approximate quantiles computed via a :class:`~lumin.data_processing.pre_proc.QuantileSketch`.
+    Other steps must provide a `partial_fit` method. The fitted Pipeline can be used as normal, e.g. via
+    :meth:`~lumin.nn.data.fold_yielder.FoldYielder.add_input_pipe`.
+
+    Arguments:
+        data: either a :class:`~lumin.nn.data.fold_yielder.FoldYielder`, whose (unprocessed) inputs will be read fold by fold, or an iterable of DataFrames
+            or arrays. Pipelines requiring several passes over the data cannot be fitted to single-pass iterators, such as generators.
+        cont_feats: (list of) column(s) to use as input data for fitting. For FoldYielders, defaults to the continuous features of the foldfile,
+            for arrays, all columns are used.
+        savename: if set will save the fitted Pipeline to with that name as Pickle (.pkl extension added automatically)
+        input_pipe: if set will fit, otherwise will instantiate a new Pipeline
+        norm_in: whether to apply StandardScaler to inputs. Only used if input_pipe is not set.
+        pca: whether to apply PCA to inputs. Perforemed prior to StandardScaler.
+             No dimensionality reduction is applied, purely rotation. Only used if input_pipe is not set.
+        whiten: whether PCA should whiten inputs. Only used if input_pipe is not set.
+        with_mean: whether StandardScalers should shift means to 0. Only used if input_pipe is not set.
+        with_std: whether StandardScalers should scale standard deviations to 1. Only used if input_pipe is not set.
+        n_components: if set, causes PCA to reduce the dimensionality of the input data. Only used if input_pipe is not set.
+        robust: whether to use a RobustScaler in place of the StandardScaler. Only used if input_pipe is not set.
+        quantile_range: percentiles defining the interquantile range used by the RobustScaler. Only used if input_pipe is not set.
+        chunk_size: minimum number of rows per chunk of data used to update the steps.
+            Must be at least the number of components if PCA is used.
+        sketch_size: compactor size of the quantile sketches used to fit RobustScalers
+        fold_idxs: if data is a :class:`~lumin.nn.data.fold_yielder.FoldYielder`, optional list of indeces of the folds to use, by default all folds
+        seed: seed for the random number generators of the quantile sketches, such that fitting does not depend on, or change, the global random state
+
+    Returns:
+        Fitted Pipeline
+
+    Examples::
+        >>> input_pipe = fit_input_pipe_streaming(train_fy, savename=PATH/'input_pipe')
+        >>>
+        >>> input_pipe = fit_input_pipe_streaming(train_fy, robust=True, fold_idxs=range(5))
+        >>>
+        >>> chunks = [pd.read_csv(f) for f in files]
+        >>> input_pipe = fit_input_pipe_streaming(chunks, cont_feats, pca=True)
+    '''
+
+    if input_pipe is None: input_pipe, _ = get_pre_proc_pipes(norm_in=norm_in, pca=pca, whiten=whiten, with_mean=with_mean, with_std=with_std,
+                                                              n_components=n_components, robust=robust, quantile_range=quantile_range)
+    _fit_pipe_streaming(input_pipe, data, cont_feats, 'inputs', chunk_size=chunk_size, sketch_size=sketch_size, fold_idxs=fold_idxs, seed=seed)
+    if savename is not None:
+        with open(f'{savename}.pkl', 'wb') as fout: pickle.dump(input_pipe, fout)
+    return input_pipe
+
+
+def fit_output_pipe_streaming(data:Union['FoldYielder',Iterable[Union[pd.DataFrame,np.ndarray]]], targ_feats:Optional[Union[str,List[str]]]=None,
+                              savename:Optional[str]=None, output_pipe:Optional[Pipeline]=None, norm_out:bool=True, robust:bool=False,
+                              quantile_range:Tuple[float,float]=(25.,75.), chunk_size:int=100000, sketch_size:int=2048,
+                              fold_idxs:Optional[List[int]]=None, seed:Optional[int]=0) -> Pipeline:
+    r'''
+    Fit output pipeline to target features, reading the data in chunks, and optionally save.
+    See :meth:`~lumin.data_processing.pre_proc.fit_input_pipe_streaming` for details.
+
+    Arguments:
+        data: either a :class:`~lumin.nn.data.fold_yielder.FoldYielder`, whose (unprocessed) targets will be read fold by fold, or an iterable of
+            DataFrames or arrays. Pipelines requiring several passes over the data cannot be fitted to single-pass iterators, such as generators.
+        targ_feats: (list of) column(s) to use as target data for fitting. For FoldYielders and arrays, defaults to all targets.
+        savename: if set will save the fitted Pipeline to with that name as Pickle (.pkl extension added automatically)
+        output_pipe: if set will fit, otherwise will instantiate a new Pipeline
+        norm_out: whether to apply StandardScaler to outputs. Only used if output_pipe is not set.
+        robust: whether to use a RobustScaler in place of the StandardScaler. Only used if output_pipe is not set.
+        quantile_range: percentiles defining the interquantile range used by the RobustScaler. Only used if output_pipe is not set.
+        chunk_size: minimum number of rows per chunk of data used to update the steps
+        sketch_size: compactor size of the quantile sketches used to fit RobustScalers
+        fold_idxs: if data is a :class:`~lumin.nn.data.fold_yielder.FoldYielder`, optional list of indeces of the folds to use, by default all folds
+        seed: seed for the random number generators of the quantile sketches, such that fitting does not depend on, or change, the global random state
+
+    Returns:
+        Fitted Pipeline
+    '''
+
+    if output_pipe is None: _, output_pipe = get_pre_proc_pipes(norm_out=norm_out, robust=robust, quantile_range=quantile_range)
+    _fit_pipe_streaming(output_pipe, data, targ_feats, 'targets', chunk_size=chunk_size, sketch_size=sketch_size, fold_idxs=fold_idxs, seed=seed)
+    if savename is not None:
+        with open(f'{savename}.pkl', 'wb') as fout: pickle.dump(output_pipe, fout)
+    return output_pipe
+
+
+class CatEncoder:
+    r'''
+    Encodes categorical features as codes valued 0->cardinality-1, in order of the sorted categories.
+    Categories are found, and data encoded, with a single, hash-based pass over each column via `pd.Categorical`, rather than one pass per category.
+    Categories can be accumulated over several chunks of data via :meth:`~lumin.data_processing.pre_proc.CatEncoder.partial_fit`, and the fitted encoder
+    can be passed to :meth:`~lumin.data_processing.file_proc.df2foldfile` or :meth:`~lumin.data_processing.file_proc.chunks2foldfile` to encode data as it
+    is saved.
+    Categories not seen during fitting, including NaNs, either cause an error or are assigned a reserved code.
+
+    Arguments:
+        cat_feats: list of columns to encode as categorical features
+        unseen_code: if set, code assigned to categories not seen during fitting, e.g. -1 or the number of categories.
+            Cardinalities returned by :meth:`~lumin.data_processing.pre_proc.CatEncoder.get_cat_szs` are increased to include non-negative reserved codes,
+            and are saved in the meta data of foldfiles written with the encoder, such that :meth:`~lumin.nn.models.helpers.CatEmbedder.from_fy` sizes
+            embeddings to include the reserved code. Otherwise, embeddings must be sized explicitly from
+            :meth:`~lumin.data_processing.pre_proc.CatEncoder.get_cat_szs`.
+            If not set, unseen categories raise a ValueError
+
+    Examples::
+        >>> enc = CatEncoder(cat_feats).fit(train_df)
+        >>> enc.transform(train_df)
+        >>> enc.transform(test_df)
+        >>>
+        >>> enc = CatEncoder(cat_feats, unseen_code=-1)
+        >>> for chunk in pd.read_csv('train.csv', chunksize=1000000, usecols=cat_feats): enc.partial_fit(chunk)
+        >>> chunks2foldfile(pd.read_csv('train.csv', chunksize=1000000), n_folds=10, cont_feats=cont_feats, cat_feats=cat_feats,
+        ...                 targ_feats='gen_target', savename='train', targ_type='int', cat_encoder=enc)
+    '''
+
+    def __init__(self, cat_feats:List[str], unseen_code:Optional[int]=None):
+        self.cat_feats,self.unseen_code = cat_feats,unseen_code
+        self.categories:OrderedDict = OrderedDict()
+
+    def __repr__(self) -> str: return f'CatEncoder for {self.cat_feats}, with cardinalities {list(self.get_cat_szs().values())}'
+
+    def partial_fit(self, df:pd.DataFrame) -> 'CatEncoder':
+        r'''
+        Adds the categories present in the data to those already known
+
+        Arguments:
+            df: DataFrame containing the categorical features
+
+        Returns:
+            self
+        '''
+
+        for f in self.cat_feats:
+            cats = pd.Categorical(df[f]).categories  # Sorted, excluding NaNs
+            self.categories[f] = cats if f not in self.categories else self.categories[f].union(cats)
+        return self
+
+    def fit(self, df:pd.DataFrame) -> 'CatEncoder':
+        r'''
+        Sets the categories of each feature to those present in the data
+
+        Arguments:
+            df: DataFrame containing the categorical features
+
+        Returns:
+            self
+        '''
+
+        self.categories = OrderedDict()
+        return self.partial_fit(df)
+
+    def transform(self, df:pd.DataFrame, inplace:bool=True) -> pd.DataFrame:
+        r'''
+        Replaces categorical features with their codes
+
+        Arguments:
+            df: DataFrame containing the categorical features
+            inplace: whether to modify `df`, or to return a new DataFrame, sharing the data of the other columns
+
+        Returns:
+            DataFrame with encoded features
+        '''
+
+        if not inplace: df = df.copy(deep=False)
+        for f in self.cat_feats:
+            codes = pd.Categorical(df[f], categories=self.categories[f]).codes.astype(np.int64)
+            unseen = codes < 0
+            if unseen.any():
+                if self.unseen_code is None:
+                    raise ValueError(f"Feature {f} declared categorical, but data contains categories not seen during fitting: "
+                                     f"{list(pd.unique(df[f].values[unseen])[:10])}")
+                codes[unseen] = self.unseen_code
+            df[f] = codes
+        return df
+
+    def get_cat_maps(self) -> OrderedDict:
+        r'''
+        Returns:
+            ordered dictionary mapping categorical features to dictionaries mapping codes to categories
+        '''
+
+        return OrderedDict((f, dict(enumerate(c.tolist()))) for f, c in self.categories.items())
+
+    def get_cat_szs(self) -> OrderedDict:
+        r'''
+        Returns:
+            ordered dictionary mapping categorical features to their cardinalities, including the reserved code for unseen categories, if non-negative
+        '''
+
+        n_extra = 0 if self.unseen_code is None else self.unseen_code+1
+        return OrderedDict((f, max(len(c), n_extra)) for f, c in self.categories.items())
+
+
 def proc_cats(train_df:pd.DataFrame, cat_feats:List[str],
-              val_df:Optional[pd.DataFrame]=None, test_df:Optional[pd.DataFrame]=None) -> Tuple[OrderedDict,OrderedDict]:
+              val_df:Optional[pd.DataFrame]=None, test_df:Optional[pd.DataFrame]=None, unseen_code:Optional[int]=None) -> Tuple[OrderedDict,OrderedDict]:
     r'''
     Process categorical features in train_df to be valued 0->cardinality-1. Applied inplace.
     Applies same transformation to validation and testing data is passed.
-    Will complain if validation or testing sets contain categories which are not present in the training data.
-    
+    Will complain if validation or testing sets contain categories which are not present in the training data, unless `unseen_code` is set.
+    See :class:`~lumin.data_processing.pre_proc.CatEncoder` for encoding data in chunks.
+
     Arguments:
         train_df: DataFrame with the training data, which will also be used to specify all the categories to consider
         cat_feats: list of columns to use as categorical features
         val_df: if set will apply the same category to code mapping to the validation data as was performed on the training data
         test_df: if set will apply the same category to code mapping to the testing data as was performed on the training data
-    
+        unseen_code: if set, code assigned to categories in the validation and testing data which are not present in the training data.
+            Embeddings must then be sized from the returned cardinalities, which include non-negative reserved codes
+
     Returns:
         ordered dictionary mapping categorical features to dictionaries mapping categories to codes
         ordered dictionary mapping categorical features to their cardinalities
     '''
 
-    # TODO: check how this handles non-numerical categories
-
-    cat_maps = OrderedDict()
-    cat_szs = OrderedDict()
-    for feat in cat_feats:
-        cat_maps[feat] = {}
-        vals = sorted(set(train_df[feat]))
-        cat_szs[feat] = len(vals)
-        if val_df is not None:
-            if sorted(set(val_df[feat])) != vals:
-                raise Exception(f"Feature {feat} declared categorical, but validation set contains categories different to the training set")
-        if test_df is not None:
-            if sorted(set(val_df[feat])) != vals:
-                raise Exception(f"Feature {feat} declared categorical, but testing set contains categories different to the training set")
-        
-        for i, val in enumerate(vals):
-            train_df.loc[train_df[feat] == val, feat] = i
-            if val_df is not None: val_df.loc[val_df[feat] == val, feat] = i
-            if test_df is not None: test_df.loc[test_df[feat] == val, feat] = i
-            cat_maps[feat][i] = val
-    return cat_maps, cat_szs
+    enc = CatEncoder(cat_feats, unseen_code=unseen_code).fit(train_df)
+    for df in [train_df, val_df, test_df]:
+        if df is not None: enc.transform(df)
+    return enc.get_cat_maps(), enc.get_cat_szs()
@@ -7,6 +7,7 @@ from torch import Tensor
 
 from .callback import Callback
 from ..data.batch_yielder import BatchYielder
+from ..data.samplers import BootstrapSampler
 from ..data.fold_yielder import FoldYielder
 from ...utils.misc import to_np, to_device
 from ..models.abs_model import AbsModel
@@ -77,9 +78,9 @@ class SequentialReweight(Callback):
         preds = self.model.predict_array(fld['inputs'], as_np=False, bs=bs)
         coefs = to_np(self.reweight_func(preds, to_device(Tensor(fld['targets']))))
         weight = np.sum(fld['weights'])
-        fld['weights'] += self.scale*coefs*fld['weights']
-        fld['weights'] *= weight/np.sum(fld['weights'])
-        fy.foldfile[f'fold_{fold_id}/weights'][...] = fld['weights'].squeeze()
+        weights = fld['weights']+(self.scale*coefs*fld['weights'])
+        weights *= weight/np.sum(weights)
+        fy.save_fold_column(weights.squeeze(), fold_id, 'weights')
     
     def on_train_end(self, fy:FoldYielder, val_id:int, bs:Optional[int]=None, **kargs) -> None:
         r'''
@@ -114,16 +115,19 @@ class SequentialReweightClasses(SequentialReweight):
         fld = fy.get_fold(fold_id)
         preds = self.model.predict_array(fld['inputs'], as_np=False)
         coefs = to_np(self.reweight_func(preds, to_device(Tensor(fld['targets']))))
+        weights = fld['weights'].copy()
         for c in set(fld['targets'].squeeze()):
-            weight = np.sum(fld['weights'][fld['targets'] == c])
-            fld['weights'][fld['targets'] == c] += self.scale*(coefs*fld['weights'])[fld['targets'] == c]
-            fld['weights'][fld['targets'] == c] *= weight/np.sum(fld['weights'][fld['targets'] == c])
-        fy.foldfile[f'fold_{fold_id}/weights'][...] = fld['weights'].squeeze()
+            weight = np.sum(weights[fld['targets'] == c])
+            weights[fld['targets'] == c] += self.scale*(coefs*fld['weights'])[fld['targets'] == c]
+            weights[fld['targets'] == c] *= weight/np.sum(weights[fld['targets'] == c])
+        fy.save_fold_column(weights.squeeze(), fold_id, 'weights')
 
 
 class BootstrapResample(Callback):
     r'''
     Callback for bootstrap sampling new training datasets from original training data during (ensemble) training.
+    For :class:`~lumin.nn.data.batch_yielder.BatchYielder` s, the sample is applied via a :class:`~lumin.nn.data.samplers.BootstrapSampler`, such that
+    minibatches are gathered directly from the original data, rather than from resampled copies.
 
     Arguments:
         n_folds: the number of folds present in training :class:`~lumin.nn.data.fold_yielder.FoldYielder`
@@ -142,7 +146,7 @@ class BootstrapResample(Callback):
     def _get_sample(self, length:int) -> np.ndarray: return np.random.choice(range(length), length, replace=True)
     
     def _resample(self, sample:np.ndarray, inputs:Union[np.ndarray,Tensor], targets:Union[np.ndarray,Tensor],
-                  weights:Union[np.ndarray,Tensor,None]) -> None:
+                  weights:Union[np.ndarray,Tensor,None]) -> Tuple[Union[np.ndarray,Tensor],Union[np.ndarray,Tensor],Union[np.ndarray,Tensor,None]]:
 
         pkg = np if isinstance(weights, np.ndarray) else torch 
         # Get weight sums before resampling
@@ -153,17 +157,18 @@ class BootstrapResample(Callback):
             else:
                 weight_sum = pkg.sum(weights)
                     
-        # Resample
-        inputs[...] = inputs[sample]
-        targets[...] = targets[sample]
+        # Resample, into new arrays since the originals may be read-only, e.g. if cached by the FoldYielder
+        inputs = inputs[sample]
+        targets = targets[sample]
         if weights is not None:
-            weights[...] = weights[sample]
+            weights = weights[sample]
         
             # Reweight
             if self.reweight:
                 if 'class' in self.objective:
                     for c in weight_sum: weights[targets.squeeze() == c] *= weight_sum[c]/pkg.sum(weights[targets.squeeze() == c])
                 else: weights *= weight_sum/pkg.sum(weights)
+        return inputs, targets, weights
         
     def on_train_begin(self, **kargs) -> None:
         r'''
@@ -188,7 +193,8 @@ class BootstrapResample(Callback):
             sample = self.samples[self.iter % self.n_trn_flds]
         self.iter += 1
         if self.objective is None: self.objective = by.objective
-        self._resample(sample, by.inputs, by.targets, by.weights)
+        if isinstance(by, BatchYielder): by.sampler = BootstrapSampler(reweight=self.reweight, idxs=sample)
+        else:                            by.inputs,by.targets,by.weights = self._resample(sample, by.inputs, by.targets, by.weights)
 
 
 class FeatureSubsample(Callback):
@@ -1,11 +1,17 @@
 import numpy as np
-from typing import List, Optional, Union, Tuple
+from typing import List, Optional, Union, Tuple, Iterator, Callable
+from threading import Thread, Event
+from queue import Queue, Empty, Full
+import warnings
 
-from ...utils.misc import to_device
+from .fold_yielder import FoldYielder
+from .samplers import AbsIdxSampler
+from ...utils.misc import to_device, device
 
+import torch
 from torch.tensor import Tensor
 
-__all__ = ['BatchYielder']
+__all__ = ['BatchYielder', 'StreamingBatchYielder']
 
 
 '''
@@ -14,6 +20,18 @@ Todo
 '''
 
 
+def _augment_batch(x:Union[Tensor,Tuple[Tensor,Tensor]], y:Tensor, aug_fn:Optional[Callable[[Tensor,Optional[Tensor]],Tuple[Tensor,Optional[Tensor]]]],
+                   mask:Optional[Tensor]) -> Tuple[Union[Tensor,Tuple[Tensor,Tensor]],Tensor]:
+    r'''
+    Applies a minibatch augmentation to the flat inputs and targets, followed by an input mask. Matrix inputs are passed through unchanged.
+    '''
+
+    x,m = x if isinstance(x, tuple) else (x,None)
+    if aug_fn is not None: x,y = aug_fn(x, y)
+    if mask is not None: x = x[:,mask]
+    return (x if m is None else (x,m)), y
+
+
 class BatchYielder:
     r'''
     Yields minibatches to model during training. Iteration provides one minibatch as tuple of tensors of inputs, targets, and weights.
@@ -27,14 +45,42 @@ class BatchYielder:
         shuffle: whether to shuffle the data at the beginning of an iteration
         use_weights: if passed weights, whether to actually pass them to the model
         bulk_move: whether to move all data to device at once. Default is true (saves time), but if device has low memory you can set to False.
+        n_prefetch: if not `bulk_move`, the number of minibatches to gather ahead of the current one on a background thread. When training on CUDA, minibatches
+            are gathered into reused, pinned staging buffers and transferred to the device asynchronously. Set to zero to gather each minibatch synchronously.
+        aug_fn: optional function applying train-time augmentation to each minibatch of inputs (excluding matrix inputs) and targets once on device, e.g. from
+            :meth:`~lumin.nn.data.fold_yielder.HEPAugFoldYielder.get_batch_aug`
+        sampler: optional index sampler from :mod:`~lumin.nn.data.samplers`, selecting the rows to yield in each iteration, e.g. weight-proportional,
+            class-balanced, or bootstrap sampling. Minibatches are gathered by index, so no resampled copies of the data are made.
+            By default, all rows are yielded once per iteration.
     '''
 
     def __init__(self, inputs:Union[np.ndarray,Tuple[np.ndarray,np.ndarray]], targets:np.ndarray, bs:int, objective:str,
-                 weights:Optional[np.ndarray]=None, shuffle:bool=True, use_weights:bool=True, bulk_move:bool=True):
+                 weights:Optional[np.ndarray]=None, shuffle:bool=True, use_weights:bool=True, bulk_move:bool=True, n_prefetch:int=2,
+                 aug_fn:Optional[Callable[[Tensor,Optional[Tensor]],Tuple[Tensor,Optional[Tensor]]]]=None, sampler:Optional[AbsIdxSampler]=None):
         self.inputs,self.targets,self.weights,self.bs,self.objective,self.shuffle,self.use_weights,self.bulk_move,self.matrix_inputs = \
             inputs,targets,weights,bs,objective,shuffle,use_weights,bulk_move,None
+        self.n_prefetch,self.aug_fn,self.input_mask,self.sampler = n_prefetch,aug_fn,None,sampler
         if isinstance(self.inputs, tuple): self.inputs,self.matrix_inputs = self.inputs
 
+    def set_input_mask(self, mask:np.ndarray) -> None:
+        r'''
+        Only yield the selected input features. If augmenting minibatches, the mask is applied on device after augmentation,
+        otherwise the inputs are sliced immediately.
+
+        Arguments:
+            mask: array of indeces, or boolean array, selecting features
+        '''
+
+        if self.aug_fn is None: self.inputs = self.inputs[:,mask]
+        else:                   self.input_mask = torch.as_tensor(mask, device=device)
+
+    def _augment(self, x:Union[Tensor,Tuple[Tensor,Tensor]], y:Tensor) -> Tuple[Union[Tensor,Tuple[Tensor,Tensor]],Tensor]:
+        r'''
+        Applies `aug_fn`, if set, and then the input mask, if set, to a minibatch on device
+        '''
+
+        return _augment_batch(x, y, self.aug_fn, self.input_mask)
+
     def __iter__(self) -> List[Tensor]:
         r'''
         Iterate through data in batches.
@@ -43,23 +89,30 @@ class BatchYielder:
             tuple of batches of inputs, targets, and weights as tensors on device
         '''
 
-        full_idxs = np.arange(len(self.inputs))
-        if self.shuffle: np.random.shuffle(full_idxs)
+        if self.sampler is None:
+            full_idxs,weights = np.arange(len(self.inputs)),self.weights
+            if self.shuffle: np.random.shuffle(full_idxs)
+        else:
+            full_idxs,weights = self.sampler.sample(self.targets, self.weights, self.objective, self.shuffle)
+        if not self.use_weights: weights = None
 
         if self.bulk_move:
             inputs = to_device(Tensor(self.inputs))
             if 'multiclass' in self.objective: targets = to_device(Tensor(self.targets).long().squeeze())
             else:                              targets = to_device(Tensor(self.targets))
-            if self.weights is not None and self.use_weights: weights = to_device(Tensor(self.weights))
-            else:                                             weights = None
-            if self.matrix_inputs is not None: matrix_inputs = to_device(Tensor(self.matrix_inputs))
+            if weights is not None: weights = to_device(Tensor(weights))
+            if self.matrix_inputs is not None: matrix_inputs = to_device(Tensor(np.asarray(self.matrix_inputs)))
             else:                                              matrix_inputs = None
 
             for i in range(0, len(full_idxs)-self.bs+1, self.bs):
                 idxs = full_idxs[i:i+self.bs]
                 x = inputs[idxs] if matrix_inputs is None else (inputs[idxs],matrix_inputs[idxs])
                 w = None if weights is None else weights[idxs]
-                yield x, targets[idxs], w              
+                if self.aug_fn is None: yield x, targets[idxs], w
+                else:                   yield (*self._augment(x, targets[idxs]), w)
+
+        elif self.n_prefetch > 0:
+            yield from self._pipeline(full_idxs, weights)
 
         else:
             for i in range(0, len(full_idxs)-self.bs+1, self.bs):
@@ -68,15 +121,208 @@ class BatchYielder:
                 else:                              y = to_device(Tensor(self.targets[idxs]))
                 if self.matrix_inputs is None: x =  to_device(Tensor(self.inputs[idxs]))
                 else:                          x = (to_device(Tensor(self.inputs[idxs])),to_device(Tensor(self.matrix_inputs[idxs])))
-                w = to_device(Tensor(self.weights[idxs])) if self.weights is not None and self.use_weights else None
-                yield x, y, w
+                w = to_device(Tensor(weights[idxs])) if weights is not None else None
+                if self.aug_fn is None: yield x, y, w
+                else:                   yield (*self._augment(x, y), w)
+
+    @staticmethod
+    def _gather(arr:np.ndarray, idxs:np.ndarray, out:np.ndarray) -> None:
+        if isinstance(arr, np.ndarray) and arr.dtype == out.dtype: np.take(arr, idxs, axis=0, out=out, mode='clip')  # Indeces are known to be valid, so no need for buffering
+        else:                      out[...] = arr[idxs]
+
+    def _pipeline(self, full_idxs:np.ndarray, weights:Optional[np.ndarray]) -> Iterator[Tuple[Union[Tensor,Tuple[Tensor,Tensor]],Tensor,Optional[Tensor]]]:
+        r'''
+        Gathers minibatches on a background thread, up to `n_prefetch` ahead of the current one. On CUDA, data are gathered into a pool of pinned buffers,
+        which are reused once their transfer to the device has completed. On CPU, each minibatch is gathered into new tensors, since these are yielded
+        directly.
+        '''
+
+        arrs = [self.inputs, self.matrix_inputs, self.targets, weights]
+        starts = range(0, len(full_idxs)-self.bs+1, self.bs)
+        pinned = device.type == 'cuda'
+        free,ready,stop = Queue(),Queue(maxsize=self.n_prefetch),Event()
+
+        def _new_bufs() -> List[Optional[Tensor]]:
+            bufs = [None if a is None else torch.empty((self.bs,*a.shape[1:]), dtype=torch.float32) for a in arrs]
+            return [b.pin_memory() for b in bufs] if pinned else bufs
+
+        def _get(q:Queue) -> Optional[object]:
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except Empty:
+                    continue
+            return None
 
-    def __len__(self): return len(self.inputs)//self.bs
+        def _put(q:Queue, item:object) -> bool:
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def _worker() -> None:
+            try:
+                for i in starts:
+                    bufs = _get(free) if pinned else _new_bufs()
+                    if bufs is None: return
+                    idxs = full_idxs[i:i+self.bs]
+                    for a, b in zip(arrs, bufs):
+                        if a is not None: self._gather(a, idxs, b.numpy())
+                    if not _put(ready, bufs): return
+            except Exception as e:
+                _put(ready, e)
+
+        if pinned:
+            for _ in range(self.n_prefetch+2): free.put(_new_bufs())  # Worker fills one whilst up to n_prefetch wait and two are in use
+        thread,prev = Thread(target=_worker, daemon=True),None
+        thread.start()
+        try:
+            for _ in starts:
+                bufs = None
+                while bufs is None:
+                    try:
+                        bufs = ready.get(timeout=0.1)
+                    except Empty:
+                        if not thread.is_alive() and ready.empty(): raise RuntimeError("Minibatch worker stopped unexpectedly")
+                if isinstance(bufs, Exception): raise bufs
+                x,m,y,w = [None if b is None else b.to(device, non_blocking=True) for b in bufs]
+                if pinned:  # Return buffers of the previous minibatch to the pool, once their transfer has completed
+                    event = torch.cuda.Event()
+                    event.record()
+                    if prev is not None:
+                        prev[1].synchronize()
+                        free.put(prev[0])
+                    prev = (bufs, event)
+                if 'multiclass' in self.objective: y = y.long().squeeze()
+                x = x if m is None else (x,m)
+                if self.aug_fn is None: yield x, y, w
+                else:                   yield (*self._augment(x, y), w)
+        finally:
+            stop.set()
+            thread.join()
+
+    def __len__(self): return (len(self.inputs) if self.sampler is None else self.sampler.n_samples(len(self.inputs)))//self.bs
 
     def get_inputs(self, on_device:bool=False) -> Union[Tensor, Tuple[Tensor,Tensor]]:
         if on_device:
             if self.matrix_inputs is None: return to_device(Tensor(self.inputs))
-            else:                          return (to_device(Tensor(self.inputs)), to_device(Tensor(self.matrix_inputs)))
+            else:                          return (to_device(Tensor(self.inputs)), to_device(Tensor(np.asarray(self.matrix_inputs))))
         else:
             if self.matrix_inputs is None: return self.inputs
             else:                          return (self.inputs, self.matrix_inputs)
+
+
+class StreamingBatchYielder:
+    r'''
+    Yields minibatches to model during training, reading data for a single fold directly from a :class:`~lumin.nn.data.fold_yielder.FoldYielder` in slices
+    of rows, rather than requiring the whole fold to be loaded into memory. Iteration provides one minibatch as tuple of tensors of inputs, targets, and weights.
+    Data are shuffled in two stages: the order in which slices are read is shuffled, and the rows of each fill of a shuffle buffer are then shuffled. Peak memory
+    is therefore set by `buffer_size`, rather than the size of the fold. Larger buffers give a more thorough shuffle.
+
+    Ignored features are accounted for. Callbacks which modify the in-memory data of a :class:`~lumin.nn.data.batch_yielder.BatchYielder`, e.g.
+    :class:`~lumin.nn.callbacks.data_callbacks.BootstrapResample`, are not supported, and are rejected by
+    :meth:`~lumin.nn.training.fold_train.fold_train_ensemble`. Train-time augmentation is only applied to minibatches on device.
+
+    Arguments:
+        fy: :class:`~lumin.nn.data.fold_yielder.FoldYielder` providing the data
+        fold_idx: index of fold to yield
+        bs: batchsize, number of data to include per minibatch
+        objective: 'classification', 'multiclass classification', or 'regression'. Used for casting target dtype.
+        buffer_size: number of rows to read before shuffling and yielding minibatches
+        chunk_size: number of rows to read from the foldfile at once. By default, the chunk length of the inputs, if they are chunked, otherwise
+            1/32 of `buffer_size`
+        shuffle: whether to shuffle the data
+        use_weights: if weights are present, whether to actually pass them to the model
+        aug_fn: optional function applying train-time augmentation to each minibatch on device. By default, taken from the
+            :class:`~lumin.nn.data.fold_yielder.FoldYielder` via :meth:`~lumin.nn.data.fold_yielder.FoldYielder.get_batch_aug`
+
+    Examples::
+        >>> by = StreamingBatchYielder(fy, 0, bs=256, objective='classification', buffer_size=1000000)
+        >>> model.fit(by, callbacks)
+    '''
+
+    def __init__(self, fy:FoldYielder, fold_idx:int, bs:int, objective:str, buffer_size:int=100000, chunk_size:Optional[int]=None,
+                 shuffle:bool=True, use_weights:bool=True, aug_fn:Optional[Callable[[Tensor,Optional[Tensor]],Tuple[Tensor,Optional[Tensor]]]]=None):
+        self.fy,self.fold_idx,self.bs,self.objective,self.buffer_size,self.shuffle,self.use_weights = \
+            fy,fold_idx,bs,objective,buffer_size,shuffle,use_weights
+        self.aug_fn,self.input_mask = fy.get_batch_aug() if aug_fn is None else aug_fn,None
+        self.n,self.mask = fy.n_rows(fold_idx),None
+        if chunk_size is None:
+            chunks = fy.fold_index[fold_idx]['columns']['inputs']['chunks']
+            chunk_size = chunks[0] if chunks is not None else max(1, buffer_size//32)
+        self.chunk_size = chunk_size
+        self.has_weights = 'weights' in fy.fold_index[fold_idx]['columns']
+        self.has_matrix = fy.has_matrix and fy.yield_matrix
+        if fy.augmented and fy.train_time_aug and self.aug_fn is None:
+            warnings.warn("StreamingBatchYielder only applies train-time augmentation to minibatches on device, e.g. via HEPAugFoldYielder(device_aug=True)")
+
+    def __len__(self): return self.n//self.bs
+
+    def set_input_mask(self, mask:np.ndarray) -> None:
+        r'''
+        Only read the selected input features. If augmenting minibatches, all features are read and the mask is applied on device after augmentation.
+
+        Arguments:
+            mask: array of indeces, or boolean array, selecting features
+        '''
+
+        if self.aug_fn is not None:
+            self.input_mask = torch.as_tensor(mask, device=device)
+            return
+        idxs = np.arange(len(self.fy.cont_feats+self.fy.cat_feats)) if self.mask is None else self.mask
+        self.mask = idxs[mask]
+
+    def _read(self, rows:slice) -> List[Optional[np.ndarray]]:
+        fy,idx = self.fy,self.fold_idx
+        return [fy.get_inputs(idx, rows=rows, mask=self.mask),
+                np.asarray(fy.get_matrix_inputs(idx, rows=rows)) if self.has_matrix else None,
+                fy.get_column('targets', fold_idx=idx, rows=rows, add_newaxis=True),
+                fy.get_column('weights', fold_idx=idx, rows=rows, add_newaxis=True) if self.has_weights and self.use_weights else None]
+
+    def _to_device(self, arrs:List[Optional[np.ndarray]]) -> Tuple[Union[Tensor,Tuple[Tensor,Tensor]],Tensor,Optional[Tensor]]:
+        x,m,y,w = [None if a is None else to_device(Tensor(a)) for a in arrs]
+        if 'multiclass' in self.objective: y = y.long().squeeze()
+        x = x if m is None else (x,m)
+        if self.aug_fn is None: return x, y, w
+        return (*_augment_batch(x, y, self.aug_fn, self.input_mask), w)
+
+    def __iter__(self) -> Iterator[Tuple[Union[Tensor,Tuple[Tensor,Tensor]],Tensor,Optional[Tensor]]]:
+        r'''
+        Iterate through data in batches.
+
+        Returns:
+            tuple of batches of inputs, targets, and weights as tensors on device
+        '''
+
+        starts = np.arange(0, self.n, self.chunk_size)
+        if self.shuffle: np.random.shuffle(starts)
+        buf,n_buf = [],0
+        for i, start in enumerate(starts):
+            buf.append(self._read(slice(start, min(start+self.chunk_size, self.n))))
+            n_buf += len(buf[-1][2])
+            if n_buf < max(self.buffer_size, self.bs) and i < len(starts)-1: continue
+            arrs = [None if a[0] is None else np.concatenate(a) for a in zip(*buf)]
+            if self.shuffle:
+                perm = np.random.permutation(n_buf)
+                arrs = [None if a is None else np.take(a, perm, axis=0) for a in arrs]
+            n_use = (n_buf//self.bs)*self.bs
+            for j in range(0, n_use, self.bs): yield self._to_device([None if a is None else a[j:j+self.bs] for a in arrs])
+            buf,n_buf = [[None if a is None else a[n_use:].copy() for a in arrs]],n_buf-n_use  # Carry remainder into next fill
+
+    def get_inputs(self, on_device:bool=False) -> Union[np.ndarray,Tensor,Tuple[np.ndarray,np.ndarray],Tuple[Tensor,Tensor]]:
+        r'''
+        Returns inputs for the first `buffer_size` rows of the fold, e.g. for data-driven initialisation
+
+        Arguments:
+            on_device: whether to return the inputs as tensors on device
+
+        Returns:
+            inputs, and matrix inputs if present
+        '''
+
+        x,m,_,_ = self._read(slice(0, min(self.buffer_size, self.n)))
+        if on_device: x,m = to_device(Tensor(x)),None if m is None else to_device(Tensor(m))
+        return x if m is None else (x,m)
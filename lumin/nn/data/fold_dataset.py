@@ -0,0 +1,219 @@
+import numpy as np
+from typing import List, Optional, Union, Tuple, Iterator, Dict, Any
+
+import torch
+from torch.tensor import Tensor
+from torch.utils.data import Dataset, Sampler, DataLoader, get_worker_info
+
+from .fold_yielder import FoldYielder
+from .batch_yielder import _augment_batch
+from ...utils.misc import device
+
+__all__ = ['FoldDataset', 'FoldBatchSampler', 'FoldDataLoader']
+
+
+class FoldDataset(Dataset):
+    r'''
+    `torch.utils.data.Dataset` providing blocks of minibatches from a :class:`~lumin.nn.data.fold_yielder.FoldYielder`.
+    Items are indexed by tuples of fold index, and first and last row of a block, as provided by :class:`~lumin.nn.data.fold_dataset.FoldBatchSampler`.
+    Each block is read from the foldfile in a single slice via :meth:`~lumin.nn.data.fold_yielder.FoldYielder.get_fold`, such that ignored features,
+    matrix inputs, and train-time augmentation (e.g. by a :class:`~lumin.nn.data.fold_yielder.HEPAugFoldYielder`) are accounted for.
+    The rows of the block are optionally shuffled and then split into full minibatches.
+    When used in worker processes, each worker reopens the foldfile to obtain its own file handles.
+
+    Arguments:
+        fy: :class:`~lumin.nn.data.fold_yielder.FoldYielder` providing the data
+        bs: batchsize, number of data to include per minibatch
+        shuffle: whether to shuffle the rows within each block
+        use_weights: if weights are present, whether to actually return them
+
+    Examples::
+        >>> ds = FoldDataset(fy, bs=256)
+        >>> x, m, y, w = ds[(0, 0, 4096)]
+    '''
+
+    def __init__(self, fy:FoldYielder, bs:int, shuffle:bool=True, use_weights:bool=True):
+        self.fy,self.bs,self.shuffle,self.use_weights = fy,bs,shuffle,use_weights
+
+    @staticmethod
+    def _to_tensor(arr:Optional[np.ndarray], bs:int) -> Optional[Tensor]:
+        if arr is None: return None
+        return torch.as_tensor(arr[:bs*(len(arr)//bs)], dtype=torch.float32).reshape(-1, bs, *arr.shape[1:])  # Incomplete minibatches are dropped
+
+    def __getitem__(self, item:Tuple[int,int,int]) -> Tuple[Optional[Tensor],Optional[Tensor],Optional[Tensor],Optional[Tensor]]:
+        r'''
+        Load a block of rows
+
+        Arguments:
+            item: tuple of fold index, and first and last row (exclusive) of the block
+
+        Returns:
+            tuple of inputs, matrix inputs, targets, and weights as tensors, each with shape (number of minibatches, batchsize, ...)
+        '''
+
+        fold_idx,start,stop = item
+        data = self.fy.get_fold(fold_idx, rows=slice(start, stop))
+        x,m = data['inputs'] if isinstance(data['inputs'], tuple) else (data['inputs'],None)
+        arrs = [x, m, data['targets'], data['weights'] if self.use_weights else None]
+        if self.shuffle:
+            perm = np.random.permutation(len(x))
+            arrs = [None if a is None else a[perm] for a in arrs]
+        return tuple(self._to_tensor(a, self.bs) for a in arrs)
+
+    @staticmethod
+    def worker_init_fn(worker_id:int) -> None:
+        r'''
+        Gives each worker its own file handles, and a different random seed for shuffling and augmentation
+        '''
+
+        info = get_worker_info()
+        info.dataset.fy.reopen(read_only=True)
+        np.random.seed(info.seed % 2**32)
+
+
+class FoldBatchSampler(Sampler):
+    r'''
+    `torch.utils.data.Sampler` which splits folds of a :class:`~lumin.nn.data.fold_yielder.FoldYielder` into contiguous blocks of whole minibatches, to be
+    loaded by a :class:`~lumin.nn.data.fold_dataset.FoldDataset`. Block order is shuffled over all requested folds.
+    The folds to sample can be changed between iterations, via :meth:`~lumin.nn.data.fold_dataset.FoldBatchSampler.set_folds`, without recreating any
+    worker processes.
+
+    Arguments:
+        fy: :class:`~lumin.nn.data.fold_yielder.FoldYielder` providing the data
+        fold_idxs: indeces of folds to sample
+        bs: batchsize, number of data to include per minibatch
+        batches_per_block: number of minibatches to read per block. Larger blocks are read more efficiently and shuffled more thoroughly, but use more memory
+        shuffle: whether to shuffle the order of the blocks
+    '''
+
+    def __init__(self, fy:FoldYielder, fold_idxs:List[int], bs:int, batches_per_block:int=32, shuffle:bool=True):
+        self.fy,self.bs,self.batches_per_block,self.shuffle = fy,bs,batches_per_block,shuffle
+        self.set_folds(fold_idxs)
+
+    def set_folds(self, fold_idxs:List[int]) -> None:
+        r'''
+        Set the folds to sample on the next iteration
+
+        Arguments:
+            fold_idxs: indeces of folds to sample
+        '''
+
+        block = self.bs*self.batches_per_block
+        self.fold_idxs,self.blocks = fold_idxs,[]
+        for f in fold_idxs:
+            n = self.fy.n_rows(f)
+            self.blocks += [(f, s, min(s+block, n)) for s in range(0, n, block)]
+
+    def __len__(self) -> int: return len(self.blocks)
+
+    def n_batches(self) -> int:
+        r'''
+        Returns the number of full minibatches provided by the blocks
+        '''
+
+        return sum((stop-start)//self.bs for _, start, stop in self.blocks)
+
+    def __iter__(self) -> Iterator[Tuple[int,int,int]]:
+        idxs = np.random.permutation(len(self.blocks)) if self.shuffle else range(len(self.blocks))
+        for i in idxs: yield self.blocks[i]
+
+
+class FoldDataLoader:
+    r'''
+    Drop-in replacement for a :class:`~lumin.nn.data.batch_yielder.BatchYielder`, which loads and prepares minibatches from a
+    :class:`~lumin.nn.data.fold_yielder.FoldYielder` in parallel worker processes, via a `torch.utils.data.DataLoader`.
+    Iteration provides one minibatch as tuple of tensors of inputs, targets, and weights, on device.
+    Data are read in blocks of whole minibatches, rather than by row. Train-time augmentation, e.g. by a
+    :class:`~lumin.nn.data.fold_yielder.HEPAugFoldYielder`, takes place in the worker processes, unless it is to be applied to minibatches on device
+    (`device_aug`), in which case it is applied in the main process after transfer.
+    With persistent workers, a single FoldDataLoader may be reused for several (sub-)epochs, changing the folds via
+    :meth:`~lumin.nn.data.fold_dataset.FoldDataLoader.set_folds`.
+
+    .. Note:: Workers open the foldfile in read-only mode, and changes to the foldfile during training (e.g. by
+        :class:`~lumin.nn.callbacks.data_callbacks.SequentialReweight`) may not be seen by persistent workers. Callbacks which modify the in-memory data
+        of a :class:`~lumin.nn.data.batch_yielder.BatchYielder`, e.g. :class:`~lumin.nn.callbacks.data_callbacks.BootstrapResample`, are not supported, and
+        are rejected by :meth:`~lumin.nn.training.fold_train.fold_train_ensemble`.
+        Persistent workers are shut down by :meth:`~lumin.nn.data.fold_dataset.FoldDataLoader.close`.
+
+    Arguments:
+        fy: :class:`~lumin.nn.data.fold_yielder.FoldYielder` providing the data
+        fold_idxs: indeces of folds to yield
+        bs: batchsize, number of data to include per minibatch
+        objective: 'classification', 'multiclass classification', or 'regression'. Used for casting target dtype.
+        shuffle: whether to shuffle the data
+        use_weights: if weights are present, whether to actually pass them to the model
+        num_workers: number of worker processes. If zero, data are loaded in the main process
+        persistent_workers: whether to keep the worker processes alive between iterations
+        pin_memory: whether to load data into pinned memory, allowing asynchronous transfer to the device. By default, true if training on CUDA
+        batches_per_block: number of minibatches to read per block
+        prefetch_factor: number of blocks loaded in advance by each worker
+
+    Examples::
+        >>> by = FoldDataLoader(fy, [1, 2, 3], bs=256, objective='classification', num_workers=4)
+        >>> model.fit(by, callbacks)
+        >>> by.set_folds([4])
+        >>> model.fit(by, callbacks)
+        >>> by.close()
+    '''
+
+    def __init__(self, fy:FoldYielder, fold_idxs:List[int], bs:int, objective:str, shuffle:bool=True, use_weights:bool=True,
+                 num_workers:int=0, persistent_workers:bool=True, pin_memory:Optional[bool]=None, batches_per_block:int=32, prefetch_factor:int=2):
+        self.fy,self.bs,self.objective,self.input_mask = fy,bs,objective,None
+        self.aug_fn = fy.get_batch_aug()
+        self.pin_memory = device.type == 'cuda' if pin_memory is None else pin_memory
+        self.sampler = FoldBatchSampler(fy, fold_idxs, bs=bs, batches_per_block=batches_per_block, shuffle=shuffle)
+        kargs:Dict[str,Any] = {}
+        if num_workers > 0: kargs = {'persistent_workers': persistent_workers, 'prefetch_factor': prefetch_factor, 'worker_init_fn': FoldDataset.worker_init_fn}
+        self.loader = DataLoader(FoldDataset(fy, bs=bs, shuffle=shuffle, use_weights=use_weights), sampler=self.sampler, batch_size=None,
+                                 num_workers=num_workers, pin_memory=self.pin_memory, **kargs)
+
+    def __len__(self) -> int: return self.sampler.n_batches()
+
+    def __enter__(self) -> 'FoldDataLoader': return self
+
+    def __exit__(self, *args) -> None: self.close()
+
+    def close(self) -> None:
+        r'''
+        Shuts down the worker processes, if running. Iterating again afterwards starts new workers.
+        '''
+
+        it,self.loader._iterator = getattr(self.loader, '_iterator', None),None
+        if it is not None and hasattr(it, '_shutdown_workers'): it._shutdown_workers()
+
+    def set_folds(self, fold_idxs:List[int]) -> None:
+        r'''
+        Set the folds to yield on the next iteration
+
+        Arguments:
+            fold_idxs: indeces of folds to yield
+        '''
+
+        self.sampler.set_folds(fold_idxs)
+
+    def set_input_mask(self, mask:np.ndarray) -> None:
+        r'''
+        Only yield the selected input features
+
+        Arguments:
+            mask: array of indeces, or boolean array, selecting features
+        '''
+
+        self.input_mask = torch.as_tensor(mask, device=device)
+
+    def __iter__(self) -> Iterator[Tuple[Union[Tensor,Tuple[Tensor,Tensor]],Tensor,Optional[Tensor]]]:
+        r'''
+        Iterate through data in batches.
+
+        Returns:
+            tuple of batches of inputs, targets, and weights as tensors on device
+        '''
+
+        for block in self.loader:
+            x,m,y,w = [None if t is None else t.to(device, non_blocking=self.pin_memory) for t in block]
+            if self.aug_fn is None and self.input_mask is not None: x = x[:,:,self.input_mask]
+            if 'multiclass' in self.objective: y = y.long()
+            for i in range(len(y)):
+                xi,yi = (x[i] if m is None else (x[i],m[i])),(y[i].squeeze() if 'multiclass' in self.objective else y[i])
+                if self.aug_fn is not None: xi,yi = _augment_batch(xi, yi, self.aug_fn, self.input_mask)
+                yield xi, yi, None if w is None else w[i]
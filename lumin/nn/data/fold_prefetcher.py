@@ -0,0 +1,130 @@
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+from threading import Thread, Event
+from queue import Queue, Empty, Full
+import numpy as np
+
+from .fold_yielder import FoldYielder
+
+__all__ = ['FoldPrefetcher']
+
+
+class _Stop:
+    r'''
+    Sentinel placed in the queue once all requested folds have been loaded
+    '''
+
+    pass
+
+
+class FoldPrefetcher:
+    r'''
+    Loads folds from a :class:`~lumin.nn.data.fold_yielder.FoldYielder` on a background thread, so that the next fold(s) are read from disk and cleaned whilst
+    the current one is being used, e.g. for training or inference. Iteration provides tuples of the fold index and the loaded data, in the same order as
+    `fold_idxs`.
+    The number of folds held in memory ahead of the current one is bounded by `n_prefetch`; setting `n_prefetch` to zero disables the background thread and
+    loads each fold synchronously on request.
+
+    .. Note:: The background thread shares the HDF5 file handle of the :class:`~lumin.nn.data.fold_yielder.FoldYielder`. h5py serialises access to the file,
+        so reading and writing from the main thread remains safe, however changes made to folds which have already been prefetched will not be reflected in
+        the data yielded for them.
+
+    Arguments:
+        fy: :class:`~lumin.nn.data.fold_yielder.FoldYielder` providing the data
+        fold_idxs: iterable of items to load, by default fold indeces. May contain repeats, e.g. to cover several epochs
+        n_prefetch: number of folds to load ahead of the one currently being used
+        get_func: optional callable to load an item in `fold_idxs`, by default `fy.get_fold`
+
+    Examples::
+        >>> for trn_id, trn_fold in FoldPrefetcher(fy, trn_ids):
+        ...     by = BatchYielder(**trn_fold, objective=objective, bs=bs)
+        >>>
+        >>> with FoldPrefetcher(fy, range(len(fy)), n_prefetch=2) as prefetcher:
+        ...     for fold_idx, fold in prefetcher:
+        ...         pred = model.predict(fold['inputs'])
+        >>>
+        >>> prefetcher = FoldPrefetcher(fy, [(f,a) for f in range(len(fy)) for a in range(fy.aug_mult)],
+        ...                             get_func=lambda x: fy.get_test_fold(*x))
+    '''
+
+    def __init__(self, fy:FoldYielder, fold_idxs:Iterable[Any], n_prefetch:int=1, get_func:Optional[Callable[[Any],Dict[str,np.ndarray]]]=None):
+        if n_prefetch < 0: raise ValueError(f"n_prefetch must be non-negative, but {n_prefetch} was passed")
+        self.fy,self.fold_idxs,self.n_prefetch = fy,fold_idxs,n_prefetch
+        self.get_func = fy.get_fold if get_func is None else get_func
+        self._queue,self._stop,self._thread = None,Event(),None
+
+    def __repr__(self) -> str: return f'FoldPrefetcher loading up to {self.n_prefetch} folds ahead from {self.fy}'
+
+    def __enter__(self) -> 'FoldPrefetcher': return self
+
+    def __exit__(self, *args) -> None: self.close()
+
+    def __del__(self) -> None: self.close()
+
+    def _put(self, item:Any) -> bool:
+        r'''
+        Blocking put which periodically checks whether the prefetcher has been closed
+
+        Returns:
+            Whether the item was placed in the queue
+        '''
+
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _worker(self) -> None:
+        try:
+            for idx in self.fold_idxs:
+                if self._stop.is_set(): return
+                if not self._put((idx, self.get_func(idx))): return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(_Stop())
+
+    def _start(self) -> None:
+        self.close()
+        self._stop.clear()
+        self._queue = Queue(maxsize=self.n_prefetch)
+        self._thread = Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def __iter__(self) -> Iterator[Tuple[Any,Dict[str,np.ndarray]]]:
+        if self.n_prefetch == 0:
+            for idx in self.fold_idxs: yield idx, self.get_func(idx)
+            return
+
+        self._start()
+        queue,thread = self._queue,self._thread
+        try:
+            while True:
+                try:
+                    item = queue.get(timeout=0.1)
+                except Empty:
+                    if not thread.is_alive() and queue.empty(): return  # Worker was closed
+                    continue
+                if isinstance(item, _Stop): return
+                if isinstance(item, Exception): raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        r'''
+        Stops the background thread, if running, and discards any prefetched folds
+        '''
+
+        thread = getattr(self, '_thread', None)
+        if thread is None: return
+        self._stop.set()
+        while thread.is_alive():
+            try:
+                while True: self._queue.get_nowait()  # Unblock the worker
+            except Empty:
+                pass
+            thread.join(timeout=0.1)
+        self._thread,self._queue = None,None
@@ -1,16 +1,103 @@
 import numpy as np
 import pandas as pd
 import h5py
-from typing import Dict, Optional, Union, List
+from typing import Dict, Optional, Union, List, Tuple, Any, Callable, Iterator, TYPE_CHECKING
 import pickle
 import warnings
 from pathlib import Path
 from collections import OrderedDict
+from threading import Lock
 import json
+import os
+from functools import partial
 
 from sklearn.pipeline import Pipeline
 
-__all__ = ['FoldYielder', 'HEPAugFoldYielder']
+if TYPE_CHECKING: from torch import Tensor  # Torch is only imported when augmenting minibatches, so that data can be accessed without it
+
+__all__ = ['FoldYielder', 'HEPAugFoldYielder', 'ShardedFoldYielder', 'RaggedMatrix']
+
+
+class RaggedMatrix:
+    r'''
+    Matrix data in ragged format, as saved by :meth:`~lumin.data_processing.file_proc.df2foldfile` with `ragged=True`: only the features of the objects
+    present in each row are stored, and rows are expanded into padded matrices only when indexed, e.g. when gathering a minibatch.
+    Indexing with an integer, a slice, or an array of row indeces returns a padded Numpy array, and the full padded array is available via `np.asarray`.
+
+    Arguments:
+        values: array of features of each present object, with shape (number of objects, number of features)
+        objects: index of each object within the padded matrix of its row
+        offsets: index in `values` of the first object of each row, followed by the total number of objects
+        shape: shape of the padded matrix of each row
+        row_wise: whether objects are rows of the padded matrices, otherwise columns
+        fill: value for the features of missing objects
+
+    Examples::
+        >>> mat = fy.get_ragged(0)
+        >>> x = mat[idxs]
+        >>> mask = mat.get_mask(idxs)
+    '''
+
+    def __init__(self, values:np.ndarray, objects:np.ndarray, offsets:np.ndarray, shape:Tuple[int,int], row_wise:bool=True, fill:float=0):
+        self.values,self.objects,self.offsets,self.row_wise,self.fill = values,objects,offsets,row_wise,fill
+        self.shape,self.dtype,self.ndim = (len(offsets)-1,*shape),values.dtype,len(shape)+1
+        self.nbytes = values.nbytes+objects.nbytes+offsets.nbytes
+
+    def __repr__(self) -> str: return f'RaggedMatrix with padded shape {self.shape}, containing {len(self.values)} objects'
+
+    def __len__(self) -> int: return self.shape[0]
+
+    def __array__(self, dtype:Optional[np.dtype]=None) -> np.ndarray:
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype, copy=False)
+
+    def _get_rows(self, idxs:Union[int,slice,np.ndarray]) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+        r'''
+        Returns the requested row indeces, and the index in `values` and the row in the output of each of their objects
+        '''
+
+        if isinstance(idxs, slice): idxs = np.arange(*idxs.indices(len(self)))
+        idxs = np.atleast_1d(idxs)
+        idxs = np.where(idxs < 0, idxs+len(self), idxs)
+        counts = self.offsets[idxs+1]-self.offsets[idxs]
+        rows = np.repeat(np.arange(len(idxs)), counts)
+        src = np.arange(counts.sum())+np.repeat(self.offsets[idxs]-np.cumsum(counts)+counts, counts)
+        return idxs, src, rows
+
+    def __getitem__(self, idxs:Union[int,slice,np.ndarray]) -> np.ndarray:
+        scalar = np.isscalar(idxs)
+        idxs,src,rows = self._get_rows(idxs)
+        n_objs,n_feats = self.shape[1:] if self.row_wise else self.shape[:0:-1]
+        out = np.full((len(idxs),n_objs,n_feats), self.fill, dtype=self.dtype)
+        out[rows,self.objects[src]] = self.values[src]
+        if not self.row_wise: out = np.ascontiguousarray(out.transpose(0,2,1))
+        return out[0] if scalar else out
+
+    def get_mask(self, idxs:Union[slice,np.ndarray]=slice(None)) -> np.ndarray:
+        r'''
+        Returns a mask indicating which objects are present in the requested rows, e.g. for heads which mask out missing objects
+
+        Arguments:
+            idxs: slice or array of indeces of rows
+
+        Returns:
+            Boolean array of shape (rows, objects)
+        '''
+
+        idxs,src,rows = self._get_rows(idxs)
+        mask = np.zeros((len(idxs),self.shape[1 if self.row_wise else 2]), dtype=bool)
+        mask[rows,self.objects[src]] = True
+        return mask
+
+    def get_lengths(self) -> np.ndarray:
+        r'''
+        Returns the number of present objects in each row, e.g. for packing sequences
+
+        Returns:
+            Array of number of objects per row
+        '''
+
+        return np.diff(self.offsets)
 
 
 class FoldYielder:
@@ -26,7 +113,31 @@ class FoldYielder:
         output_pipe: optional Pipeline, or filename for pickled Pipeline, which was used for processing the targets
         yield_matrix: whether to actually yield matrix data if present
         matrix_pipe: preprocessing pipe for matrix data
-
+        memmap: if True, uncompressed and contiguous datasets will be accessed as read-only `np.memmap` views of the foldfile, rather than being copied into
+            memory. Repeated reads, and separate processes reading the same foldfile, then share the OS page cache. Data which must be modified on read, e.g.
+            inputs containing NaNs or selections of columns, are still copied.
+        cache_size: if greater than zero, the maximum number of bytes of fold data to keep in memory. Folds returned by
+            :meth:`~lumin.nn.data.fold_yielder.FoldYielder.get_fold` are then cached, and the least-recently used folds are evicted when the budget is
+            exceeded. Cached arrays are read-only, and so must be copied by any code which wishes to modify them in place.
+        read_only: if True, the foldfile will be opened in read-only mode, allowing several processes to read it concurrently.
+            Predictions and other data saved via the FoldYielder will then be written to `pred_file`.
+        swmr: if True, the foldfile will be opened for HDF5 single-writer-multiple-reader access: if `read_only`, as a reader, otherwise as the writer.
+            Writing in SWMR mode requires that the foldfile was created with `swmr=True`, and new datasets cannot be added to the foldfile by the writer,
+            so new columns will instead be written to `pred_file`. Readers refresh datasets before each read, to see changes made by the writer.
+        pred_file: optional filename of a separate HDF5 file in which to save predictions and other data, if they cannot be written to the foldfile.
+            Data in `pred_file` take precedence over data of the same name in the foldfile when read. Each concurrent job should use its own `pred_file`.
+        pad_matrix: if False, and the matrix data were saved in ragged format, folds will contain the matrix inputs as a
+            :class:`~lumin.nn.data.fold_yielder.RaggedMatrix`, which is only expanded into padded matrices when indexed, e.g. per minibatch.
+            Otherwise matrix data are always padded when read.
+
+    If the foldfile was written with `sanitise=True`, its inputs are known to be free of NaNs and infs, and they are not passed through `np.nan_to_num`
+    when read; the `sanitised` attribute indicates whether this is the case.
+
+    The structure of the foldfile (the datasets in each fold, and their shapes, data types, and chunk layouts) is indexed once when the file is opened,
+    and is available via `fold_index`. The number of rows in each fold is then available via `n_rows`, and the total number of rows via `total_rows`.
+
+    Data stored in reduced precision, i.e. float16 or bfloat16 (see :meth:`~lumin.data_processing.file_proc.df2foldfile`), are upcast to float32 as they
+    are read, and the storage types requested when the foldfile was written are available via `storage_dtypes`.
 
     Examples::
         >>> fy = FoldYielder('train.h5')
@@ -36,19 +147,35 @@ class FoldYielder:
         >>> fy = FoldYielder('train.h5', input_pipe=input_pipe, matrix_pipe=matrix_pipe)
         >>>
         >>> fy = FoldYielder('train.h5', input_pipe=input_pipe, yield_matrix=False)
+        >>>
+        >>> fy = FoldYielder('train.h5', memmap=True)
+        >>>
+        >>> fy = FoldYielder('train.h5', cache_size=16*1024**3)
+        >>>
+        >>> fy = FoldYielder('test.h5', read_only=True, pred_file='test_preds_job0.h5')
+        >>>
+        >>> fy = FoldYielder('train_ragged.h5', pad_matrix=False)
     '''
 
     # TODO: Matrix example
 
     def __init__(self, foldfile:Union[str,Path,h5py.File], cont_feats:Optional[List[str]]=None, cat_feats:Optional[List[str]]=None,
                  ignore_feats:Optional[List[str]]=None, input_pipe:Optional[Union[str,Pipeline,Path]]=None, output_pipe:Optional[Union[str,Pipeline,Path]]=None,
-                 yield_matrix:bool=True, matrix_pipe:Optional[Union[str,Pipeline,Path]]=None):
+                 yield_matrix:bool=True, matrix_pipe:Optional[Union[str,Pipeline,Path]]=None, memmap:bool=False, cache_size:int=0,
+                 read_only:bool=False, swmr:bool=False, pred_file:Optional[Union[str,Path]]=None, pad_matrix:bool=True):
         self.cont_feats,self.cat_feats,self.input_pipe,self.output_pipe = cont_feats,cat_feats,input_pipe,output_pipe
-        self.yield_matrix,self.matrix_pipe = yield_matrix,matrix_pipe
-        self.augmented,self.aug_mult,self.train_time_aug,self.test_time_aug = False,0,False,False
+        self.read_only,self.swmr,self.pred_file,self.pad_matrix = read_only,swmr,None,pad_matrix
+        self.yield_matrix,self.matrix_pipe,self.memmap,self._memmaps = yield_matrix,matrix_pipe,memmap,{}
+        self.cache_size,self._cache,self._cache_lock = cache_size,OrderedDict(),Lock()
+        self._cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+        self.augmented,self.aug_mult,self.train_time_aug,self.test_time_aug,self.sanitised = False,0,False,False,False
+        self.storage_dtypes,self.cat_szs = None,None
+        self._inherited = []  # Handles inherited from a parent process, kept alive since closing them could flush the parent's HDF5 state to disk
+        if pred_file is not None: self.pred_file = h5py.File(pred_file, 'a')
+        self._pred_file_name = None if pred_file is None else self.pred_file.filename
         self._set_foldfile(foldfile)
         self.input_feats = self.cont_feats + self.cat_feats
-        self.orig_cont_feats,self.orig_cat_feat,self._ignore_feats = self.cont_feats,self.cat_feats,[]
+        self.orig_cont_feats,self.orig_cat_feat,self._ignore_feats,self._use_cols = self.cont_feats,self.cat_feats,[],None
         if isinstance(self.input_pipe, str) or isinstance(self.input_pipe, Path): self.add_input_pipe_from_file(self.input_pipe)
         if isinstance(self.output_pipe, str) or isinstance(self.input_pipe, Path): self.add_output_pipe_from_file(self.output_pipe)
         if isinstance(self.matrix_pipe, str) or isinstance(self.matrix_pipe, Path): self.add_matrix_pipe_from_file(self.matrix_pipe)
@@ -63,15 +190,160 @@ class FoldYielder:
     def __iter__(self) -> Dict[str,np.ndarray]:
         for i in range(self.n_folds): yield self.get_fold(i)
 
+    def __getstate__(self) -> Dict[str,Any]:
+        state = self.__dict__.copy()
+        for k in ['foldfile', 'pred_file', '_cache', '_cache_lock', '_memmaps', '_datasets', '_inherited']: del state[k]
+        return state
+
+    def __setstate__(self, state:Dict[str,Any]) -> None:
+        self.__dict__.update(state)
+        self._inherited = []
+        self.reopen(read_only=self.read_only)
+
+    def reopen(self, read_only:bool=True) -> None:
+        r'''
+        Reopens the foldfile, and prediction file if set, discarding any existing file handles and cached data.
+        Used to give each worker process its own file handles, since HDF5 handles cannot be shared between processes.
+        FoldYielders are also reopened in this way when unpickled, in their original mode.
+        If the files are locked, e.g. because the original FoldYielder still has them open for writing, they are opened read-only, with file locking
+        disabled if necessary.
+
+        .. Warning:: Changes made to the files by other processes are not guaranteed to be visible, unless the FoldYielder was opened with `swmr=True`
+
+        Arguments:
+            read_only: whether to reopen the files in read-only mode, allowing several processes to read them concurrently
+        '''
+
+        for f in self._get_files():
+            if self._pid != os.getpid(): self._inherited.append(f)
+            else:                        f.close()
+        self.read_only = read_only
+        try:
+            self._reopen_foldfile()
+            self.pred_file = None if self._pred_file_name is None else self._reopen_file(self._pred_file_name, append=True)
+        except OSError:  # Locked for writing, e.g. by the original FoldYielder, so `read_only` is set to indicate that writes are not possible
+            if read_only: raise
+            self.reopen(read_only=True)
+            return
+        self._pid,self._memmaps,self._cache,self._cache_lock = os.getpid(),{},OrderedDict(),Lock()
+        self._cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+        self._build_index()
+
+    @staticmethod
+    def _open_read_only(name:str, swmr:bool=False) -> h5py.File:
+        try:
+            return h5py.File(name, 'r', swmr=swmr)
+        except OSError:
+            return h5py.File(name, 'r', swmr=swmr, locking=False)
+
+    def _reopen_file(self, name:str, append:bool=False) -> h5py.File:
+        r'''
+        Opens a file in the mode of the FoldYielder. Writable prediction files are opened in append mode
+        '''
+
+        if self.read_only: return self._open_read_only(name, swmr=self.swmr)
+        return h5py.File(name, 'a') if append else self._open_foldfile(name)
+
+    def _reopen_foldfile(self) -> None: self.foldfile = self._reopen_file(self._foldfile_name)
+
+    def _get_files(self) -> List[h5py.File]:
+        r'''
+        Returns the open foldfile, and prediction file if set
+        '''
+
+        return [f for f in [self.__dict__.get('foldfile'), self.__dict__.get('pred_file')] if f is not None]
+
+    def _get_file(self, src:Any) -> h5py.File:
+        r'''
+        Returns the file referred to by the source of a fold or column in the index
+        '''
+
+        return getattr(self, src)
+
     def columns(self) -> List[str]:
         r'''
-        Returns list of columns present in foldfile
+        Returns list of columns present in foldfile, and in the prediction file, if set
 
         Returns:
             list of columns present in foldfile
         '''
 
-        return [k for k in self.foldfile["fold_0"].keys()]
+        return list(self.fold_index[0]['columns']) if self.n_folds > 0 else []
+
+    def n_rows(self, fold_idx:int) -> int:
+        r'''
+        Returns the number of rows (data points) in the specified fold
+
+        Arguments:
+            fold_idx: index of fold
+
+        Returns:
+            number of rows in fold
+        '''
+
+        return self._get_fold_info(fold_idx)['n_rows']
+
+    def _get_fold_info(self, fold_idx:int) -> Dict[str,Any]:
+        if fold_idx < 0 or fold_idx >= self.n_folds: raise IndexError(f"Fold {fold_idx} does not exist")
+        return self.fold_index[fold_idx]
+
+    @staticmethod
+    def _get_dtypes(ds:h5py.Dataset) -> Tuple[str,np.dtype]:
+        r'''
+        Returns the type in which a dataset is stored, and the type in which it is read: reduced-precision floats are upcast to float32
+        '''
+
+        storage = ds.attrs.get('dtype', ds.dtype.name)
+        return storage, np.dtype(np.float32) if storage in ['float16', 'bfloat16'] else ds.dtype
+
+    @staticmethod
+    def _get_column_info(obj:Union[h5py.Dataset,h5py.Group], src:str) -> Dict[str,Any]:
+        if isinstance(obj, h5py.Group):
+            if 'offsets' in obj:  # Ragged matrix data
+                storage,dtype = FoldYielder._get_dtypes(obj['values'])
+                return {'file': src, 'path': obj.name, 'group': True, 'n_datasets': len(obj), 'ragged': True, 'shape': (obj['offsets'].shape[0]-1,*obj.attrs['shape']),
+                        'dtype': dtype, 'storage_dtype': storage, 'row_wise': bool(obj.attrs['row_wise'])}
+            return {'file': src, 'path': obj.name, 'group': True, 'n_datasets': len(obj)}
+        storage,dtype = FoldYielder._get_dtypes(obj)
+        return {'file': src, 'path': obj.name, 'group': False, 'shape': obj.shape, 'dtype': dtype, 'storage_dtype': storage, 'chunks': obj.chunks,
+                'compression': obj.compression, 'virtual': obj.is_virtual}
+
+    def _build_index(self) -> None:
+        r'''
+        Indexes the structure of the foldfile, and prediction file, if set, such that data can later be accessed without further metadata lookups
+        '''
+
+        self.fold_index,self._datasets = [],{}
+        for i, (src, path) in enumerate(self._get_fold_sources()):
+            fold,cols = f'fold_{i}',OrderedDict()
+            for k, v in self._get_file(src)[path].items(): cols[k] = self._get_column_info(v, src)
+            if self.pred_file is not None and fold in self.pred_file:
+                for k, v in self.pred_file[fold].items(): cols[k] = self._get_column_info(v, 'pred_file')
+            n_rows = next((cols[c]['shape'][0] for c in ['targets', 'inputs', 'weights', *cols] if c in cols and not cols[c]['group']), 0)
+            self.fold_index.append({'name': fold, 'file': src, 'path': path, 'n_rows': n_rows, 'columns': cols})
+        self.row_offsets = np.cumsum([0]+[f['n_rows'] for f in self.fold_index])
+        self.n_folds,self.total_rows = len(self.fold_index),int(self.row_offsets[-1])
+
+    def _get_fold_sources(self) -> List[Tuple[Any,str]]:
+        r'''
+        Returns the source file and group of each fold
+        '''
+
+        fold_idxs = sorted(int(f[5:]) for f in self.foldfile if f.startswith('fold_'))
+        if fold_idxs != list(range(len(fold_idxs))): raise ValueError(f"Folds in foldfile must be numbered consecutively from zero, but found {fold_idxs}")
+        return [('foldfile', f'fold_{i}') for i in fold_idxs]
+
+    def _get_dataset(self, name:str) -> Union[h5py.Dataset,Dict[str,h5py.Dataset]]:
+        r'''
+        Returns the h5py dataset for the named fold column, or for groups a dictionary of their datasets. Handles are cached to avoid repeated lookups.
+        '''
+
+        if name not in self._datasets:
+            fold,column = name.split('/')
+            info = self.fold_index[int(fold[5:])]['columns'][column]
+            obj = self._get_file(info['file'])[info['path']]
+            self._datasets[name] = {k: v for k, v in obj.items()} if info['group'] else obj
+        return self._datasets[name]
 
     def add_ignore(self, feats:List[str]) -> None:
         r'''
@@ -84,7 +356,19 @@ class FoldYielder:
         self._ignore_feats += feats
         self.cont_feats = [f for f in self.cont_feats if f not in self._ignore_feats]
         self.cat_feats  = [f for f in self.cat_feats  if f not in self._ignore_feats]
+        self._use_cols  = [i for i, f in enumerate(self.input_feats) if f not in self._ignore_feats]
+        self.clear_cache()
     
+    def get_batch_aug(self) -> Optional[Callable[['Tensor',Optional['Tensor']],Tuple['Tensor',Optional['Tensor']]]]:
+        r'''
+        Returns a function to apply train-time augmentation to minibatches on device, if required. Plain FoldYielders do not augment data.
+
+        Returns:
+            `None`
+        '''
+
+        return None
+
     def get_ignore(self) -> List[str]:
         r'''
         Returns list of ignored features
@@ -123,11 +407,20 @@ class FoldYielder:
             foldfile: filename of h5py file or opened h5py file
         '''
         
-        if not isinstance(foldfile,  h5py.File): foldfile = h5py.File(foldfile, "r+")
-        self.foldfile, self.n_folds = foldfile, len([f for f in foldfile if 'fold_' in f])
+        foldfile = self._open_foldfile(foldfile)
+        self.foldfile,self._foldfile_name,self._pid = foldfile,foldfile.filename,os.getpid()
+        self._build_index()
         self.has_matrix = 'matrix_inputs' in self.columns()
+        self.columnar = 'input_columns' in self.columns()
         if 'meta_data' in self.foldfile: self._load_meta_data()
 
+    def _open_foldfile(self, foldfile:Union[str,Path,h5py.File]) -> h5py.File:
+        if not isinstance(foldfile,  h5py.File):
+            if self.read_only: foldfile = h5py.File(foldfile, "r", swmr=self.swmr)
+            else:              foldfile = h5py.File(foldfile, "r+", libver='latest' if self.swmr else None)
+        if self.swmr and not self.read_only: foldfile.swmr_mode = True
+        return foldfile
+
     def _load_meta_data(self) -> None:
         if self.cont_feats is not None:
             warnings.warn("Fold file contains meta data information, explicit passing of continuous and categorical feature lists is no longer required.")
@@ -135,7 +428,10 @@ class FoldYielder:
         self.cat_feats  = json.loads(self.foldfile['meta_data/cat_feats'][()])
         self.targ_feats = json.loads(self.foldfile['meta_data/targ_feats'][()])
         if 'wgt_feat' in self.foldfile['meta_data']: self.wgt_feat = json.loads(self.foldfile['meta_data/wgt_feat'][()])
+        if 'sanitised' in self.foldfile['meta_data']: self.sanitised = json.loads(self.foldfile['meta_data/sanitised'][()])
+        if 'storage_dtypes' in self.foldfile['meta_data']: self.storage_dtypes = json.loads(self.foldfile['meta_data/storage_dtypes'][()])
         if 'cat_maps' in self.foldfile['meta_data']: self.cat_maps = OrderedDict(json.loads(self.foldfile['meta_data/cat_maps'][()]))
+        if 'cat_szs' in self.foldfile['meta_data']: self.cat_szs = OrderedDict(json.loads(self.foldfile['meta_data/cat_szs'][()]))
         if self.has_matrix:
             self.matrix_feats = json.loads(self.foldfile['meta_data/matrix_feats'][()])
             self.matrix_feats['missing'] = np.array(self.matrix_feats['missing'], dtype=np.bool)
@@ -145,7 +441,56 @@ class FoldYielder:
         Closes the foldfile
         '''
 
-        self.foldfile.close()
+        self._memmaps,self._datasets = {},{}
+        self.clear_cache()
+        for f in self._get_files(): f.close()
+
+    @staticmethod
+    def _get_nbytes(data:Dict[str,Union[np.ndarray,Tuple[np.ndarray,np.ndarray],None]]) -> int:
+        n = 0
+        for v in data.values():
+            if v is None: continue
+            for a in (v if isinstance(v, tuple) else (v,)): n += a.nbytes
+        return n
+
+    def _add_to_cache(self, idx:int, data:Dict[str,Union[np.ndarray,Tuple[np.ndarray,np.ndarray],None]]) -> None:
+        nbytes = self._get_nbytes(data)
+        if nbytes > self.cache_size: return
+        for v in data.values():
+            if v is None: continue
+            for a in (v if isinstance(v, tuple) else (v,)):
+                if isinstance(a, np.ndarray): a.flags.writeable = False
+        with self._cache_lock:
+            if idx in self._cache: return
+            while len(self._cache) > 0 and self._cache_stats['bytes']+nbytes > self.cache_size:
+                _, (_, n) = self._cache.popitem(last=False)
+                self._cache_stats['bytes'] -= n
+                self._cache_stats['evictions'] += 1
+            self._cache[idx] = (data, nbytes)
+            self._cache_stats['bytes'] += nbytes
+
+    def clear_cache(self, fold_idx:Optional[int]=None) -> None:
+        r'''
+        Removes cached data, e.g. after the data in the foldfile has been modified. Called automatically by methods of the FoldYielder which affect fold data.
+
+        Arguments:
+            fold_idx: if set, only remove the specified fold from the cache, otherwise remove all folds
+        '''
+
+        with self._cache_lock:
+            idxs = list(self._cache.keys()) if fold_idx is None else [fold_idx]
+            for i in idxs:
+                if i in self._cache: self._cache_stats['bytes'] -= self._cache.pop(i)[1]
+
+    def get_cache_stats(self) -> Dict[str,int]:
+        r'''
+        Returns statistics about the use of the fold cache
+
+        Returns:
+            Dictionary of the number of cache hits, misses, and evictions, the number of folds currently cached, and the number of bytes they occupy
+        '''
+
+        with self._cache_lock: return {**self._cache_stats, 'folds': len(self._cache)}
 
     def add_input_pipe(self, input_pipe:Union[str,Pipeline]) -> None:
         r'''
@@ -212,64 +557,324 @@ class FoldYielder:
 
         with open(name, 'rb') as fin: self.output_pipe = pickle.load(fin)
 
-    def get_fold(self, idx:int) -> Dict[str,np.ndarray]:
+    def get_fold(self, idx:int, rows:Optional[slice]=None) -> Dict[str,np.ndarray]:
         r'''
         Get data for single fold. Data consists of dictionary of inputs, targets, and weights.
-        Accounts for ignored features.
-        Inputs are passed through np.nan_to_num to deal with nans and infs.
+        Accounts for ignored features; only the columns of features which are not ignored are read from the foldfile.
+        Inputs are passed through np.nan_to_num to deal with nans and infs, unless the foldfile was sanitised when written.
+        If a cache size was set, data are returned from the cache where possible.
 
         Arguments:
             idx: fold index to load
+            rows: optional slice of rows to load. Slices of folds are not cached
 
         Returns:
             tuple of inputs, targets, and weights as Numpy arrays
         '''
 
         def _append_matrix(data):
-            data['inputs'] = (data['inputs'],np.nan_to_num(self.get_column('matrix_inputs', n_folds=1, fold_idx=idx)))
+            data['inputs'] = (data['inputs'],self.get_matrix_inputs(idx, rows=rows))
             return data
 
-        data = self.get_data(n_folds=1, fold_idx=idx)
-        if len(self._ignore_feats) == 0:
-            return _append_matrix(data) if self.has_matrix and self.yield_matrix else data
-        else:
-            inputs = pd.DataFrame(np.array(self.foldfile[f'fold_{idx}/inputs']), columns=self.input_feats)
-            inputs = inputs[[f for f in self.input_feats if f not in self._ignore_feats]]
-            data['inputs'] = np.nan_to_num(inputs.values)
+        if rows is not None:
+            data = self._get_fold_data(idx, rows=rows)
             return _append_matrix(data) if self.has_matrix and self.yield_matrix else data
+        if self.cache_size > 0:
+            with self._cache_lock:
+                if idx in self._cache:
+                    self._cache.move_to_end(idx)
+                    self._cache_stats['hits'] += 1
+                    return dict(self._cache[idx][0])
+                self._cache_stats['misses'] += 1
+
+        data = self._get_fold_data(idx)
+        if self.has_matrix and self.yield_matrix: data = _append_matrix(data)
+        if self.cache_size > 0: self._add_to_cache(idx, data)
+        return data
+
+    @staticmethod
+    def _read_dataset(ds:h5py.Dataset, rows:Optional[slice]=None, cols:Optional[List[int]]=None, out:Optional[np.ndarray]=None,
+                      bfloat16:bool=False) -> np.ndarray:
+        r'''
+        Reads the requested rows and columns of a dataset via hyperslab selections directly into a (preallocated) array, without intermediate copies.
+        Columns are read in runs of contiguous indeces. Data stored in a different type to the output array, e.g. float16 or bfloat16 data read as float32,
+        are read in blocks of chunks into a reused buffer, and upcast into the output array.
+
+        Arguments:
+            ds: h5py dataset to read
+            rows: optional slice of rows to read (step must be 1)
+            cols: optional list of indeces along the second axis of `ds` to read, in the order in which they should be returned
+            out: optional preallocated array into which to read the data
+            bfloat16: whether `ds` contains bfloat16 data, stored as the upper 16 bits of float32 data
+
+        Returns:
+            Numpy array of requested data
+        '''
+
+        rows = slice(None) if rows is None else rows
+        if rows.step not in [None, 1]: raise ValueError("Row slices must have a step of 1")
+        start,stop,_ = rows.indices(ds.shape[0])
+        n = max(stop-start, 0)
+        if cols is not None and len(cols) > 0 and (min(cols) < 0 or max(cols) >= ds.shape[1]):
+            raise IndexError(f"Column indeces {cols} out of range for data with shape {ds.shape}")
+        shape = (n,*ds.shape[1:]) if cols is None else (n,len(cols),*ds.shape[2:])
+        if out is None: out = np.empty(shape, dtype=np.float32 if bfloat16 or ds.dtype == np.float16 else ds.dtype)
+        elif out.shape != shape: raise ValueError(f"Output array has shape {out.shape}, but shape {shape} is required")
+        if n == 0 or out.size == 0: return out
+        if bfloat16 or ds.dtype != out.dtype:  # Faster than conversion by HDF5
+            block = 65536 if ds.chunks is None else max(1, 65536//ds.chunks[0])*ds.chunks[0]
+            buf = np.empty((min(block, n),*shape[1:]), dtype=ds.dtype)
+            for i in range(0, n, block):
+                m = min(block, n-i)
+                FoldYielder._read_dataset(ds, rows=slice(start+i, start+i+m), cols=cols, out=buf[:m])
+                if bfloat16:
+                    bits = out[i:i+m].view(np.uint32)
+                    bits[...] = buf[:m]
+                    bits <<= 16
+                else:
+                    out[i:i+m] = buf[:m]
+            return out
+        if cols is None:
+            if out.flags.c_contiguous: ds.read_direct(out, source_sel=np.s_[start:stop])
+            else:                      out[...] = ds[start:stop]  # e.g. a column of a larger array
+            return out
+
+        j = 0
+        while j < len(cols):  # Read each run of contiguous columns in a single hyperslab selection
+            k = j+1
+            while k < len(cols) and cols[k] == cols[k-1]+1: k += 1
+            ds.read_direct(out, source_sel=np.s_[start:stop,cols[j]:cols[k-1]+1], dest_sel=np.s_[:,j:k])
+            j = k
+        return out
+
+    @staticmethod
+    def _read_columnar(grp:Union[h5py.Group,Dict[str,h5py.Dataset]], rows:Optional[slice]=None, cols:Optional[List[int]]=None, out:Optional[np.ndarray]=None) -> np.ndarray:
+        r'''
+        Reads the requested rows and columns of inputs saved in columnar format, i.e. one dataset per feature, directly into a (preallocated) array.
+        Only the datasets of the requested columns are accessed.
+
+        Arguments:
+            grp: h5py group, or dictionary, containing one dataset per column, named by column index
+            rows: optional slice of rows to read (step must be 1)
+            cols: optional list of column indeces to read, in the order in which they should be returned
+            out: optional preallocated array into which to read the data
+
+        Returns:
+            Numpy array of requested data
+        '''
+
+        if cols is None: cols = range(len(grp))
+        if out is None:
+            ds = grp['0']
+            start,stop,_ = (slice(None) if rows is None else rows).indices(ds.shape[0])
+            out = np.empty((max(stop-start, 0),len(cols)), dtype=np.promote_types(ds.dtype, np.float32), order='F')  # Columns are contiguous
+        for j, c in enumerate(cols): FoldYielder._read_dataset(grp[str(c)], rows=rows, out=out[:,j])
+        return out
+
+    def _get_memmap(self, name:str) -> Optional[np.memmap]:
+        r'''
+        Returns a read-only memory map of the named dataset, if the dataset is stored contiguously, uncompressed, and in the type in which it is read,
+        otherwise `None`.
+        File offsets are resolved, and unless the foldfile was sanitised, the finiteness of the data checked, once per dataset.
+        '''
+
+        if name not in self._memmaps:
+            ds,mm,finite = self._get_dataset(name),None,True
+            fold,column = name.split('/')
+            upcast = self.fold_index[int(fold[5:])]['columns'][column]['dtype'] != ds.dtype
+            if ds.chunks is None and not ds.is_virtual and ds.dtype.kind in 'biuf' and ds.size > 0 and not upcast:  # Compression requires chunking
+                offset = ds.id.get_offset()
+                if offset is not None: mm = np.memmap(ds.file.filename, dtype=ds.dtype, mode='r', offset=offset, shape=ds.shape)
+            if mm is not None and not self.sanitised and mm.dtype.kind == 'f':
+                step = max(1, (1 << 24)//max(1, mm[:1].nbytes))  # Check in blocks of about 16 MB, rather than allocating a mask for the whole dataset
+                finite = all(np.isfinite(mm[i:i+step]).all() for i in range(0, len(mm), step))
+            self._memmaps[name] = (mm,finite)
+        return self._memmaps[name][0]
+
+    def _nan_to_num(self, arr:np.ndarray) -> np.ndarray:
+        r'''
+        Passes data through `np.nan_to_num`, unless the foldfile was sanitised when written, or the data is a memory map and is already finite, in which
+        case the data are returned as is to avoid a copy.
+        Writable arrays, i.e. those freshly read from the foldfile, are modified in place.
+        '''
+
+        if self.sanitised: return arr
+        if isinstance(arr, np.memmap):
+            root = arr
+            while isinstance(root.base, np.ndarray): root = root.base  # Slices of the memory map of a dataset are views of it
+            if any(mm is root and finite for mm, finite in self._memmaps.values()): return arr
+        return np.nan_to_num(arr, copy=not arr.flags.writeable)
+
+    def _get_source(self, name:str) -> h5py.File:
+        r'''
+        Returns the file from which to read the named dataset: the prediction file, if set and containing the dataset, otherwise the foldfile
+        '''
+
+        fold,column = name.split('/')
+        return self._get_file(self.fold_index[int(fold[5:])]['columns'][column]['file'])
+
+    def _read_fold_column(self, fold:str, column:str, rows:Optional[slice]=None, cols:Optional[List[int]]=None,
+                          out:Optional[np.ndarray]=None) -> np.ndarray:
+        name = f'{fold}/{column}'
+        src = self._get_source(name)
+        if self.fold_index[int(fold[5:])]['columns'][column].get('ragged', False):
+            mat = self._read_ragged(fold, column, rows=rows, fill=0 if self.sanitised else np.nan)
+            if out is None: return mat[:]
+            out[...] = mat[:]
+            return out
+        if self._is_columnar(column, src):
+            grp = self._get_dataset(f'{fold}/input_columns')
+            if self.swmr:
+                for c in grp.values(): c.refresh()
+            return self._read_columnar(grp, rows=rows, cols=cols, out=out)
+        if self.swmr and src is not self.pred_file:
+            self._get_dataset(name).refresh()
+        elif self.memmap:
+            mm = self._get_memmap(name)
+            if mm is not None:
+                if rows is not None: mm = mm[rows]
+                if out is None: return mm if cols is None else mm[:,cols]
+                if cols is None: out[...] = mm
+                else:            np.take(mm, cols, axis=1, out=out)
+                return out
+        bfloat16 = self.fold_index[int(fold[5:])]['columns'][column]['storage_dtype'] == 'bfloat16'
+        return self._read_dataset(self._get_dataset(name), rows=rows, cols=cols, out=out, bfloat16=bfloat16)
+
+    def _read_ragged(self, fold:str, column:str, rows:Optional[slice]=None, fill:float=0) -> RaggedMatrix:
+        r'''
+        Reads the requested rows of a column saved in ragged format. Only the objects of the requested rows are read.
+        '''
+
+        grp,info = self._get_dataset(f'{fold}/{column}'),self.fold_index[int(fold[5:])]['columns'][column]
+        if self.swmr:
+            for ds in grp.values(): ds.refresh()
+        start,stop,step = (slice(None) if rows is None else rows).indices(info['shape'][0])
+        if step != 1: raise ValueError("Row slices must have a step of 1")
+        offsets = grp['offsets'][start:max(start, stop)+1]
+        vals = slice(offsets[0], offsets[-1])
+        values = self._read_dataset(grp['values'], rows=vals, bfloat16=info['storage_dtype'] == 'bfloat16')
+        return RaggedMatrix(values, grp['objects'][vals], offsets-offsets[0], info['shape'][1:], info['row_wise'], fill)
+
+    def get_ragged(self, fold_idx:int, column:str='matrix_inputs', rows:Optional[slice]=None, nan_to_num:bool=False) -> RaggedMatrix:
+        r'''
+        Load a column saved in ragged format, e.g. matrix inputs saved by :meth:`~lumin.data_processing.file_proc.df2foldfile` with `ragged=True`,
+        without padding it, e.g. in order to pass it to a model which handles missing objects via masks or packed sequences.
+
+        Arguments:
+            fold_idx: index of fold to load
+            column: name of column to load
+            rows: optional slice of rows to load
+            nan_to_num: whether to pass the features through `np.nan_to_num`, and pad missing objects with zeros rather than NaNs
 
-    def get_column(self, column:str, n_folds:Optional[int]=None, fold_idx:Optional[int]=None, add_newaxis:bool=False) -> Union[np.ndarray, None]:
+        Returns:
+            :class:`~lumin.nn.data.fold_yielder.RaggedMatrix` of column data
+        '''
+
+        info = self._get_fold_info(fold_idx)
+        if not info['columns'].get(column, {}).get('ragged', False): raise ValueError(f"Column {column} of fold {fold_idx} is not saved in ragged format")
+        mat = self._read_ragged(info['name'], column, rows=rows, fill=0 if nan_to_num or self.sanitised else np.nan)
+        if nan_to_num: mat.values = self._nan_to_num(mat.values)
+        return mat
+
+    def get_inputs(self, idx:int, rows:Optional[slice]=None, mask:Optional[np.ndarray]=None) -> np.ndarray:
+        r'''
+        Get the inputs of a fold, or of a slice of its rows. Accounts for ignored features; only the columns of features which are not ignored are read.
+        Inputs are passed through np.nan_to_num to deal with nans and infs, unless the foldfile was sanitised when written.
+
+        Arguments:
+            idx: fold index to load
+            rows: optional slice of rows to load
+            mask: optional array of indeces, or boolean array, further selecting features from those which are not ignored
+
+        Returns:
+            Numpy array of inputs
+        '''
+
+        cols = self._use_cols
+        if mask is not None: cols = (np.arange(len(self.input_feats)) if cols is None else np.array(cols))[mask].tolist()
+        return self._nan_to_num(self.get_column('inputs', n_folds=1, fold_idx=idx, rows=rows, cols=cols))
+
+    def get_matrix_inputs(self, idx:int, rows:Optional[slice]=None) -> Union[np.ndarray,RaggedMatrix]:
+        r'''
+        Get the matrix inputs of a fold, or of a slice of its rows, as a padded array, or as a :class:`~lumin.nn.data.fold_yielder.RaggedMatrix` if they
+        were saved in ragged format and `pad_matrix` is false.
+        Matrix inputs are passed through np.nan_to_num to deal with nans and infs, unless the foldfile was sanitised when written.
+
+        Arguments:
+            idx: fold index to load
+            rows: optional slice of rows to load
+
+        Returns:
+            Matrix inputs
+        '''
+
+        if not self.pad_matrix and self._get_fold_info(idx)['columns']['matrix_inputs'].get('ragged', False):
+            return self.get_ragged(idx, rows=rows, nan_to_num=True)
+        return self._nan_to_num(self.get_column('matrix_inputs', n_folds=1, fold_idx=idx, rows=rows))
+
+    def _is_columnar(self, column:str, src:h5py.File) -> bool: return column == 'inputs' and self.columnar and src is not self.pred_file
+
+    def _alloc_column(self, column:str, n_folds:int, rows:Optional[slice]=None, cols:Optional[List[int]]=None) -> Tuple[np.ndarray,List[int]]:
+        r'''
+        Allocates a single array to hold the requested data of a column over several folds, based on the indexed shapes of the fold datasets
+
+        Returns:
+            Empty array, and the row offset of each fold within it
+        '''
+
+        infos = [f['columns'][column] for f in self.fold_index[:n_folds]]
+        lens = [len(range(*(slice(None) if rows is None else rows).indices(i['shape'][0]))) for i in infos]
+        shape = infos[0]['shape'][1:] if cols is None else (len(cols),*infos[0]['shape'][2:])
+        order = 'F' if self._is_columnar(column, self._get_source(f'fold_0/{column}')) else 'C'  # Columnar data are read column by column
+        return np.empty((sum(lens),*shape), dtype=infos[0]['dtype'], order=order), np.cumsum([0]+lens).tolist()
+
+    def get_column(self, column:str, n_folds:Optional[int]=None, fold_idx:Optional[int]=None, add_newaxis:bool=False,
+                   rows:Optional[slice]=None, cols:Optional[List[int]]=None) -> Union[np.ndarray, None]:
         r'''
         Load column (h5py group) from foldfile. Used for getting arbitrary data which isn't automatically grabbed by other methods.
+        Subsets of rows and columns can be requested, in which case only the requested data are read from the file.
+        Data from several folds are read directly into a single, preallocated array.
 
         Arguments:
             column: name of h5py group to get
             n_folds: number of folds to get data from. Default all folds. Not compatable with fold_idx
             fold_idx: Only load group from a single, specified fold. Not compatable with n_folds
             add_newaxis: whether expand shape of returned data if data shape is ()
+            rows: optional slice of rows to load from each fold, e.g. `slice(0, 1000)`
+            cols: optional list of indeces along the second axis of the data to load, e.g. the indeces of the input features to load
 
         Returns:
             Numpy array of column data
         '''
 
-        if column not in self.columns(): return None
-
         if fold_idx is None:
-            data = []
-            for i, fold in enumerate([f for f in self.foldfile if 'fold_' in f]):
-                if n_folds is not None and i >= n_folds: break
-                data.append(np.array(self.foldfile[f'{fold}/{column}']))
-            data = np.concatenate(data)
+            if column not in self.columns(): return None
+            n = self.n_folds if n_folds is None else min(n_folds, self.n_folds)
+            data,offsets = self._alloc_column(column, n, rows=rows, cols=cols)
+            for i, f in enumerate(self.fold_index[:n]):
+                self._read_fold_column(f['name'], column, rows=rows, cols=cols, out=data[offsets[i]:offsets[i+1]])
         else:
-            if f'fold_{fold_idx}' not in self.foldfile: raise IndexError(f"Fold {fold_idx} does not exist")
-            data = np.array(self.foldfile[f'fold_{fold_idx}/{column}'])
-        return data[:, None] if data[0].shape is () and add_newaxis else data
+            info = self._get_fold_info(fold_idx)
+            if column not in info['columns']: return None
+            data = self._read_fold_column(info['name'], column, rows=rows, cols=cols)
+        return data[:, None] if data.ndim == 1 and add_newaxis else data
+
+    def _get_data(self, n_folds:Optional[int]=None, fold_idx:Optional[int]=None, cols:Optional[List[int]]=None,
+                  rows:Optional[slice]=None) -> Dict[str,np.ndarray]:
+        return {'inputs':  self._nan_to_num(self.get_column('inputs',  n_folds=n_folds, fold_idx=fold_idx, cols=cols, rows=rows)),
+                'targets':               self.get_column('targets', n_folds=n_folds, fold_idx=fold_idx, add_newaxis=True, rows=rows),
+                'weights':               self.get_column('weights', n_folds=n_folds, fold_idx=fold_idx, add_newaxis=True, rows=rows)}
+
+    def _get_fold_data(self, idx:int, rows:Optional[slice]=None) -> Dict[str,np.ndarray]:
+        return {'inputs':  self.get_inputs(idx, rows=rows),
+                'targets': self.get_column('targets', n_folds=1, fold_idx=idx, add_newaxis=True, rows=rows),
+                'weights': self.get_column('weights', n_folds=1, fold_idx=idx, add_newaxis=True, rows=rows)}
 
     def get_data(self, n_folds:Optional[int]=None, fold_idx:Optional[int]=None) -> Dict[str,np.ndarray]:
         r'''
         Get data for single, specified fold or several of folds. Data consists of dictionary of inputs, targets, and weights.
         Does not accounts for ignored features.
-        Inputs are passed through np.nan_to_num to deal with nans and infs.
+        Inputs are passed through np.nan_to_num to deal with nans and infs, unless the foldfile was sanitised when written.
 
         Arguments:
             n_folds: number of folds to get data from. Default all folds. Not compatable with fold_idx
@@ -279,15 +884,14 @@ class FoldYielder:
             tuple of inputs, targets, and weights as Numpy arrays
         '''
 
-        return {'inputs':  np.nan_to_num(self.get_column('inputs',  n_folds=n_folds, fold_idx=fold_idx)),
-                'targets':               self.get_column('targets', n_folds=n_folds, fold_idx=fold_idx, add_newaxis=True),
-                'weights':               self.get_column('weights', n_folds=n_folds, fold_idx=fold_idx, add_newaxis=True)}
+        return self._get_data(n_folds=n_folds, fold_idx=fold_idx)
 
     def get_df(self, pred_name:str='pred', targ_name:str='targets', wgt_name:str='weights', n_folds:Optional[int]=None, fold_idx:Optional[int]=None,
                inc_inputs:bool=False, inc_ignore:bool=False, deprocess:bool=False, verbose:bool=True, suppress_warn:bool=False,
-               nan_to_num:bool=False, inc_matrix:bool=False) -> pd.DataFrame:
+               nan_to_num:bool=False, inc_matrix:bool=False, feats:Optional[List[str]]=None) -> pd.DataFrame:
         r'''
-        Get a Pandas DataFrameof the data in the foldfile. Will add columns for inputs (if requested), targets, weights, and predictions (if present)
+        Get a Pandas DataFrameof the data in the foldfile. Will add columns for inputs (if requested), targets, weights, and predictions (if present).
+        Multi-fold data are read into single arrays, which are used by the DataFrame without further copies where possible
 
         Arguments:
             pred_name: name of prediction group
@@ -302,6 +906,8 @@ class FoldYielder:
             suppress_warn: whether to supress the warning about missing columns
             nan_to_num: whether to pass input data through `np.nan_to_num`
             inc_matrix: whether to include flattened matrix data in output, if present
+            feats: optional list of input features to include if `inc_inputs` is `True`, by default all (non-ignored, unless `inc_ignore`) features.
+                If not deprocessing, only these features are read from the foldfile
 
         Returns:
             Pandas DataFrame with requested data
@@ -310,10 +916,15 @@ class FoldYielder:
         # TODO Decide how to handle deprocessing matrix data: option for object by object, flattened out?
 
         if inc_inputs:
-            inputs = self.get_column('inputs', n_folds=n_folds, fold_idx=fold_idx)
-            if deprocess and self.input_pipe is not None:
+            if feats is None: feats = self.input_feats if inc_ignore else [f for f in self.input_feats if f not in self._ignore_feats]
+            full_read = deprocess and self.input_pipe is not None  # Inverse transform requires all continuous features
+            inputs = self.get_column('inputs', n_folds=n_folds, fold_idx=fold_idx,
+                                     cols=None if full_read else [self.input_feats.index(f) for f in feats])
+            if full_read:
                 try:
-                    inputs = np.hstack((self.input_pipe.inverse_transform(inputs[:,:len(self.orig_cont_feats)]), inputs[:,len(self.orig_cont_feats):]))
+                    cont = self.input_pipe.inverse_transform(inputs[:,:len(self.orig_cont_feats)])
+                    if inputs.flags.writeable: inputs[:,:len(self.orig_cont_feats)] = cont  # Avoid copying the full inputs
+                    else:                      inputs = np.hstack((cont, inputs[:,len(self.orig_cont_feats):]))
                 except ValueError:
                     if self.has_matrix:
                         print('Deprocessing of flat data failed, possible due to the input_pipe expecting to also transform matrix data. Deprocessing of matrix'
@@ -323,15 +934,15 @@ class FoldYielder:
                     else:
                         print('Deprocessing of flat data failed, returning inputs as processed.')
                         
-            if nan_to_num: inputs = np.nan_to_num(inputs)
-            data = pd.DataFrame(inputs, columns=self.input_feats)
-            if len(self._ignore_feats) > 0 and not inc_ignore: data = data[[f for f in self.input_feats if f not in self._ignore_feats]]
+            if nan_to_num: inputs = self._nan_to_num(inputs)
+            if full_read and feats != self.input_feats: data = pd.DataFrame(inputs, columns=self.input_feats)[feats]
+            else:                                       data = pd.DataFrame(inputs, columns=feats, copy=False)
             if self.has_matrix and inc_matrix:
                 mat = self.get_column('matrix_inputs', n_folds=n_folds, fold_idx=fold_idx).reshape(len(inputs),np.multiply(*self.matrix_feats['shape']))
                 mat = mat[:,np.logical_not(self.matrix_feats['missing'])]
                 # if deprocess and self.matrix_pipe is not None: mat = self.matrix_pipe.inverse_transform(mat)
-                if nan_to_num: mat = np.nan_to_num(mat)
-                data = data.join(pd.DataFrame(mat, columns=self.matrix_feats['present_feats']))
+                if nan_to_num: mat = self._nan_to_num(mat)
+                data = pd.concat([data, pd.DataFrame(mat, columns=self.matrix_feats['present_feats'], copy=False)], axis=1, copy=False)
         else:
             data = pd.DataFrame()
 
@@ -363,9 +974,51 @@ class FoldYielder:
         if verbose: print(f'{len(data)} datapoints loaded')
         return data
 
+    def _create_fold_column(self, fold_idx:int, column:str, shape:Tuple[int,...], dtype:Any, chunks:Optional[Union[bool,Tuple[int,...]]]=None,
+                            compression:Optional[str]=None) -> h5py.Dataset:
+        r'''
+        Creates a dataset for a column of a given fold, or reuses the existing one if it has the same shape, and updates the index.
+        Datasets are created in the foldfile if it is writable, otherwise (or if in SWMR mode and the column does not yet exist) in the prediction file.
+        '''
+
+        name,info = f'fold_{fold_idx}/{column}',self._get_fold_info(fold_idx)
+        src = info['columns'][column]['file'] if column in info['columns'] else None
+        if self.read_only or src == 'pred_file' or (self.swmr and src is None):
+            if self.pred_file is None:
+                raise ValueError("The foldfile cannot be modified, either because it was opened as read-only, or because new data cannot be added in SWMR mode. "
+                                 "Please set a separate pred_file in which to save data.")
+            out,path = 'pred_file',name
+        else:
+            out,path = info['file'],f"{info['path']}/{column}"
+        out_file = self._get_file(out)
+        if path in out_file and (not isinstance(out_file[path], h5py.Dataset) or out_file[path].shape != tuple(shape)): del out_file[path]
+        if path not in out_file: out_file.create_dataset(path, shape=shape, dtype=dtype, chunks=chunks, compression=compression)
+        info['columns'][column] = self._get_column_info(out_file[path], out)
+        if column in ['inputs', 'matrix_inputs']: self.sanitised = False  # New data may contain NaNs or infs
+        self._memmaps.pop(name, None)
+        self._datasets.pop(name, None)
+        self.clear_cache(fold_idx)
+        return out_file[path]
+
+    def save_fold_column(self, arr:np.ndarray, fold_idx:int, column:str, dtype:Optional[str]=None) -> None:
+        r'''
+        Save data for given fold as a column, overwriting any existing data in the column.
+        Data are written to the foldfile if it is writable, otherwise (or if in SWMR mode and the column does not yet exist) to the prediction file.
+
+        Arguments:
+            arr: array of data in the same order as data appears in the file
+            fold_idx: index for fold
+            column: name of column to save data under
+            dtype: optional data type with which to create new columns, by default the type of `arr`
+        '''
+
+        ds = self._create_fold_column(fold_idx, column, arr.shape, arr.dtype if dtype is None else dtype)
+        ds[...] = arr
+        ds.file.flush()
+
     def save_fold_pred(self, pred:np.ndarray, fold_idx:int, pred_name:str='pred') -> None:
         r'''
-        Save predictions for given fold as a new column in the foldfile
+        Save predictions for given fold as a new column in the foldfile, or in the prediction file if the foldfile is read-only
 
         Arguments:
             pred: array of predictions in the same order as data appears in the file
@@ -373,9 +1026,7 @@ class FoldYielder:
             pred_name: name of column to save predictions under
         '''
 
-        try: self.foldfile.create_dataset(f'fold_{fold_idx}/{pred_name}', shape=pred.shape, dtype='float32')
-        except RuntimeError: pass
-        self.foldfile[f'fold_{fold_idx}/{pred_name}'][...] = pred
+        self.save_fold_column(pred, fold_idx, pred_name, dtype='float32')
 
 
 class HEPAugFoldYielder(FoldYielder):
@@ -400,6 +1051,21 @@ class HEPAugFoldYielder(FoldYielder):
         output_pipe: optional Pipeline, or filename for pickled Pipeline, which was used for processing the targets
         yield_matrix: whether to actually yield matrix data if present
         matrix_pipe: preprocessing pipe for matrix data
+        memmap: if True, uncompressed and contiguous datasets will be accessed as read-only `np.memmap` views of the foldfile, rather than being copied into
+            memory
+        cache_size: if greater than zero, the maximum number of bytes of fold data to keep in memory. Only unaugmented folds are cached, i.e. those
+            returned by :meth:`~lumin.nn.data.fold_yielder.HEPAugFoldYielder.get_fold` when `device_aug` is set, since augmented folds differ on every call
+        read_only: if True, the foldfile will be opened in read-only mode, allowing several processes to read it concurrently
+        swmr: if True, the foldfile will be opened for HDF5 single-writer-multiple-reader access
+        pred_file: optional filename of a separate HDF5 file in which to save predictions and other data, if they cannot be written to the foldfile
+        pad_matrix: if False, and the matrix data were saved in ragged format, folds will contain the matrix inputs as a
+            :class:`~lumin.nn.data.fold_yielder.RaggedMatrix`. Matrix inputs are not augmented, and are always padded in the stacks of
+            :meth:`~lumin.nn.data.fold_yielder.HEPAugFoldYielder.get_test_fold_stacks`
+        device_aug: if True, train-time augmentation is not applied when loading folds, and is instead applied to each minibatch on the training device,
+            via the function returned by :meth:`~lumin.nn.data.fold_yielder.HEPAugFoldYielder.get_batch_aug`
+
+    Augmentations are applied to arrays via precomputed column indeces of the momentum components of each vector: rotations are applied to all vectors
+    at once, and reflections via a single multiplication per axis.
 
     Examples::
         >>> fy = HEPAugFoldYielder('train.h5',
@@ -414,17 +1080,19 @@ class HEPAugFoldYielder(FoldYielder):
                  reflect_x:bool=False, reflect_y:bool=True, reflect_z:bool=True,
                  train_time_aug:bool=True, test_time_aug:bool=True,
                  input_pipe:Optional[Pipeline]=None, output_pipe:Optional[Pipeline]=None,
-                 yield_matrix:bool=True, matrix_pipe:Optional[Union[str,Pipeline]]=None):
+                 yield_matrix:bool=True, matrix_pipe:Optional[Union[str,Pipeline]]=None, memmap:bool=False, cache_size:int=0,
+                 read_only:bool=False, swmr:bool=False, pred_file:Optional[Union[str,Path]]=None, pad_matrix:bool=True, device_aug:bool=False):
         super().__init__(foldfile=foldfile, cont_feats=cont_feats, cat_feats=cat_feats,
                          ignore_feats=ignore_feats, input_pipe=input_pipe, output_pipe=output_pipe,
-                         yield_matrix=yield_matrix, matrix_pipe=matrix_pipe)
+                         yield_matrix=yield_matrix, matrix_pipe=matrix_pipe, memmap=memmap, cache_size=cache_size,
+                         read_only=read_only, swmr=swmr, pred_file=pred_file, pad_matrix=pad_matrix)
 
         if rot_mult > 0 and not random_rot and rot_mult % 2 != 0:
             warnings.warn('Warning: rot_mult must currently be even for fixed rotations, adding an extra rotation multiplicity')
             rot_mult += 1
         self.rot_mult,self.random_rot,self.reflect_x,self.reflect_y,self.reflect_z,self.train_time_aug,self.test_time_aug,self.targ_feats = \
             rot_mult,random_rot,reflect_x,reflect_y,reflect_z,train_time_aug,test_time_aug,targ_feats
-        self.augmented,self.reflect_axes,self.aug_mult = True,[],1
+        self.augmented,self.reflect_axes,self.aug_mult,self.device_aug = True,[],1,device_aug
         self.vectors = [x[:-3] for x in self.cont_feats if '_px' in x]
         if self.targ_feats is not None: self.targ_vectors = [x[:-3] for x in self.targ_feats if '_px' in x]
 
@@ -453,64 +1121,161 @@ class HEPAugFoldYielder(FoldYielder):
                 self.reflect_axes += ['_pz']
                 self.aug_mult *= 2
         print(f'Total augmentation multiplicity is {self.aug_mult}')
+        self._aug_maps = self._get_aug_maps(self.input_feats, self.vectors)
+        if self.targ_feats is not None: self._targ_aug_maps = self._get_aug_maps(self.targ_feats, self.targ_vectors)
     
-    def _rotate(self, df:pd.DataFrame, vecs:List[str]) -> None:
-        for vec in vecs:
-            df.loc[:, f'{vec}_pxtmp'] = df.loc[:, f'{vec}_px']*np.cos(df.loc[:, 'aug_angle'])-df.loc[:, f'{vec}_py']*np.sin(df.loc[:, 'aug_angle'])
-            df.loc[:, f'{vec}_py']    = df.loc[:, f'{vec}_py']*np.cos(df.loc[:, 'aug_angle'])+df.loc[:, f'{vec}_px']*np.sin(df.loc[:, 'aug_angle'])
-            df.loc[:, f'{vec}_px']    = df.loc[:, f'{vec}_pxtmp']
-    
-    def _reflect(self, df:pd.DataFrame, vectors:List[str]) -> None:
-        for vector in vectors:
-            for coord in self.reflect_axes:
-                try:
-                    cut = (df[f'aug{coord}'] == 1)
-                    df.loc[cut, f'{vector}{coord}'] = -df.loc[cut, f'{vector}{coord}']
-                except KeyError:
-                    pass
-            
-    def get_fold(self, idx:int) -> Dict[str,np.ndarray]:
+    def _get_aug_maps(self, feats:List[str], vecs:List[str]) -> Dict[str,np.ndarray]:
+        r'''
+        Precomputes the column indeces of the momentum components of vectors in data with columns `feats`: x and y components of vectors which can be
+        rotated, and the components of each axis of reflection
+        '''
+
+        lookup = {f: i for i, f in enumerate(feats)}
+        rot = [v for v in vecs if f'{v}_px' in lookup and f'{v}_py' in lookup]
+        maps = {'rot_px': np.array([lookup[f'{v}_px'] for v in rot], dtype=int), 'rot_py': np.array([lookup[f'{v}_py'] for v in rot], dtype=int)}
+        for coord in self.reflect_axes: maps[coord] = np.array([lookup[f'{v}{coord}'] for v in vecs if f'{v}{coord}' in lookup], dtype=int)
+        return maps
+
+    @staticmethod
+    def _rotate(arr:Union[np.ndarray,'Tensor'], px:Union[np.ndarray,'Tensor'], py:Union[np.ndarray,'Tensor'], c:Any, s:Any) -> None:
+        r'''
+        Rotates all vectors in the transverse plane in place. Works on both arrays and tensors.
+
+        Arguments:
+            arr: data to augment
+            px: column indeces of x components
+            py: column indeces of y components, in the same order as `px`
+            c: cosine of the rotation angle, either a scalar, or a column vector of one angle per row
+            s: sine of the rotation angle, either a scalar, or a column vector of one angle per row
+        '''
+
+        x,y = arr[:,px],arr[:,py]
+        arr[:,px] = x*c-y*s
+        arr[:,py] = y*c+x*s
+
+    @staticmethod
+    def _reflect(arr:Union[np.ndarray,'Tensor'], idxs:Union[np.ndarray,'Tensor'], sign:Any) -> None:
+        r'''
+        Reflects the components of all vectors along an axis in place, by multiplying them by `sign`, either a scalar or a column vector of one sign per row.
+        Works on both arrays and tensors.
+        '''
+
+        arr[:,idxs] = arr[:,idxs]*sign
+
+    def _augment(self, arr:Union[np.ndarray,'Tensor'], maps:Dict[str,Union[np.ndarray,'Tensor']], c:Any, s:Any, signs:Dict[str,Any]) -> None:
+        if c is not None and len(maps['rot_px']) > 0: self._rotate(arr, maps['rot_px'], maps['rot_py'], c, s)
+        for coord, sign in signs.items():
+            if len(maps[coord]) > 0: self._reflect(arr, maps[coord], sign)
+
+    def _get_train_aug(self, n:int, dtype:np.dtype) -> Tuple[Optional[np.ndarray],Optional[np.ndarray],Dict[str,np.ndarray]]:
+        r'''
+        Returns the cosine and sine of a random rotation angle per row (if rotating), and a random sign per row for each axis of reflection
+        '''
+
+        c,s = None,None
+        if self.rot_mult:
+            angle = ((2*np.pi*np.random.random(size=(n,1)))-np.pi)
+            c,s = np.cos(angle).astype(dtype),np.sin(angle).astype(dtype)
+        return c,s,{coord: (1-2*np.random.randint(0, 2, size=(n,1))).astype(dtype) for coord in self.reflect_axes}
+
+    def _get_test_aug(self, aug_idx:int, n:int, dtype:np.dtype) -> Tuple[Any,Any,Dict[str,Any]]:
+        r'''
+        Returns the cosine and sine of the rotation angle(s) (if rotating) for the specified test-time augmentation, and the sign for each axis which should be
+        reflected
+        '''
+
+        c,s,signs = None,None,{}
+        if self.rot_mult:
+            if self.random_rot: angle = ((2*np.pi*np.random.random(size=(n,1)))-np.pi)
+            else:               angle = np.linspace(0, 2*np.pi, (self.rot_mult)+1)[aug_idx % self.rot_mult]
+            c,s = np.cos(angle).astype(dtype),np.sin(angle).astype(dtype)
+        if len(self.reflect_axes) > 0:
+            ref_idx = self._get_ref_idx(aug_idx)
+            signs = {coord: np.array(-1, dtype=dtype) for i, coord in enumerate(self.reflect_axes) if ref_idx[i] == '1'}
+        return c,s,signs
+
+    def _get_aug_data(self, idx:int, rows:Optional[slice]=None) -> Tuple[Dict[str,np.ndarray],np.ndarray,Optional[np.ndarray]]:
+        r'''
+        Loads targets and weights, and writable copies of the inputs and, if they are to be augmented, the targets
+        '''
+
+        data = {'targets': self.get_column('targets', fold_idx=idx, add_newaxis=True, rows=rows),
+                'weights': self.get_column('weights', fold_idx=idx, add_newaxis=True, rows=rows)}
+        inputs = self.get_column('inputs', fold_idx=idx, rows=rows)
+        if not inputs.flags.writeable: inputs = np.array(inputs)
+        targets = None
+        if self.targ_feats is not None: targets = data['targets'].astype(np.promote_types(data['targets'].dtype, np.float32))
+        return data,inputs,targets
+
+    def _set_aug_data(self, data:Dict[str,np.ndarray], inputs:np.ndarray, targets:Optional[np.ndarray]) -> Dict[str,np.ndarray]:
+        if self._use_cols is not None: inputs = inputs[:,self._use_cols]
+        data['inputs'] = self._nan_to_num(inputs)
+        if targets is not None: data['targets'] = np.nan_to_num(targets, copy=False)
+        return data
+
+    def get_fold(self, idx:int, rows:Optional[slice]=None) -> Dict[str,np.ndarray]:
         r'''
         Get data for single fold applying random train-time data augmentaion. Data consists of dictionary of inputs, targets, and weights.
         Accounts for ignored features.
-        Inputs are passed through np.nan_to_num to deal with nans and infs.
+        Inputs are passed through np.nan_to_num to deal with nans and infs, unless the foldfile was sanitised when written.
+        If `device_aug` is set, train-time augmentation is instead left to be applied per minibatch, and the data are returned unaugmented, and cached if a
+        cache size was set.
 
         Arguments:
             idx: fold index to load
+            rows: optional slice of rows to load
 
         Returns:
             tuple of inputs, targets, and weights as Numpy arrays
         '''
 
         def _append_matrix(data):
-            data['inputs'] = (data['inputs'],np.nan_to_num(self.get_column('matrix_inputs', n_folds=1, fold_idx=idx)))
+            data['inputs'] = (data['inputs'],self.get_matrix_inputs(idx, rows=rows))
             return data
 
-        data = self.get_data(n_folds=1, fold_idx=idx)
-        if not self.augmented: return data
-        inputs = pd.DataFrame(np.array(self.foldfile[f'fold_{idx}/inputs']), columns=self.input_feats)
-        if self.targ_feats is not None: targets = pd.DataFrame(np.array(self.foldfile[f'fold_{idx}/targets']), columns=self.targ_feats)
-            
-        if self.rot_mult:
-            inputs['aug_angle'] = (2*np.pi*np.random.random(size=len(inputs)))-np.pi
-            self._rotate(inputs, self.vectors)
-            if self.targ_feats is not None:
-                targets['aug_angle'] = inputs['aug_angle']
-                self._rotate(targets, self.targ_vectors)
-            
-        for coord in self.reflect_axes:
-            inputs[f'aug{coord}'] = np.random.randint(0, 2, size=len(inputs))
-            if self.targ_feats is not None: targets[f'aug{coord}'] = inputs[f'aug{coord}']
-        self._reflect(inputs, self.vectors)
-        if self.targ_feats is not None: self._reflect(targets, self.targ_vectors)
-
-        inputs = inputs[[f for f in self.input_feats if f not in self._ignore_feats]]
-        data['inputs'] = np.nan_to_num(inputs.values)
-        if self.targ_feats is not None:
-            targets = targets[self.targ_feats]
-            data['targets'] = np.nan_to_num(targets.values)
+        if not self.augmented: return self._get_data(n_folds=1, fold_idx=idx, rows=rows)
+        if self.device_aug: return super().get_fold(idx, rows=rows)  # Unaugmented, and so can be cached
+        data,inputs,targets = self._get_aug_data(idx, rows)
+        c,s,signs = self._get_train_aug(len(inputs), inputs.dtype)
+        self._augment(inputs, self._aug_maps, c, s, signs)
+        if targets is not None: self._augment(targets, self._targ_aug_maps, c, s, signs)
+        data = self._set_aug_data(data, inputs, targets)
         return _append_matrix(data) if self.has_matrix and self.yield_matrix else data
 
+    def get_batch_aug(self) -> Optional[Callable[['Tensor',Optional['Tensor']],Tuple['Tensor',Optional['Tensor']]]]:
+        r'''
+        Returns a function which applies random train-time augmentation to minibatches of inputs and targets, as tensors on device, if `device_aug` is set,
+        otherwise `None`.
+        Accounts for the features which are currently ignored.
+
+        Returns:
+            Function taking minibatches of inputs, excluding matrix inputs, and targets, and returning augmented copies of them
+        '''
+
+        if not self.device_aug: return None
+        import torch
+        from ...utils.misc import device
+        feats = [f for f in self.input_feats if f not in self._ignore_feats]
+        maps = {k: torch.as_tensor(v, device=device) for k, v in self._get_aug_maps(feats, self.vectors).items()}
+        targ_maps = None
+        if self.targ_feats is not None: targ_maps = {k: torch.as_tensor(v, device=device) for k, v in self._targ_aug_maps.items()}
+        return partial(self._augment_batch, maps=maps, targ_maps=targ_maps)
+
+    def _augment_batch(self, x:'Tensor', y:Optional['Tensor'], maps:Dict[str,'Tensor'],
+                       targ_maps:Optional[Dict[str,'Tensor']]) -> Tuple['Tensor',Optional['Tensor']]:
+        import torch
+        x,n = x.clone(),len(x)
+        c,s = None,None
+        if self.rot_mult:
+            angle = (2*np.pi*torch.rand((n,1), device=x.device, dtype=x.dtype))-np.pi
+            c,s = torch.cos(angle),torch.sin(angle)
+        signs = {coord: 1-2*torch.randint(0, 2, (n,1), device=x.device).to(x.dtype) for coord in self.reflect_axes}
+        self._augment(x, maps, c, s, signs)
+        if targ_maps is not None and y is not None:
+            y = y.clone()
+            self._augment(y, targ_maps, c, s, signs)
+        return x, y
+
     def _get_ref_idx(self, aug_idx:int) -> str:
         n_axes = len(self.reflect_axes)
         div = self.rot_mult if self.rot_mult else 1
@@ -522,7 +1287,7 @@ class HEPAugFoldYielder(FoldYielder):
         r'''
         Get test data for single fold applying test-time data augmentaion. Data consists of dictionary of inputs, targets, and weights.
         Accounts for ignored features.
-        Inputs are passed through np.nan_to_num to deal with nans and infs.
+        Inputs are passed through np.nan_to_num to deal with nans and infs, unless the foldfile was sanitised when written.
 
         Arguments:
             idx: fold index to load
@@ -533,59 +1298,180 @@ class HEPAugFoldYielder(FoldYielder):
         '''
 
         def _append_matrix(data):
-            data['inputs'] = (data['inputs'],np.nan_to_num(self.get_column('matrix_inputs', n_folds=1, fold_idx=idx)))
+            data['inputs'] = (data['inputs'],self.get_matrix_inputs(idx))
             return data
 
         if aug_idx >= self.aug_mult: raise ValueError(f"Invalid augmentation idx passed {aug_idx}")
-        data = self.get_data(n_folds=1, fold_idx=idx)
-        if not self.augmented: return data
-        
-        inputs = pd.DataFrame(np.array(self.foldfile[f'fold_{idx}/inputs']), columns=self.input_feats)
-        if len(self.reflect_axes) > 0 and self.rot_mult > 0:
-            rot_idx = aug_idx % self.rot_mult
-            ref_idx = self._get_ref_idx(aug_idx)
-            if self.random_rot: inputs['aug_angle'] = (2*np.pi*np.random.random(size=len(inputs)))-np.pi
-            else:               inputs['aug_angle'] = np.linspace(0, 2*np.pi, (self.rot_mult)+1)[rot_idx]
-            self._rotate(inputs, self.vectors)            
-
-            for i, coord in enumerate(self.reflect_axes): inputs[f'aug{coord}'] = int(ref_idx[i])
-            self._reflect(inputs, self.vectors)
-            
-        elif len(self.reflect_axes) > 0:
-            ref_idx = self._get_ref_idx(aug_idx)
-            for i, coord in enumerate(self.reflect_axes): inputs[f'aug{coord}'] = int(ref_idx[i])
-            self._reflect(inputs, self.vectors)
-            
-        elif self.rot_mult:
-            if self.random_rot: inputs['aug_angle'] = (2*np.pi*np.random.random(size=len(inputs)))-np.pi
-            else:               inputs['aug_angle'] = np.linspace(0, 2*np.pi, (self.rot_mult)+1)[aug_idx]
-            self._rotate(inputs, self.vectors)
-            
-        inputs = inputs[[f for f in self.input_feats if f not in self._ignore_feats]]
-        data['inputs'] = np.nan_to_num(inputs.values)
-        
-        if self.targ_feats is not None:
-            targets = pd.DataFrame(np.array(self.foldfile[f'fold_{idx}/targets']), columns=self.targ_feats)
-            if len(self.reflect_axes) > 0 and self.rot_mult > 0:
-                rot_idx = aug_idx % self.rot_mult
-                ref_idx = self._get_ref_idx(aug_idx)
-                if self.random_rot: targets['aug_angle'] = (2*np.pi*np.random.random(size=len(targets)))-np.pi
-                else:               targets['aug_angle'] = np.linspace(0, 2*np.pi, (self.rot_mult)+1)[rot_idx]
-                self._rotate(targets, self.targ_vectors)            
-
-                for i, coord in enumerate(self.reflect_axes): targets[f'aug{coord}'] = int(ref_idx[i])
-                self._reflect(targets, self.targ_vectors)
-
-            elif len(self.reflect_axes) > 0:
-                ref_idx = self._get_ref_idx(aug_idx)
-                for i, coord in enumerate(self.reflect_axes): targets[f'aug{coord}'] = int(ref_idx[i])
-                self._reflect(targets, self.targ_vectors)
-
-            elif self.rot_mult:
-                if self.random_rot: targets['aug_angle'] = (2*np.pi*np.random.random(size=len(targets)))-np.pi
-                else:               targets['aug_angle'] = np.linspace(0, 2*np.pi, (self.rot_mult)+1)[aug_idx]
-                self._rotate(targets, self.targ_vectors)
-            
-            targets = targets[self.targ_feats]
-            data['targets'] = np.nan_to_num(targets.values)
+        if not self.augmented: return self.get_data(n_folds=1, fold_idx=idx)
+        data,inputs,targets = self._get_aug_data(idx)
+        c,s,signs = self._get_test_aug(aug_idx, len(inputs), inputs.dtype)
+        self._augment(inputs, self._aug_maps, c, s, signs)
+        if targets is not None: self._augment(targets, self._targ_aug_maps, c, s, signs)
+        data = self._set_aug_data(data, inputs, targets)
         return _append_matrix(data) if self.has_matrix and self.yield_matrix else data
+
+    def get_test_fold_stacks(self, idx:int, n_stack:Optional[int]=None) -> Iterator[Tuple[List[int],Union[np.ndarray,Tuple[np.ndarray,np.ndarray]]]]:
+        r'''
+        Reads a fold once and provides all of its test-time augmentations, stacked along the first axis in groups of `n_stack`, such that they may be passed
+        through a model in large batches. The fold is read when the method is called, and the augmentations are generated during iteration, each stack in a
+        single pass of the augmentation kernels.
+        Accounts for ignored features.
+        Inputs are passed through np.nan_to_num to deal with nans and infs, unless the foldfile was sanitised when written.
+
+        Arguments:
+            idx: fold index to load
+            n_stack: number of augmentations to stack together. By default all augmentations are provided in a single stack
+
+        Returns:
+            Iterator of tuples of the augmentation indeces in the stack, and the stacked inputs (and matrix inputs), in which the rows of the fold are repeated
+            for each augmentation in turn
+
+        Examples::
+            >>> pred = 0
+            >>> for augs, inputs in fy.get_test_fold_stacks(0, n_stack=4):
+            ...     pred += model.predict(inputs).reshape(len(augs), -1, model.n_out).sum(0)
+            >>> pred /= fy.aug_mult
+        '''
+
+        n_stack = self.aug_mult if n_stack is None else n_stack
+        if n_stack < 1: raise ValueError(f"n_stack must be positive, but {n_stack} was passed")
+        if not self.augmented:
+            data = self.get_data(n_folds=1, fold_idx=idx)['inputs']
+            return iter([([0], data)])
+        _,inputs,_ = self._get_aug_data(idx)
+        matrix = self._nan_to_num(self.get_column('matrix_inputs', n_folds=1, fold_idx=idx)) if self.has_matrix and self.yield_matrix else None
+
+        def _stacks() -> Iterator[Tuple[List[int],Union[np.ndarray,Tuple[np.ndarray,np.ndarray]]]]:
+            n,dtype,one = len(inputs),inputs.dtype,np.array(1, dtype=inputs.dtype)
+            for start in range(0, self.aug_mult, n_stack):
+                augs = list(range(start, min(start+n_stack, self.aug_mult)))
+                params = [self._get_test_aug(a, n, dtype) for a in augs]
+                c,s = None,None
+                if self.rot_mult:
+                    c = np.concatenate([np.broadcast_to(p[0], (n,1)) for p in params])
+                    s = np.concatenate([np.broadcast_to(p[1], (n,1)) for p in params])
+                signs = {coord: np.concatenate([np.broadcast_to(p[2].get(coord, one), (n,1)) for p in params])
+                         for coord in self.reflect_axes if any(coord in p[2] for p in params)}
+                stack = np.tile(inputs, (len(augs),1))
+                self._augment(stack, self._aug_maps, c, s, signs)
+                if self._use_cols is not None: stack = stack[:,self._use_cols]
+                stack = self._nan_to_num(stack)
+                yield augs, (stack if matrix is None else (stack,np.concatenate([matrix]*len(augs))))
+
+        return _stacks()
+
+
+class ShardedFoldYielder(FoldYielder):
+    r'''
+    Version of :class:`~lumin.nn.data.fold_yielder.FoldYielder` which presents several foldfiles (shards), e.g. one per production campaign, as a single set
+    of folds, allowing datasets to be split over several files, and reads to be spread over several disks.
+    Each fold maps to a fold of one of the shards: by default the folds of each shard in turn, or as set via `folds`.
+    The shard and group of each fold are listed in `fold_index`.
+    ShardedFoldYielders can be used wherever a FoldYielder is expected, e.g. by :meth:`~lumin.nn.training.fold_train.fold_train_ensemble`,
+    :meth:`~lumin.nn.models.model.Model.predict_folds`, and :meth:`~lumin.nn.data.fold_yielder.FoldYielder.get_df`.
+
+    The meta data of the shards must describe the same features, and are read from the first shard. The data are only treated as sanitised if all shards
+    were sanitised when written. Shards must either all be columnar, or all not. Predictions and other data are saved in the shard containing the fold, or
+    in `pred_file`, under the folds of the ShardedFoldYielder.
+
+    .. Note:: Since models are trained fold by fold, each fold should contain a representative mixture of the data, e.g. shards should not each contain only
+        a single class
+
+    Arguments:
+        foldfiles: list of filenames of hdf5 files, or opened hdf5 files
+        folds: optional list of pairs of shard index and fold index, defining the folds of the ShardedFoldYielder. By default all folds of each shard in turn
+        cont_feats: list of names of continuous features present in input data, not required if foldfiles contain meta data already
+        cat_feats: list of names of categorical features present in input data, not required if foldfiles contain meta data already
+        ignore_feats: optional list of input features which should be ignored
+        input_pipe: optional Pipeline, or filename for pickled Pipeline, which was used for processing the inputs
+        output_pipe: optional Pipeline, or filename for pickled Pipeline, which was used for processing the targets
+        yield_matrix: whether to actually yield matrix data if present
+        matrix_pipe: preprocessing pipe for matrix data
+        memmap: if True, uncompressed and contiguous datasets will be accessed as read-only `np.memmap` views of the foldfiles
+        cache_size: if greater than zero, the maximum number of bytes of fold data to keep in memory
+        read_only: if True, the foldfiles will be opened in read-only mode, allowing several processes to read them concurrently
+        swmr: if True, the foldfiles will be opened for HDF5 single-writer-multiple-reader access
+        pred_file: optional filename of a separate HDF5 file in which to save predictions and other data, if they cannot be written to the foldfiles
+        pad_matrix: if False, matrix data saved in ragged format will be yielded as :class:`~lumin.nn.data.fold_yielder.RaggedMatrix`
+
+    Examples::
+        >>> fy = ShardedFoldYielder(['train_2016.h5', 'train_2017.h5', 'train_2018.h5'])
+        >>>
+        >>> fy = ShardedFoldYielder(['train_2016.h5', 'train_2017.h5'], folds=[(0,0), (1,0), (0,1), (1,1)])
+        >>>
+        >>> fy = ShardedFoldYielder(['/disk0/test.h5', '/disk1/test.h5'], read_only=True, pred_file='test_preds.h5')
+    '''
+
+    def __init__(self, foldfiles:List[Union[str,Path,h5py.File]], folds:Optional[List[Tuple[int,int]]]=None,
+                 cont_feats:Optional[List[str]]=None, cat_feats:Optional[List[str]]=None, ignore_feats:Optional[List[str]]=None,
+                 input_pipe:Optional[Union[str,Pipeline,Path]]=None, output_pipe:Optional[Union[str,Pipeline,Path]]=None,
+                 yield_matrix:bool=True, matrix_pipe:Optional[Union[str,Pipeline,Path]]=None, memmap:bool=False, cache_size:int=0,
+                 read_only:bool=False, swmr:bool=False, pred_file:Optional[Union[str,Path]]=None, pad_matrix:bool=True):
+        if len(foldfiles) == 0: raise ValueError("At least one foldfile must be passed")
+        self.shard_folds = None if folds is None else [tuple(f) for f in folds]
+        super().__init__(foldfile=foldfiles, cont_feats=cont_feats, cat_feats=cat_feats, ignore_feats=ignore_feats, input_pipe=input_pipe,
+                         output_pipe=output_pipe, yield_matrix=yield_matrix, matrix_pipe=matrix_pipe, memmap=memmap, cache_size=cache_size,
+                         read_only=read_only, swmr=swmr, pred_file=pred_file, pad_matrix=pad_matrix)
+
+    def __repr__(self) -> str: return f'ShardedFoldYielder with {self.n_folds} folds from {len(self.foldfiles)} foldfiles, containing {self.columns()}'
+
+    def __getstate__(self) -> Dict[str,Any]:
+        state = super().__getstate__()
+        del state['foldfiles']
+        return state
+
+    def _reopen_foldfile(self) -> None:
+        self.foldfiles = [self._reopen_file(n) for n in self._foldfile_names]
+        self.foldfile = self.foldfiles[0]
+
+    def _get_files(self) -> List[h5py.File]:
+        r'''
+        Returns the open foldfiles, and prediction file if set
+        '''
+
+        return [f for f in [*self.__dict__.get('foldfiles', []), self.__dict__.get('pred_file')] if f is not None]
+
+    def _get_file(self, src:Any) -> h5py.File:
+        r'''
+        Returns the file referred to by the source of a fold or column in the index: the index of a shard, or the name of an attribute
+        '''
+
+        return self.foldfiles[src] if isinstance(src, int) else getattr(self, src)
+
+    def _get_fold_sources(self) -> List[Tuple[Any,str]]:
+        r'''
+        Returns the shard index and group of each fold
+        '''
+
+        if self.shard_folds is None:
+            return [(i, f'fold_{j}') for i, f in enumerate(self.foldfiles) for j in sorted(int(k[5:]) for k in f if k.startswith('fold_'))]
+        for i, j in self.shard_folds:
+            if i < 0 or i >= len(self.foldfiles) or f'fold_{j}' not in self.foldfiles[i]: raise ValueError(f"Fold {j} of shard {i} does not exist")
+        return [(i, f'fold_{j}') for i, j in self.shard_folds]
+
+    def _set_foldfile(self, foldfiles:List[Union[str,Path,h5py.File]]) -> None:
+        r'''
+        Sets the files from which to access data
+
+        Arguments:
+            foldfiles: list of filenames of h5py files or opened h5py files
+        '''
+
+        self.foldfiles = [self._open_foldfile(f) for f in foldfiles]
+        self.foldfile,self._foldfile_names,self._pid = self.foldfiles[0],[f.filename for f in self.foldfiles],os.getpid()
+        self._foldfile_name = self._foldfile_names[0]
+        self._build_index()
+        self.has_matrix = 'matrix_inputs' in self.columns()
+        self.columnar = 'input_columns' in self.columns()
+        if any(('input_columns' in f['columns']) != self.columnar for f in self.fold_index): raise ValueError("Shards must either all be columnar, or all not")
+        if 'meta_data' in self.foldfile: self._load_meta_data()
+
+    def _load_meta_data(self) -> None:
+        feat_keys = ['cont_feats', 'cat_feats', 'targ_feats', 'wgt_feat', 'cat_maps', 'cat_szs', 'matrix_feats']
+        metas = [{k: json.loads(v[()]) for k, v in f['meta_data'].items()} if 'meta_data' in f else {} for f in self.foldfiles]
+        for i, m in enumerate(metas[1:], 1):
+            diff = [k for k in feat_keys if m.get(k) != metas[0].get(k)]
+            if len(diff) > 0: raise ValueError(f"The meta data of shard {i}, {self._foldfile_names[i]}, differs from that of shard 0 for {diff}")
+        super()._load_meta_data()
+        self.sanitised = all(m.get('sanitised', False) for m in metas)
+        if any(m.get('storage_dtypes') != metas[0].get('storage_dtypes') for m in metas): self.storage_dtypes = None  # Still upcast per dataset on read
@@ -0,0 +1,165 @@
+from typing import Dict, Optional, Union, Tuple, Any
+from pathlib import Path
+from threading import Thread
+from queue import Queue
+import numpy as np
+import h5py
+
+from .fold_yielder import FoldYielder
+
+__all__ = ['PredWriter']
+
+
+class _Stop:
+    r'''
+    Sentinel placed in the queue to stop the writer thread
+    '''
+
+    pass
+
+
+class PredWriter:
+    r'''
+    Writes predictions for the folds of a :class:`~lumin.nn.data.fold_yielder.FoldYielder`, either for whole folds, or slice by slice as predictions are
+    made by batched inference. Output datasets are created once per fold and prediction name, with chunking and (optionally) compression, and writes are
+    buffered and carried out on a background thread, such that inference can continue whilst predictions are written.
+    Predictions can be saved to the foldfile (or its prediction file) via the :class:`~lumin.nn.data.fold_yielder.FoldYielder`, to a separate HDF5 file, or
+    kept in memory.
+
+    .. Note:: Written data are only guaranteed to be readable once :meth:`~lumin.nn.data.pred_writer.PredWriter.flush` or
+        :meth:`~lumin.nn.data.pred_writer.PredWriter.close` has been called. Errors raised whilst writing are reraised by these methods.
+
+    Arguments:
+        fy: :class:`~lumin.nn.data.fold_yielder.FoldYielder` providing the data for which predictions are written
+        target: where to save predictions: `None` to save them via `fy`, as new columns in the foldfile or its prediction file;
+            a filename of a separate HDF5 file, in which predictions are saved under the same fold structure as the foldfile; or 'memory' to keep them in
+            :attr:`preds`, a dictionary mapping prediction names to dictionaries of arrays per fold
+        chunk_rows: number of rows per chunk of created datasets
+        compression: optional compression argument for h5py, e.g. 'lzf'
+        n_buffer: maximum number of writes waiting to be carried out, before further writes block
+        asynchronous: whether to write on a background thread. If false, data are written immediately
+
+    Examples::
+        >>> with PredWriter(fy, target='preds.h5') as writer:
+        ...     for fold_idx in range(len(fy)):
+        ...         writer.save(model.predict(fy.get_fold(fold_idx)['inputs'])[:,0], fold_idx, pred_name='pred')
+        >>>
+        >>> model.predict_folds(fy, pred_writer=PredWriter(fy, target='memory'))
+    '''
+
+    def __init__(self, fy:FoldYielder, target:Optional[Union[str,Path]]=None, chunk_rows:int=65536, compression:Optional[str]='lzf', n_buffer:int=8,
+                 asynchronous:bool=True):
+        self.fy,self.target,self.chunk_rows,self.compression,self.n_buffer,self.asynchronous = fy,target,chunk_rows,compression,n_buffer,asynchronous
+        self.preds:Dict[str,Dict[int,np.ndarray]] = {}
+        self.file = None
+        self._outputs:Dict[Tuple[int,str],Any] = {}
+        self._queue,self._thread,self._error = None,None,None
+
+    def __repr__(self) -> str: return f'PredWriter saving predictions for {self.fy} to {"the foldfile" if self.target is None else self.target}'
+
+    def __enter__(self) -> 'PredWriter': return self
+
+    def __exit__(self, *args) -> None: self.close()
+
+    def _create(self, fold_idx:int, pred_name:str, shape:Tuple[int,...]) -> Union[h5py.Dataset,np.ndarray]:
+        r'''
+        Creates the output for the predictions of a fold
+        '''
+
+        chunks = (max(1, min(self.chunk_rows, shape[0])),*shape[1:]) if shape[0] > 0 else None
+        compression = self.compression if chunks is not None else None
+        if self.target == 'memory':
+            if pred_name not in self.preds: self.preds[pred_name] = {}
+            self.preds[pred_name][fold_idx] = np.empty(shape, dtype=np.float32)
+            return self.preds[pred_name][fold_idx]
+        if self.target is None: return self.fy._create_fold_column(fold_idx, pred_name, shape, 'float32', chunks=chunks, compression=compression)
+        if self.file is None: self.file = h5py.File(self.target, 'a')
+        name = f'fold_{fold_idx}/{pred_name}'
+        if name in self.file and self.file[name].shape != shape: del self.file[name]
+        if name not in self.file: self.file.create_dataset(name, shape=shape, dtype='float32', chunks=chunks, compression=compression)
+        return self.file[name]
+
+    def _write(self, item:Tuple[Union[h5py.Dataset,np.ndarray],int,np.ndarray]) -> None:
+        out,start,arr = item
+        out[start:start+len(arr)] = arr
+
+    def _worker(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if isinstance(item, _Stop): return
+                if self._error is None: self._write(item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _start(self) -> None:
+        self._queue = Queue(maxsize=self.n_buffer)
+        self._thread = Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def write(self, pred:np.ndarray, fold_idx:int, pred_name:str='pred', start:int=0) -> None:
+        r'''
+        Write a slice of predictions for a fold. The output for the fold is created on the first write, with as many rows as the fold.
+
+        Arguments:
+            pred: array of predictions for consecutive rows of the fold
+            fold_idx: index for fold
+            pred_name: name under which to save predictions
+            start: index of the row in the fold to which the first prediction corresponds
+        '''
+
+        if self._error is not None: self.flush()
+        key = (fold_idx, pred_name)
+        if key not in self._outputs: self._outputs[key] = self._create(fold_idx, pred_name, (self.fy.n_rows(fold_idx),*pred.shape[1:]))
+        item = (self._outputs[key], start, np.array(pred, dtype=np.float32))  # Copy, since the caller may reuse its array
+        if not self.asynchronous:
+            self._write(item)
+            return
+        if self._thread is None: self._start()
+        self._queue.put(item)
+
+    def save(self, pred:np.ndarray, fold_idx:int, pred_name:str='pred') -> None:
+        r'''
+        Write predictions for a whole fold
+
+        Arguments:
+            pred: array of predictions in the same order as data appears in the file
+            fold_idx: index for fold
+            pred_name: name under which to save predictions
+        '''
+
+        self.write(pred, fold_idx, pred_name)
+
+    def flush(self) -> None:
+        r'''
+        Waits for all pending writes to complete and flushes the output file, reraising any errors encountered whilst writing
+        '''
+
+        if self._queue is not None: self._queue.join()
+        if self.file is not None: self.file.flush()
+        elif self.target is None:
+            for f in self.fy._get_files():
+                if f.mode != 'r': f.flush()
+        if self._error is not None:
+            e,self._error = self._error,None
+            raise e
+
+    def close(self) -> None:
+        r'''
+        Completes all pending writes, stops the background thread, and closes the separate output file, if used.
+        Predictions kept in memory remain accessible, and further writes may still be made.
+        '''
+
+        try:
+            self.flush()
+        finally:
+            if self._thread is not None:
+                self._queue.put(_Stop())
+                self._thread.join()
+                self._queue,self._thread = None,None
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self._outputs = {}
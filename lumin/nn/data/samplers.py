@@ -0,0 +1,214 @@
+import numpy as np
+from typing import Optional, Tuple
+from abc import ABC, abstractmethod
+
+__all__ = ['AbsIdxSampler', 'ShuffleSampler', 'WeightedSampler', 'ClassBalancedSampler', 'BootstrapSampler']
+
+
+class AbsIdxSampler(ABC):
+    r'''
+    Abstract class for index samplers, which select the rows of the data to be yielded by a :class:`~lumin.nn.data.batch_yielder.BatchYielder` in each
+    iteration. Samplers only return indeces, and the minibatches are then gathered from the original data, such that no resampled copies of the data are made.
+    Samplers also return the weights to associate with each row of the original data, which are then gathered along with the other data, allowing samplers to
+    correct the weights for the sampling.
+    '''
+
+    @abstractmethod
+    def sample(self, targets:np.ndarray, weights:Optional[np.ndarray], objective:str, shuffle:bool=True) -> Tuple[np.ndarray,Optional[np.ndarray]]:
+        r'''
+        Sample rows for the next iteration
+
+        Arguments:
+            targets: target array of data
+            weights: optional weight array of data
+            objective: 'classification', 'multiclass classification', or 'regression'
+            shuffle: whether the sample should be shuffled
+
+        Returns:
+            Array of indeces of rows to yield, and weights to use for each row of the original data
+        '''
+
+        pass
+
+    def n_samples(self, n_rows:int) -> int:
+        r'''
+        Returns the number of rows sampled per iteration from data with `n_rows` rows
+        '''
+
+        return n_rows
+
+    @staticmethod
+    def _get_classes(targets:np.ndarray, objective:str) -> Tuple[np.ndarray,np.ndarray]:
+        r'''
+        Returns the unique classes in the targets, and the class index of each row
+        '''
+
+        if 'class' not in objective: raise ValueError(f"Class-wise sampling requires a classification objective, but objective is {objective}")
+        return np.unique(targets.squeeze(), return_inverse=True)
+
+    @staticmethod
+    def _draw(probs:np.ndarray, n:int) -> np.ndarray:
+        r'''
+        Draws `n` indeces with replacement, with probabilities proportional to `probs`, via the inverse of the cumulative distribution
+        '''
+
+        cdf = np.cumsum(probs, dtype=np.float64)
+        if cdf[-1] <= 0: raise ValueError("Sampling probabilities must have a positive sum")
+        return np.minimum(np.searchsorted(cdf, np.random.random(n)*cdf[-1], side='right'), len(cdf)-1)
+
+
+class ShuffleSampler(AbsIdxSampler):
+    r'''
+    Index sampler which yields every row once, in a random order if shuffling. Equivalent to the default behaviour of
+    :class:`~lumin.nn.data.batch_yielder.BatchYielder`.
+
+    Examples::
+        >>> by = BatchYielder(**fold, objective=objective, bs=bs, sampler=ShuffleSampler())
+    '''
+
+    def sample(self, targets:np.ndarray, weights:Optional[np.ndarray], objective:str, shuffle:bool=True) -> Tuple[np.ndarray,Optional[np.ndarray]]:
+        r'''
+        Sample rows for the next iteration
+
+        Arguments:
+            targets: target array of data
+            weights: optional weight array of data
+            objective: 'classification', 'multiclass classification', or 'regression'
+            shuffle: whether the sample should be shuffled
+
+        Returns:
+            Array of indeces of rows to yield, and the unchanged weights
+        '''
+
+        return np.random.permutation(len(targets)) if shuffle else np.arange(len(targets)), weights
+
+
+class WeightedSampler(AbsIdxSampler):
+    r'''
+    Index sampler which draws rows with replacement, with a probability proportional to their weights, such that rows with small weights do not take up
+    space in minibatches. Since the weights are accounted for by the sampling, the weights yielded for every row are set to the mean weight, preserving the
+    normalisation of the loss.
+    Negative weights are not supported.
+
+    Arguments:
+        n: number of rows to draw per iteration, by default the number of rows in the data
+
+    Examples::
+        >>> by = BatchYielder(**fold, objective=objective, bs=bs, sampler=WeightedSampler())
+    '''
+
+    def __init__(self, n:Optional[int]=None):
+        self.n = n
+
+    def n_samples(self, n_rows:int) -> int: return n_rows if self.n is None else self.n
+
+    def _get_probs(self, targets:np.ndarray, weights:np.ndarray, objective:str) -> np.ndarray:
+        if np.any(weights < 0): raise ValueError("Weight-proportional sampling does not support negative weights")
+        return weights.squeeze()
+
+    def sample(self, targets:np.ndarray, weights:Optional[np.ndarray], objective:str, shuffle:bool=True) -> Tuple[np.ndarray,Optional[np.ndarray]]:
+        r'''
+        Sample rows for the next iteration. Samples are always in a random order.
+
+        Arguments:
+            targets: target array of data
+            weights: weight array of data
+            objective: 'classification', 'multiclass classification', or 'regression'
+            shuffle: not used, only for compatability
+
+        Returns:
+            Array of indeces of rows to yield, and the mean weight for each row of the original data
+        '''
+
+        if weights is None: raise ValueError("WeightedSampler requires weights")
+        idxs = self._draw(self._get_probs(targets, weights, objective), len(targets) if self.n is None else self.n)
+        return idxs, np.full_like(weights, weights.mean())
+
+
+class ClassBalancedSampler(WeightedSampler):
+    r'''
+    Index sampler which draws rows with replacement, such that each class is sampled equally often. Within each class, rows are drawn with a probability
+    proportional to their weights, if present and `use_weights` is true, otherwise uniformly.
+    Since the balancing is accounted for by the sampling, the weights yielded for every row are set to the mean weight, preserving the normalisation of the
+    loss.
+
+    Arguments:
+        n: number of rows to draw per iteration, by default the number of rows in the data
+        use_weights: whether to draw rows within each class in proportion to their weights
+
+    Examples::
+        >>> by = BatchYielder(**fold, objective=objective, bs=bs, sampler=ClassBalancedSampler())
+    '''
+
+    def __init__(self, n:Optional[int]=None, use_weights:bool=True):
+        super().__init__(n=n)
+        self.use_weights = use_weights
+
+    def _get_probs(self, targets:np.ndarray, weights:Optional[np.ndarray], objective:str) -> np.ndarray:
+        _,cls = self._get_classes(targets, objective)
+        probs = super()._get_probs(targets, weights, objective) if self.use_weights and weights is not None else np.ones(len(targets))
+        return probs/np.bincount(cls, weights=probs)[cls]  # Each class sums to one
+
+    def sample(self, targets:np.ndarray, weights:Optional[np.ndarray], objective:str, shuffle:bool=True) -> Tuple[np.ndarray,Optional[np.ndarray]]:
+        r'''
+        Sample rows for the next iteration. Samples are always in a random order.
+
+        Arguments:
+            targets: target array of data
+            weights: optional weight array of data
+            objective: 'classification' or 'multiclass classification'
+            shuffle: not used, only for compatability
+
+        Returns:
+            Array of indeces of rows to yield, and the mean weight for each row of the original data, if weights were passed
+        '''
+
+        idxs = self._draw(self._get_probs(targets, weights, objective), len(targets) if self.n is None else self.n)
+        return idxs, None if weights is None else np.full_like(weights, weights.mean())
+
+
+class BootstrapSampler(AbsIdxSampler):
+    r'''
+    Index sampler which draws rows uniformly with replacement, i.e. a bootstrap resample of the data.
+    Optionally, the weights are rescaled such that the sampled rows have the same weight sum (per class, for classification) as the original data.
+
+    Arguments:
+        reweight: whether to rescale the weights to match the weight sum (per class) of the original data
+        idxs: optional fixed sample of indeces to yield each iteration (in a random order if shuffling), e.g. to reuse the same bootstrap sample.
+            By default a new sample is drawn for every iteration
+
+    Examples::
+        >>> by = BatchYielder(**fold, objective=objective, bs=bs, sampler=BootstrapSampler())
+    '''
+
+    def __init__(self, reweight:bool=True, idxs:Optional[np.ndarray]=None):
+        self.reweight,self.idxs = reweight,idxs
+
+    def n_samples(self, n_rows:int) -> int: return n_rows if self.idxs is None else len(self.idxs)
+
+    def sample(self, targets:np.ndarray, weights:Optional[np.ndarray], objective:str, shuffle:bool=True) -> Tuple[np.ndarray,Optional[np.ndarray]]:
+        r'''
+        Sample rows for the next iteration
+
+        Arguments:
+            targets: target array of data
+            weights: optional weight array of data
+            objective: 'classification', 'multiclass classification', or 'regression'
+            shuffle: whether the sample should be shuffled
+
+        Returns:
+            Array of indeces of rows to yield, and the (rescaled) weights for each row of the original data
+        '''
+
+        idxs = np.random.randint(0, len(targets), len(targets)) if self.idxs is None else self.idxs
+        if shuffle and self.idxs is not None: idxs = np.random.permutation(idxs)
+        if weights is None or not self.reweight: return idxs, weights
+        w = weights.squeeze()
+        if 'class' in objective:
+            _,cls = self._get_classes(targets, objective)
+            orig = np.bincount(cls, weights=w)
+            new = np.bincount(cls[idxs], weights=w[idxs], minlength=len(orig))
+            scale = np.divide(orig, new, out=np.ones_like(orig), where=new != 0)[cls]
+        else:
+            scale = w.sum()/w[idxs].sum()
+        return idxs, (w*scale).astype(weights.dtype).reshape(weights.shape)
@@ -7,6 +7,7 @@ import warnings
 from fastprogress import progress_bar, master_bar
 from pathlib import Path
 import timeit
+from functools import partial
 from typing import Dict, Union, Any, List, Optional, Tuple
 from sklearn.pipeline import Pipeline
 
@@ -17,6 +18,8 @@ from ..callbacks.abs_callback import AbsCallback
 from ..models.model import Model
 from ..models.model_builder import ModelBuilder
 from ..data.fold_yielder import FoldYielder
+from ..data.fold_prefetcher import FoldPrefetcher
+from ..data.pred_writer import PredWriter
 from ..interpretation.features import get_ensemble_feat_importance
 from ..metrics.eval_metric import EvalMetric
 from ...utils.statistics import uncert_round
@@ -288,7 +291,8 @@ class Ensemble(AbsEnsemble):
         return pred
     
     def predict_folds(self, fy:FoldYielder, n_models:Optional[int]=None, pred_name:str='pred', callbacks:Optional[List[AbsCallback]]=None,
-                      verbose:bool=True, bs:Optional[int]=None) -> None:
+                      verbose:bool=True, bs:Optional[int]=None, n_prefetch:int=1, tta_stack:Optional[int]=None,
+                      pred_writer:Optional[PredWriter]=None) -> None:
         r'''
         Apply ensemble to data accessed by a :class:`~lumin.nn.data.fold_yielder.FoldYielder` and save predictions as a new group per fold in the foldfile.
         If an output pipe has been added to the ensemble, then the predictions will be deprocessed.
@@ -303,6 +307,14 @@ class Ensemble(AbsEnsemble):
             callbacks: list of any callbacks to use during evaluation
             verbose: whether to print average prediction timings
             bs: if not `None`, will run prediction in batches of specified size to save of memory
+            n_prefetch: number of folds (or augmentations, if using test-time augmentation) to load in the background ahead of the current one
+            tta_stack: if set and using test-time augmentation, each fold is read once and its augmentations are predicted in stacks of `tta_stack`
+                augmentations at a time, via :meth:`~lumin.nn.data.fold_yielder.HEPAugFoldYielder.get_test_fold_stacks`, accumulating the average prediction.
+                Larger stacks are quicker, but hold `tta_stack` copies of the inputs of a fold, and matrix inputs, in memory at once.
+                By default, each augmentation is instead loaded and predicted separately
+            pred_writer: optional :class:`~lumin.nn.data.pred_writer.PredWriter` with which to save predictions, e.g. to a separate file or in memory.
+                By default, predictions are saved to the foldfile (or its prediction file) via a :class:`~lumin.nn.data.pred_writer.PredWriter` on a
+                background thread
 
         Examples::
             >>> ensemble.predict_array(test_fy, pred_name='pred_tta')
@@ -310,23 +322,34 @@ class Ensemble(AbsEnsemble):
 
         n_models = len(self.models) if n_models is None else n_models
         times = []
+        if not fy.test_time_aug:
+            folds = iter(FoldPrefetcher(fy, range(len(fy)), n_prefetch=n_prefetch))
+        elif tta_stack is not None:
+            folds = iter(FoldPrefetcher(fy, range(len(fy)), n_prefetch=n_prefetch, get_func=partial(fy.get_test_fold_stacks, n_stack=tta_stack)))
+        writer = PredWriter(fy) if pred_writer is None else pred_writer
         mb = master_bar(range(len(fy)))
         for fold_idx in mb:
             fold_tmr = timeit.default_timer()
             if not fy.test_time_aug:
-                fold = fy.get_fold(fold_idx)['inputs']
+                fold = next(folds)[1]['inputs']
                 pred = self.predict_array(fold, n_models, mb, display=True, callbacks=callbacks, bs=bs)
+            elif tta_stack is not None:
+                pred = 0
+                for augs, inputs in progress_bar(next(folds)[1], total=int(np.ceil(fy.aug_mult/tta_stack)), parent=mb):
+                    pred += self.predict_array(inputs, n_models, display=False, callbacks=callbacks, bs=bs).reshape(len(augs), -1, self.n_out).sum(0)
+                pred /= fy.aug_mult
             else:
                 tmpPred = []
-                pb = progress_bar(range(fy.aug_mult), parent=mb)
-                for aug in pb:
-                    fold = fy.get_test_fold(fold_idx, aug)['inputs']
+                augs = FoldPrefetcher(fy, range(fy.aug_mult), n_prefetch=n_prefetch, get_func=partial(fy.get_test_fold, fold_idx))
+                for aug, fold in progress_bar(augs, total=fy.aug_mult, parent=mb):
+                    fold = fold['inputs']
                     tmpPred.append(self.predict_array(fold, n_models, display=False, callbacks=callbacks, bs=bs))
                 pred = np.mean(tmpPred, axis=0)
 
-            times.append((timeit.default_timer()-fold_tmr)/len(fold))
-            if self.n_out > 1: fy.save_fold_pred(pred, fold_idx, pred_name=pred_name)
-            else: fy.save_fold_pred(pred[:, 0], fold_idx, pred_name=pred_name)
+            writer.save(pred if self.n_out > 1 else pred[:,0], fold_idx, pred_name=pred_name)
+            times.append((timeit.default_timer()-fold_tmr)/fy.n_rows(fold_idx))
+        if pred_writer is None: writer.close()
+        else:                   writer.flush()
         times = uncert_round(np.mean(times), np.std(times, ddof=1)/np.sqrt(len(times)))
         if verbose: print(f'Mean time per event = {times[0]}±{times[1]}')
 
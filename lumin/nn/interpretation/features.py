@@ -51,7 +51,7 @@ def get_nn_feat_importance(model:AbsModel, fy:FoldYielder, eval_metric:Optional[
     fold_bar = progress_bar(range(fy.n_folds), parent=pb_parent)
     for fold_idx in fold_bar:  # Average over folds
         val_fold = fy.get_fold(fold_idx)
-        if val_fold['weights'] is not None: val_fold['weights'] /= val_fold['weights'].sum()
+        if val_fold['weights'] is not None: val_fold['weights'] = val_fold['weights']/val_fold['weights'].sum()
         targs = val_fold['targets']
         weights = val_fold['weights']
         if eval_metric is None: nom = model.evaluate(val_fold['inputs'], targs, weights=weights)
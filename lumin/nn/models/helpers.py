@@ -61,7 +61,8 @@ class CatEmbedder():
     def from_fy(cls, fy:FoldYielder,  emb_szs:Optional[List[int]]=None, max_emb_sz:int=50, emb_load_path:Optional[Union[Path,str]]=None):
         r'''
         Instantiate an :class:`~lumin.nn.models.helpers.CatEmbedder` from a :class:`~lumin.nn.data.fold_yielder.FoldYielder`, i.e. avoid having to pass
-        cat_names and cat_szs.
+        cat_names and cat_szs. Cardinalities are taken from the meta data of the foldfile, if saved (e.g. by a
+        :class:`~lumin.data_processing.pre_proc.CatEncoder`), otherwise from the maximum code present in the data.
         
         Arguments:
             fy: :class:`~lumin.nn.data.fold_yielder.FoldYielder` with training data
@@ -83,6 +84,9 @@ class CatEmbedder():
         '''
 
         cat_names = fy.get_use_cat_feats()
+        if getattr(fy, 'cat_szs', None) is not None and all(f in fy.cat_szs for f in cat_names):  # Saved cardinalities include reserved codes
+            return cls(cat_names=cat_names, cat_szs=[fy.cat_szs[f] for f in cat_names], emb_szs=emb_szs, max_emb_sz=max_emb_sz,
+                       emb_load_path=emb_load_path)
         cat_szs = None
         # Get cardinalities
         for fld_id in range(len(fy)):
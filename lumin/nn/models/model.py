@@ -4,6 +4,7 @@ from typing import List, Optional, Union, Tuple
 from collections import OrderedDict
 from fastprogress import master_bar, progress_bar
 import timeit
+from functools import partial
 import warnings
 
 import torch
@@ -12,10 +13,13 @@ import torch.nn as nn
 
 from .abs_model import AbsModel
 from .model_builder import ModelBuilder
-from ..data.batch_yielder import BatchYielder
+from ..data.batch_yielder import BatchYielder, StreamingBatchYielder
+from ..data.fold_dataset import FoldDataLoader
 from ..callbacks.abs_callback import AbsCallback
 from ...utils.misc import to_np
 from ..data.fold_yielder import FoldYielder
+from ..data.fold_prefetcher import FoldPrefetcher
+from ..data.pred_writer import PredWriter
 from ..interpretation.features import get_nn_feat_importance
 from ..metrics.eval_metric import EvalMetric
 from ...utils.misc import to_device
@@ -113,12 +117,13 @@ class Model(AbsModel):
 
         self.input_mask = mask
         
-    def fit(self, batch_yielder:BatchYielder, callbacks:Optional[List[AbsCallback]]=None, mask_inputs:bool=True) -> float:
+    def fit(self, batch_yielder:Union[BatchYielder,StreamingBatchYielder,FoldDataLoader], callbacks:Optional[List[AbsCallback]]=None, mask_inputs:bool=True) -> float:
         r'''
         Fit network for one complete iteration of a :class:`~lumin.nn.data.batch_yielder.BatchYielder`, i.e. one (sub-)epoch
 
         Arguments:
-            batch_yielder: :class:`~lumin.nn.data.batch_yielder.BatchYielder` providing training data in form of tuple of inputs, targtes, and weights as tensors on device
+            batch_yielder: :class:`~lumin.nn.data.batch_yielder.BatchYielder`, :class:`~lumin.nn.data.batch_yielder.StreamingBatchYielder`, or
+                :class:`~lumin.nn.data.fold_dataset.FoldDataLoader` providing training data in form of tuple of inputs, targtes, and weights as tensors on device
             callbacks: list of :class:`~lumin.nn.callbacks.abs_callback.AbsCallback` to be used during training
             mask_inputs: whether to apply input mask if one has been set
 
@@ -131,7 +136,9 @@ class Model(AbsModel):
         losses = []
         if callbacks is None: callbacks = []
         for c in callbacks: c.on_epoch_begin(by=batch_yielder)
-        if self.input_mask is not None and mask_inputs: batch_yielder.inputs = batch_yielder.inputs[:,self.input_mask]
+        if self.input_mask is not None and mask_inputs:
+            if isinstance(batch_yielder, (BatchYielder,StreamingBatchYielder,FoldDataLoader)): batch_yielder.set_input_mask(self.input_mask)
+            else:                                                                 batch_yielder.inputs = batch_yielder.inputs[:,self.input_mask]
 
         for x, y, w in batch_yielder:
             for c in callbacks: c.on_batch_begin()
@@ -171,7 +178,7 @@ class Model(AbsModel):
         self.model.eval()
         if not isinstance(inputs, Tensor):
             if isinstance(inputs, tuple):
-                if not isinstance(inputs[0], Tensor): inputs = (to_device(Tensor(inputs[0]).float()),to_device(Tensor(inputs[1]).float()))
+                if not isinstance(inputs[0], Tensor): inputs = (to_device(Tensor(inputs[0]).float()),to_device(Tensor(np.asarray(inputs[1])).float()))
             else:
                 inputs = to_device(Tensor(inputs).float())
         for c in callbacks: c.on_eval_begin(inputs=inputs, targets=targets, weights=weights)
@@ -192,7 +199,7 @@ class Model(AbsModel):
         for c in callbacks: c.on_eval_end(loss=loss)        
         return loss.data.item()
 
-    def evaluate_from_by(self, by:BatchYielder, callbacks:Optional[List[AbsCallback]]=None) -> float:
+    def evaluate_from_by(self, by:Union[BatchYielder,StreamingBatchYielder,FoldDataLoader], callbacks:Optional[List[AbsCallback]]=None) -> float:
         loss = 0
         for x, y, w in by: loss += self.evaluate(x, y, w, callbacks)*by.bs
         return loss/(len(by)*by.bs)
@@ -214,6 +221,7 @@ class Model(AbsModel):
         '''
 
         def _get_preds(inputs, callbacks):
+            if isinstance(inputs, np.ndarray): inputs = to_device(Tensor(inputs).float())  # Callbacks may modify inputs, which could be read-only arrays
             for c in callbacks: c.on_pred_begin(inputs=inputs)
             if isinstance(inputs, pd.DataFrame): inputs = to_device(Tensor(inputs.values).float())
             if self.input_mask is not None and mask_inputs:
@@ -223,7 +231,7 @@ class Model(AbsModel):
                     inputs = inputs[:,self.input_mask]
             if not isinstance(inputs, Tensor):
                 if isinstance(inputs, tuple):
-                    if not isinstance(inputs[0], Tensor): inputs = (to_device(Tensor(inputs[0]).float()),to_device(Tensor(inputs[1]).float()))
+                    if not isinstance(inputs[0], Tensor): inputs = (to_device(Tensor(inputs[0]).float()),to_device(Tensor(np.asarray(inputs[1])).float()))
                 else:
                     inputs = to_device(Tensor(inputs).float())
             pred = self.model(inputs)
@@ -250,7 +258,8 @@ class Model(AbsModel):
             return to_device(Tensor(pred))
 
     def predict_folds(self, fy:FoldYielder, pred_name:str='pred', callbacks:Optional[List[AbsCallback]]=None, verbose:bool=True,
-                      bs:Optional[int]=None) -> None:
+                      bs:Optional[int]=None, n_prefetch:int=1, tta_stack:Optional[int]=None,
+                      pred_writer:Optional[PredWriter]=None) -> None:
         r'''
         Apply model to all dataaccessed by a :class:`~lumin.nn.data.fold_yielder.FoldYielder` and save predictions as new group in fold file
 
@@ -260,26 +269,51 @@ class Model(AbsModel):
             callbacks: list of any callbacks to use during evaluation
             verbose: whether to print average prediction timings
             bs: if not `None`, will run prediction in batches of specified size to save of memory
+            n_prefetch: number of folds (or augmentations, if using test-time augmentation) to load in the background ahead of the current one
+            tta_stack: if set and using test-time augmentation, each fold is read once and its augmentations are predicted in stacks of `tta_stack`
+                augmentations at a time, via :meth:`~lumin.nn.data.fold_yielder.HEPAugFoldYielder.get_test_fold_stacks`, accumulating the average prediction.
+                Larger stacks are quicker, but hold `tta_stack` copies of the inputs of a fold, and matrix inputs, in memory at once.
+                By default, each augmentation is instead loaded and predicted separately
+            pred_writer: optional :class:`~lumin.nn.data.pred_writer.PredWriter` with which to save predictions, e.g. to a separate file or in memory.
+                By default, predictions are saved to the foldfile (or its prediction file) via a :class:`~lumin.nn.data.pred_writer.PredWriter` on a
+                background thread
         '''
 
         times = []
+        if not fy.test_time_aug:
+            folds = iter(FoldPrefetcher(fy, range(len(fy)), n_prefetch=n_prefetch))
+        elif tta_stack is not None:
+            folds = iter(FoldPrefetcher(fy, range(len(fy)), n_prefetch=n_prefetch, get_func=partial(fy.get_test_fold_stacks, n_stack=tta_stack)))
+        writer = PredWriter(fy) if pred_writer is None else pred_writer
         mb = master_bar(range(len(fy)))
         for fold_idx in mb:
             fold_tmr = timeit.default_timer()
             if not fy.test_time_aug:
-                fold = fy.get_fold(fold_idx)['inputs']
-                pred = self.predict_array(fold, callbacks=callbacks, bs=bs)
+                fold = next(folds)[1]['inputs']
+                if bs is None:
+                    pred = self.predict_array(fold, callbacks=callbacks)
+                else:  # Write predictions slice by slice as they are made
+                    for i in range(0, fy.n_rows(fold_idx), bs):
+                        pred = self.predict_array((fold[0][i:i+bs],fold[1][i:i+bs]) if isinstance(fold, tuple) else fold[i:i+bs], callbacks=callbacks)
+                        writer.write(pred if self.n_out > 1 else pred[:,0], fold_idx, pred_name=pred_name, start=i)
+                    pred = None
+            elif tta_stack is not None:
+                pred = 0
+                for augs, inputs in progress_bar(next(folds)[1], total=int(np.ceil(fy.aug_mult/tta_stack)), parent=mb):
+                    pred += self.predict_array(inputs, callbacks=callbacks, bs=bs).reshape(len(augs), -1, self.n_out).sum(0)
+                pred /= fy.aug_mult
             else:
                 tmpPred = []
-                pb = progress_bar(range(fy.aug_mult), parent=mb)
-                for aug in pb:
-                    fold = fy.get_test_fold(fold_idx, aug)['inputs']
+                augs = FoldPrefetcher(fy, range(fy.aug_mult), n_prefetch=n_prefetch, get_func=partial(fy.get_test_fold, fold_idx))
+                for aug, fold in progress_bar(augs, total=fy.aug_mult, parent=mb):
+                    fold = fold['inputs']
                     tmpPred.append(self.predict_array(fold, callbacks=callbacks, bs=bs))
                 pred = np.mean(tmpPred, axis=0)
 
-            times.append((timeit.default_timer()-fold_tmr)/len(fold))
-            if self.n_out > 1: fy.save_fold_pred(pred, fold_idx, pred_name=pred_name)
-            else: fy.save_fold_pred(pred[:, 0], fold_idx, pred_name=pred_name)
+            if pred is not None: writer.save(pred if self.n_out > 1 else pred[:,0], fold_idx, pred_name=pred_name)
+            times.append((timeit.default_timer()-fold_tmr)/fy.n_rows(fold_idx))
+        if pred_writer is None: writer.close()
+        else:                   writer.flush()
         times = uncert_round(np.mean(times), np.std(times, ddof=1)/np.sqrt(len(times)))
         if verbose: print(f'Mean time per event = {times[0]}±{times[1]}')
 
@@ -15,11 +15,15 @@ import warnings
 import torch.tensor as Tensor
 
 from ..data.fold_yielder import FoldYielder
-from ..data.batch_yielder import BatchYielder
+from ..data.batch_yielder import BatchYielder, StreamingBatchYielder
+from ..data.fold_dataset import FoldDataLoader
+from ..data.fold_prefetcher import FoldPrefetcher
+from ..data.samplers import AbsIdxSampler
 from ..models.model_builder import ModelBuilder
 from ..models.model import Model
 from ..callbacks.cyclic_callbacks import AbsCyclicCallback
 from ..callbacks.model_callbacks import AbsModelCallback
+from ..callbacks.data_callbacks import BinaryLabelSmooth, BootstrapResample
 from ...utils.misc import to_tensor, to_device
 from ...utils.statistics import uncert_round
 from ..metrics.eval_metric import EvalMetric
@@ -42,12 +46,23 @@ def _get_folds(val_idx, n_folds, shuffle_folds:bool=True):
     return folds
 
 
+def _check_data_callbacks(callback_partials:List[partial], setting:str) -> None:
+    r'''
+    Raises a ValueError if any callbacks modify the in-memory data of :class:`~lumin.nn.data.batch_yielder.BatchYielder` s, which are not used with `setting`
+    '''
+
+    bad = [getattr(c, 'func', c) for c in callback_partials]
+    bad = [c.__name__ for c in bad if isinstance(c, type) and issubclass(c, (BinaryLabelSmooth, BootstrapResample))]
+    if len(bad) > 0: raise ValueError(f"Callbacks {bad} modify the in-memory training data, and so cannot be used with {setting}")
+
+
 def fold_train_ensemble(fy:FoldYielder, n_models:int, bs:int, model_builder:ModelBuilder,
                         callback_partials:Optional[List[partial]]=None, eval_metrics:Optional[Dict[str,EvalMetric]]=None,
                         train_on_weights:bool=True, eval_on_weights:bool=True, patience:int=10, max_epochs:int=200,
                         shuffle_fold:bool=True, shuffle_folds:bool=True, bulk_move:bool=True,
                         live_fdbk:bool=True, live_fdbk_first_only:bool=True, live_fdbk_extra:bool=True, live_fdbk_extra_first_only:bool=False,
-                        savepath:Path=Path('train_weights'), verbose:bool=False, log_output:bool=False,
+                        savepath:Path=Path('train_weights'), verbose:bool=False, log_output:bool=False, n_prefetch:int=1,
+                        stream_buffer:Optional[int]=None, num_workers:int=0, sampler:Optional[AbsIdxSampler]=None,
                         plot_settings:PlotSettings=PlotSettings(), plots:Optional[Any]=None) -> Tuple[List[Dict[str,float]],List[Dict[str,List[float]]],List[Dict[str,float]]]:
     r'''
     Main training method for :class:`~lumin.nn.models.model.Model`.
@@ -92,6 +107,17 @@ def fold_train_ensemble(fy:FoldYielder, n_models:int, bs:int, model_builder:Mode
         savepath: path to to which to save model weights and results
         verbose: whether to print out extra information during training
         log_output: whether to save printed results to a log file rather than printing them
+        n_prefetch: number of training folds to load in the background ahead of the current one, via a
+            :class:`~lumin.nn.data.fold_prefetcher.FoldPrefetcher`. Set to zero to load folds synchronously.
+        stream_buffer: if set, training folds are not loaded into memory, but are instead streamed from the foldfile via a
+            :class:`~lumin.nn.data.batch_yielder.StreamingBatchYielder` with a shuffle buffer of this many rows. The validation fold is still loaded.
+            Incompatible with callbacks which modify the in-memory training data, e.g. :class:`~lumin.nn.callbacks.data_callbacks.BinaryLabelSmooth` and
+            :class:`~lumin.nn.callbacks.data_callbacks.BootstrapResample`.
+        num_workers: if greater than zero, training minibatches are loaded and augmented by this many persistent worker processes, via a
+            :class:`~lumin.nn.data.fold_dataset.FoldDataLoader`, rather than by loading whole folds in the main process. Incompatible with `stream_buffer`,
+            and with callbacks which modify the in-memory training data.
+        sampler: optional index sampler from :mod:`~lumin.nn.data.samplers`, e.g. :class:`~lumin.nn.data.samplers.ClassBalancedSampler`, selecting the rows
+            of each training fold to yield per sub-epoch. Only used when training folds are loaded into memory, i.e. `stream_buffer` and `num_workers` are not set.
         plot_settings: :class:`~lumin.plotting.plot_settings.PlotSettings` class to control figure appearance
         plots: Depreciated: loss history will always be shown,
             lr history will no longer be shown separately,
@@ -117,9 +143,13 @@ def fold_train_ensemble(fy:FoldYielder, n_models:int, bs:int, model_builder:Mode
         warnings.warn("The plots argument is now depreciated and ignored. Loss history will always be shown, lr history will no longer be shown separately, \
                        and live feedback is now controlled by the four live_fdbk arguments. This argument will be removed in V0.6.")
 
+    if stream_buffer is not None and num_workers > 0: raise ValueError("Only one of stream_buffer and num_workers may be set")
+    if sampler is not None and (stream_buffer is not None or num_workers > 0): raise ValueError("sampler cannot be used with stream_buffer or num_workers")
+    if stream_buffer is not None: _check_data_callbacks(callback_partials, 'stream_buffer')
+    if num_workers > 0:           _check_data_callbacks(callback_partials, 'num_workers')
     train_tmr = timeit.default_timer()
     results,histories,cycle_losses = [],[],[]
-    nb = len(fy.foldfile['fold_0/targets'])//bs
+    nb = fy.n_rows(0)//bs
 
     if live_fdbk:
         metric_log = MetricLogger(loss_names=['Train', 'Validation'], n_folds=fy.n_folds, extra_detail=live_fdbk_extra or live_fdbk_extra_first_only,
@@ -173,61 +203,81 @@ def fold_train_ensemble(fy:FoldYielder, n_models:int, bs:int, model_builder:Mode
 
         epoch_pb = progress_bar(range(max_epochs), leave=True)
         if live_fdbk: model_bar.show()
-        for epoch in epoch_pb:
-            for trn_id in trn_ids:
-                sub_epoch += 1
-                batch_yielder = BatchYielder(**fy.get_fold(trn_id), objective=model_builder.objective,
-                                             bs=bs, use_weights=train_on_weights, shuffle=shuffle_fold, bulk_move=bulk_move)
-                loss_history['trn_loss'].append(model.fit(batch_yielder, callbacks))
-                del batch_yielder
-
-                if bulk_move:
-                    val_loss = model.evaluate(val_x, val_y, weights=val_w, callbacks=callbacks)
-                else:
-                    batch_yielder = BatchYielder(**val_fold, objective=model_builder.objective,
-                                                 bs=bs, use_weights=train_on_weights, shuffle=shuffle_fold, bulk_move=bulk_move)
-                    val_loss = model.evaluate_from_by(batch_yielder, callbacks=callbacks)
+        if num_workers > 0:
+            loader = FoldDataLoader(fy, trn_ids[:1], bs=bs, objective=model_builder.objective, shuffle=shuffle_fold, use_weights=train_on_weights,
+                                    num_workers=num_workers)
+        elif stream_buffer is None:
+            prefetcher = FoldPrefetcher(fy, trn_ids*max_epochs, n_prefetch=n_prefetch)
+            trn_folds = iter(prefetcher)
+        try:
+            for epoch in epoch_pb:
+                for trn_id in trn_ids:
+                    sub_epoch += 1
+                    if num_workers > 0:
+                        loader.set_folds([trn_id])
+                        batch_yielder = loader
+                    elif stream_buffer is None:
+                        _, trn_fold = next(trn_folds)
+                        batch_yielder = BatchYielder(**trn_fold, objective=model_builder.objective,
+                                                     bs=bs, use_weights=train_on_weights, shuffle=shuffle_fold, bulk_move=bulk_move, aug_fn=fy.get_batch_aug(),
+                                                     sampler=sampler)
+                        del trn_fold
+                    else:
+                        batch_yielder = StreamingBatchYielder(fy, trn_id, bs=bs, objective=model_builder.objective, buffer_size=stream_buffer,
+                                                              shuffle=shuffle_fold, use_weights=train_on_weights)
+                    loss_history['trn_loss'].append(model.fit(batch_yielder, callbacks))
                     del batch_yielder
 
-                loss_history['val_loss'].append(val_loss)
-                loss_callback_idx = None
-                loss = val_loss
-                for i, lc in enumerate(loss_callbacks):
-                    l = lc.get_loss()
-                    if l < loss: loss, loss_callback_idx = l, i
-                    if verbose: print(f'{sub_epoch} {type(lc).__name__} loss {l}, default loss {val_loss}')
-                    l = loss if l is None or not lc.active else l
-                    loss_history[f'{type(lc).__name__}_val_loss'].append(l)
+                    if bulk_move:
+                        val_loss = model.evaluate(val_x, val_y, weights=val_w, callbacks=callbacks)
+                    else:
+                        batch_yielder = BatchYielder(**val_fold, objective=model_builder.objective,
+                                                     bs=bs, use_weights=train_on_weights, shuffle=shuffle_fold, bulk_move=bulk_move)
+                        val_loss = model.evaluate_from_by(batch_yielder, callbacks=callbacks)
+                        del batch_yielder
+
+                    loss_history['val_loss'].append(val_loss)
+                    loss_callback_idx = None
+                    loss = val_loss
+                    for i, lc in enumerate(loss_callbacks):
+                        l = lc.get_loss()
+                        if l < loss: loss, loss_callback_idx = l, i
+                        if verbose: print(f'{sub_epoch} {type(lc).__name__} loss {l}, default loss {val_loss}')
+                        l = loss if l is None or not lc.active else l
+                        loss_history[f'{type(lc).__name__}_val_loss'].append(l)
 
-                if cyclic_callback is not None and cyclic_callback.cycle_end:
-                    if verbose: print(f"Saving snapshot {cyclic_callback.cycle_count}")
-                    cycle_losses[-1][cyclic_callback.cycle_count] = val_loss
-                    model.save(str(savepath/f"{model_num}_cycle_{cyclic_callback.cycle_count}.h5"))
+                    if cyclic_callback is not None and cyclic_callback.cycle_end:
+                        if verbose: print(f"Saving snapshot {cyclic_callback.cycle_count}")
+                        cycle_losses[-1][cyclic_callback.cycle_count] = val_loss
+                        model.save(str(savepath/f"{model_num}_cycle_{cyclic_callback.cycle_count}.h5"))
 
-                if loss <= best_loss:
-                    best_loss = loss
-                    epoch_pb.comment = f'Best loss: {best_loss:.4E} at sub-epoch: {sub_epoch}'
-                    if verbose: print(epoch_pb.comment)
-                    epoch_counter = 0
-                    if loss_callback_idx is not None: loss_callbacks[loss_callback_idx].test_model.save(savepath/"best.h5")
-                    else: model.save(savepath/"best.h5")
-                    if cyclic_callback is not None: improv_in_cycle = True
-                elif cyclic_callback is not None:
-                    if cyclic_callback.cycle_end:
-                        if improv_in_cycle:
-                            epoch_counter = 0
-                            improv_in_cycle = False
-                        else:
-                            epoch_counter += 1
-                else:
-                    epoch_counter += 1
+                    if loss <= best_loss:
+                        best_loss = loss
+                        epoch_pb.comment = f'Best loss: {best_loss:.4E} at sub-epoch: {sub_epoch}'
+                        if verbose: print(epoch_pb.comment)
+                        epoch_counter = 0
+                        if loss_callback_idx is not None: loss_callbacks[loss_callback_idx].test_model.save(savepath/"best.h5")
+                        else: model.save(savepath/"best.h5")
+                        if cyclic_callback is not None: improv_in_cycle = True
+                    elif cyclic_callback is not None:
+                        if cyclic_callback.cycle_end:
+                            if improv_in_cycle:
+                                epoch_counter = 0
+                                improv_in_cycle = False
+                            else:
+                                epoch_counter += 1
+                    else:
+                        epoch_counter += 1
 
-                if live_fdbk: metric_log.update_vals([loss_history[l][-1] for l in loss_history])
-                if epoch_counter >= patience or model.stop_train:  # Early stopping
-                    print('Early stopping after {} sub-epochs'.format(sub_epoch))
-                    stop = True; break
-            if live_fdbk: metric_log.update_plot(best_loss)
-            if stop: break
+                    if live_fdbk: metric_log.update_vals([loss_history[l][-1] for l in loss_history])
+                    if epoch_counter >= patience or model.stop_train:  # Early stopping
+                        print('Early stopping after {} sub-epochs'.format(sub_epoch))
+                        stop = True; break
+                if live_fdbk: metric_log.update_plot(best_loss)
+                if stop: break
+        finally:  # Stop workers and background loading, even if training fails
+            if num_workers > 0:         loader.close()
+            elif stream_buffer is None: prefetcher.close()
 
         model.load(savepath/"best.h5")
         model.save(savepath/f'train_{model_num}.h5')
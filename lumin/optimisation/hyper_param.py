@@ -9,6 +9,7 @@ from sklearn.ensemble import RandomForestRegressor, RandomForestClassifier
 
 from ..nn.data.fold_yielder import FoldYielder
 from ..nn.data.batch_yielder import BatchYielder
+from ..nn.data.fold_prefetcher import FoldPrefetcher
 from ..nn.models.model_builder import ModelBuilder
 from ..nn.models.model import Model
 from ..nn.callbacks.opt_callbacks import LRFinder
@@ -79,7 +80,7 @@ def get_opt_rf_params(x_trn:np.ndarray, y_trn:np.ndarray, x_val:np.ndarray, y_va
 def fold_lr_find(fy:FoldYielder, model_builder:ModelBuilder, bs:int,
                  train_on_weights:bool=True, shuffle_fold:bool=True, n_folds:int=-1, lr_bounds:Tuple[float,float]=[1e-5, 10],
                  callback_partials:Optional[List[partial]]=None, plot_settings:PlotSettings=PlotSettings(),
-                 bulk_move:bool=True) -> List[LRFinder]:
+                 bulk_move:bool=True, n_prefetch:int=1) -> List[LRFinder]:
     r'''
     Wrapper function for training using :class:`~lumin.nn.callbacks.opt_callbacks.LRFinder` which runs a Smith LR range test (https://arxiv.org/abs/1803.09820)
     using folds in :class:`~lumin.nn.data.fold_yielder.FoldYielder`.
@@ -96,6 +97,8 @@ def fold_lr_find(fy:FoldYielder, model_builder:ModelBuilder, bs:int,
         lr_bounds: starting and ending LR values
         callback_partials: optional list of functools.partial, each of which will a instantiate :class:`~lumin.nn.callbacks.callback.Callback` when called        
         plot_settings: :class:`~lumin.plotting.plot_settings.PlotSettings` class to control figure appearance
+        bulk_move: whether to pass all training data to device at once, or by minibatch
+        n_prefetch: number of folds to load in the background ahead of the current one. Set to zero to load folds synchronously.
 
     Returns:
         List of :class:`~lumin.nn.callbacks.opt_callbacks.LRFinder` which were used for each model trained
@@ -106,9 +109,8 @@ def fold_lr_find(fy:FoldYielder, model_builder:ModelBuilder, bs:int,
     lr_finders = []
     tmr = timeit.default_timer()
     nb = None
-    for trn_id in progress_bar(idxs):
+    for trn_id, trn_fold in progress_bar(FoldPrefetcher(fy, idxs, n_prefetch=n_prefetch), total=len(idxs)):
         model = Model(model_builder)
-        trn_fold = fy.get_fold(trn_id)
         if nb is None: nb = len(trn_fold['targets'])//bs
         lr_finder = LRFinder(nb=nb, lr_bounds=lr_bounds, model=model)
         cyclic_callback,callbacks = None,[]
@@ -120,8 +122,8 @@ def fold_lr_find(fy:FoldYielder, model_builder:ModelBuilder, bs:int,
         for c in callbacks:
             c.on_train_begin()
         lr_finder.on_train_begin()
-        batch_yielder = BatchYielder(**fy.get_fold(trn_id), objective=model_builder.objective, bs=bs, use_weights=train_on_weights, shuffle=shuffle_fold,
-                                     bulk_move=bulk_move)
+        batch_yielder = BatchYielder(**trn_fold, objective=model_builder.objective, bs=bs, use_weights=train_on_weights, shuffle=shuffle_fold,
+                                     bulk_move=bulk_move, aug_fn=fy.get_batch_aug())
         model.fit(batch_yielder, callbacks+[lr_finder])
         lr_finders.append(lr_finder)
         